@@ -0,0 +1,380 @@
+"""
+Модуль резервного копирования PostgreSQL.
+
+Таблицы users и balance_history выгружаются через COPY ... TO STDOUT (CSV) из
+одного снимка REPEATABLE READ и сжимаются в gzip в отдельном потоке, поэтому
+резервное копирование не блокирует обработчики бота. Копии складываются в
+BACKUP_DIR наборами "<время>_full" и "<время>_incremental":
+- полная копия содержит обе таблицы целиком;
+- инкрементальная содержит users целиком (таблица небольшая и не хранит время
+  изменения) и только новые строки balance_history по id после предыдущего набора.
+Хранятся последние BACKUP_KEEP_FULL полных копий вместе с их инкрементальными.
+
+Запуск из командной строки:
+    python backup.py backup [--full]
+    python backup.py list
+    python backup.py restore [НАБОР]
+
+Восстановление выполняется при остановленном боте: строки users обновляются по
+user_id, строки balance_history добавляются по id (уже существующие пропускаются).
+"""
+import os
+import sys
+import json
+import gzip
+import time
+import shutil
+import asyncio
+import logging
+import argparse
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional
+
+import asyncpg
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Каталог резервных копий и сколько полных копий (с их инкрементальными) хранить
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_KEEP_FULL = int(os.getenv("BACKUP_KEEP_FULL", "3"))
+# Как часто делать копию и как часто она должна быть полной (в секундах)
+BACKUP_INTERVAL = float(os.getenv("BACKUP_INTERVAL", str(6 * 60 * 60)))
+BACKUP_FULL_INTERVAL = float(os.getenv("BACKUP_FULL_INTERVAL", str(24 * 60 * 60)))
+# Таймаут одной выгрузки COPY (таймаут запросов пула для нее слишком мал)
+BACKUP_COPY_TIMEOUT = float(os.getenv("BACKUP_COPY_TIMEOUT", "1800"))
+BACKUP_COMPRESSION_LEVEL = int(os.getenv("BACKUP_COMPRESSION_LEVEL", "6"))
+# Инкрементальная копия начинается на столько id раньше конца предыдущей: строки
+# balance_history из транзакций, зафиксированных после снимка, могут получить меньший
+# id, чем уже выгруженные. Повторы при восстановлении пропускаются
+BACKUP_ID_OVERLAP = int(os.getenv("BACKUP_ID_OVERLAP", "1000"))
+
+# Порядок важен: balance_history ссылается на users
+BACKUP_TABLES = ("users", "balance_history")
+# Ключи, по которым восстановленные строки сопоставляются с существующими
+TABLE_KEYS = {"users": "user_id", "balance_history": "id"}
+# Сжатые данные пишутся на диск порциями не меньше этого размера
+WRITE_CHUNK_BYTES = 1024 * 1024
+READ_CHUNK_BYTES = 256 * 1024
+MANIFEST_NAME = "manifest.json"
+
+class _GzipSink:
+    """Приемник COPY: копит порции данных и сжимает их в файл в отдельном потоке."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.raw_bytes = 0
+        self._buffer: List[bytes] = []
+        self._buffered = 0
+        self._file = None
+
+    async def open(self) -> None:
+        self._file = await asyncio.to_thread(gzip.open, self.path, "wb", BACKUP_COMPRESSION_LEVEL)
+
+    async def write(self, chunk: bytes) -> None:
+        self._buffer.append(chunk)
+        self._buffered += len(chunk)
+        self.raw_bytes += len(chunk)
+        if self._buffered >= WRITE_CHUNK_BYTES:
+            await self._flush()
+
+    async def _flush(self) -> None:
+        data = b"".join(self._buffer)
+        self._buffer.clear()
+        self._buffered = 0
+        if data:
+            await asyncio.to_thread(self._file.write, data)
+
+    async def close(self) -> None:
+        if self._file is None:
+            return
+        try:
+            await self._flush()
+        finally:
+            await asyncio.to_thread(self._file.close)
+
+async def _read_gzip(path: str) -> AsyncIterator[bytes]:
+    """Источник для COPY FROM: распаковка файла порциями в отдельном потоке."""
+    f = await asyncio.to_thread(gzip.open, path, "rb")
+    try:
+        while True:
+            chunk = await asyncio.to_thread(f.read, READ_CHUNK_BYTES)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        await asyncio.to_thread(f.close)
+
+def _copy_rows(status: str) -> int:
+    # asyncpg возвращает статус команды вида "COPY 1234"
+    try:
+        return int(status.split()[-1])
+    except (AttributeError, ValueError, IndexError):
+        return 0
+
+class BackupEngine:
+    """
+    Резервное копирование и восстановление users и balance_history.
+
+    Args:
+        directory: Каталог наборов резервных копий
+        dsn: Строка подключения; без нее копия снимается через пул db.py
+            (с реплики, если она настроена и не отстает)
+    """
+
+    def __init__(self, directory: str = BACKUP_DIR, dsn: Optional[str] = None):
+        self.directory = directory
+        self.dsn = dsn
+        self._lock = asyncio.Lock()
+        self.stats: Dict[str, object] = {
+            "backups": 0,
+            "failures": 0,
+            "skipped": 0,
+            "last_backup": None,
+            "last_duration_s": None,
+            "last_bytes": None,
+        }
+
+    @asynccontextmanager
+    async def _connection(self):
+        if self.dsn:
+            conn = await asyncpg.connect(self.dsn)
+            try:
+                yield conn
+            finally:
+                await conn.close()
+        else:
+            from db import acquire_read
+            async with acquire_read() as conn:
+                yield conn
+
+    def list_sets(self) -> List[dict]:
+        """Завершенные наборы копий (манифесты) в порядке создания."""
+        if not os.path.isdir(self.directory):
+            return []
+        sets = []
+        for name in sorted(os.listdir(self.directory)):
+            manifest_path = os.path.join(self.directory, name, MANIFEST_NAME)
+            if name.endswith(".partial") or not os.path.exists(manifest_path):
+                continue
+            try:
+                with open(manifest_path, encoding="utf-8") as f:
+                    sets.append(json.load(f))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Не удалось прочитать манифест резервной копии {manifest_path}: {e}")
+        return sets
+
+    @staticmethod
+    async def _columns(conn, table: str) -> List[str]:
+        rows = await conn.fetch('''
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = $1
+            ORDER BY ordinal_position
+        ''', table)
+        return [row['column_name'] for row in rows]
+
+    async def _export(self, conn, table: str, path: str, from_id: int, to_id: int) -> dict:
+        columns = await self._columns(conn, table)
+        column_list = ", ".join(f'"{c}"' for c in columns)
+        query = f"SELECT {column_list} FROM {table}"
+        args = []
+        if table == "balance_history":
+            query += " WHERE id > $1 AND id <= $2"
+            args = [from_id, to_id]
+        sink = _GzipSink(path)
+        await sink.open()
+        try:
+            status = await conn.copy_from_query(query, *args, output=sink.write, format="csv",
+                                                header=True, timeout=BACKUP_COPY_TIMEOUT)
+        finally:
+            await sink.close()
+        return {
+            "file": os.path.basename(path),
+            "columns": columns,
+            "rows": _copy_rows(status),
+            "raw_bytes": sink.raw_bytes,
+            "bytes": os.path.getsize(path),
+        }
+
+    async def create_backup(self, full: Optional[bool] = None) -> Optional[dict]:
+        """
+        Снять набор резервных копий.
+
+        Args:
+            full: True - полная копия, False - инкрементальная (если есть полная),
+                None - полная раз в BACKUP_FULL_INTERVAL, иначе инкрементальная
+
+        Returns:
+            Optional[dict]: Манифест набора или None при ошибке или если копия уже снимается
+        """
+        if self._lock.locked():
+            self.stats["skipped"] += 1
+            logger.warning("Резервное копирование уже выполняется, запуск пропущен")
+            return None
+        async with self._lock:
+            started = time.monotonic()
+            partial = None
+            try:
+                sets = self.list_sets()
+                fulls = [s for s in sets if s["kind"] == "full"]
+                base = None
+                from_id = 0
+                if full is not True and fulls:
+                    full_age = time.time() - fulls[-1]["created_ts"]
+                    if full is False or full_age < BACKUP_FULL_INTERVAL:
+                        base = fulls[-1]["name"]
+                        from_id = max(0, sets[-1]["balance_history_to_id"] - BACKUP_ID_OVERLAP)
+                kind = "incremental" if base else "full"
+                name = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{kind}"
+                partial = os.path.join(self.directory, name + ".partial")
+                os.makedirs(partial, exist_ok=True)
+
+                manifest = {"name": name, "kind": kind, "base": base or name,
+                            "created_at": datetime.now().isoformat(timespec="seconds"),
+                            "created_ts": time.time(), "balance_history_from_id": from_id,
+                            "tables": {}}
+                async with self._connection() as conn:
+                    # Один снимок для обеих таблиц: история согласована с балансами
+                    async with conn.transaction(isolation="repeatable_read", readonly=True):
+                        to_id = await conn.fetchval("SELECT COALESCE(max(id), 0) FROM balance_history")
+                        for table in BACKUP_TABLES:
+                            path = os.path.join(partial, f"{table}.csv.gz")
+                            manifest["tables"][table] = await self._export(conn, table, path, from_id, to_id)
+                manifest["balance_history_to_id"] = to_id
+                manifest["duration_s"] = round(time.monotonic() - started, 2)
+
+                with open(os.path.join(partial, MANIFEST_NAME), "w", encoding="utf-8") as f:
+                    json.dump(manifest, f, ensure_ascii=False, indent=2)
+                # Набор появляется под своим именем только целиком
+                os.replace(partial, os.path.join(self.directory, name))
+                partial = None
+
+                size = sum(t["bytes"] for t in manifest["tables"].values())
+                self.stats.update(backups=self.stats["backups"] + 1, last_backup=name,
+                                  last_duration_s=manifest["duration_s"], last_bytes=size)
+                rows = ", ".join(f"{t}: {m['rows']}" for t, m in manifest["tables"].items())
+                logger.info(f"Создана резервная копия {name} за {manifest['duration_s']} с "
+                            f"({rows}; {size / (1024 * 1024):.2f} МБ)")
+                await asyncio.to_thread(self._rotate)
+                return manifest
+            except Exception as e:
+                self.stats["failures"] += 1
+                logger.error(f"Ошибка при создании резервной копии базы данных: {e}")
+                if partial:
+                    await asyncio.to_thread(shutil.rmtree, partial, True)
+                return None
+
+    def _rotate(self) -> None:
+        """Удалить полные копии сверх BACKUP_KEEP_FULL вместе с их инкрементальными."""
+        sets = self.list_sets()
+        fulls = [s["name"] for s in sets if s["kind"] == "full"]
+        expired = set(fulls[:-BACKUP_KEEP_FULL]) if BACKUP_KEEP_FULL > 0 else set()
+        for backup_set in sets:
+            if backup_set["base"] in expired:
+                shutil.rmtree(os.path.join(self.directory, backup_set["name"]), ignore_errors=True)
+                logger.info(f"Удалена старая резервная копия: {backup_set['name']}")
+        # Недописанные наборы от прерванных запусков
+        for name in os.listdir(self.directory):
+            if name.endswith(".partial"):
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def restore_chain(self, name: Optional[str] = None) -> List[dict]:
+        """Наборы, которые нужно применить для восстановления на момент набора name (по умолчанию последнего)."""
+        sets = self.list_sets()
+        if name is None:
+            if not sets:
+                raise ValueError(f"В {self.directory} нет резервных копий")
+            target = sets[-1]
+        else:
+            target = next((s for s in sets if s["name"] == name), None)
+            if target is None:
+                raise ValueError(f"Резервная копия {name} не найдена в {self.directory}")
+        return [s for s in sets if s["base"] == target["base"] and s["name"] <= target["name"]]
+
+    async def _import(self, conn, backup_set: dict, table: str) -> int:
+        info = backup_set["tables"][table]
+        columns = info["columns"]
+        column_list = ", ".join(f'"{c}"' for c in columns)
+        key = TABLE_KEYS[table]
+        staging = f"restore_{table}"
+        await conn.execute(f"CREATE TEMP TABLE {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP")
+        path = os.path.join(self.directory, backup_set["name"], info["file"])
+        await conn.copy_to_table(staging, source=_read_gzip(path), columns=columns, format="csv",
+                                 header=True, timeout=BACKUP_COPY_TIMEOUT)
+        if table == "users":
+            updates = ", ".join(f'"{c}" = EXCLUDED."{c}"' for c in columns if c != key)
+            conflict = f"DO UPDATE SET {updates}" if updates else "DO NOTHING"
+        else:
+            conflict = "DO NOTHING"
+        status = await conn.execute(
+            f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {staging} "
+            f"ON CONFLICT ({key}) {conflict}",
+            timeout=BACKUP_COPY_TIMEOUT,
+        )
+        return _copy_rows(status)
+
+    async def restore(self, name: Optional[str] = None) -> Dict[str, int]:
+        """
+        Восстановить users и balance_history из набора name и предшествующих ему.
+
+        Returns:
+            Dict[str, int]: Сколько строк записано в каждую таблицу
+        """
+        chain = self.restore_chain(name)
+        restored = {table: 0 for table in BACKUP_TABLES}
+        async with self._connection() as conn:
+            for backup_set in chain:
+                # Каждый набор применяется целиком или не применяется вовсе
+                async with conn.transaction():
+                    for table in BACKUP_TABLES:
+                        restored[table] += await self._import(conn, backup_set, table)
+                logger.info(f"Применена резервная копия {backup_set['name']}")
+            await conn.execute('''
+                SELECT setval(pg_get_serial_sequence('balance_history', 'id'),
+                              GREATEST((SELECT COALESCE(MAX(id), 0) FROM balance_history), 1))
+            ''')
+        return restored
+
+    def get_stats(self) -> dict:
+        return dict(self.stats)
+
+# Глобальный экземпляр (копии снимаются через пул бота)
+backup_engine = BackupEngine()
+
+async def _main(args) -> None:
+    from db import PG_CONNECTION_STRING
+    engine = BackupEngine(args.directory, args.dsn or PG_CONNECTION_STRING)
+    if args.command == "backup":
+        manifest = await engine.create_backup(full=True if args.full else None)
+        if manifest is None:
+            sys.exit(1)
+        print(json.dumps(manifest, ensure_ascii=False, indent=2))
+    elif args.command == "list":
+        for backup_set in engine.list_sets():
+            rows = ", ".join(f"{t}: {m['rows']}" for t, m in backup_set["tables"].items())
+            print(f"{backup_set['name']}\t{backup_set['created_at']}\t{rows}")
+    elif args.command == "restore":
+        from migrations import run_migrations
+        # Таблицы должны существовать в актуальной схеме
+        await run_migrations(engine.dsn)
+        restored = await engine.restore(args.name)
+        print(json.dumps(restored, ensure_ascii=False))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Резервное копирование users и balance_history")
+    parser.add_argument("--directory", default=BACKUP_DIR, help="Каталог резервных копий")
+    parser.add_argument("--dsn", help="Строка подключения (по умолчанию как у бота)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    backup_parser = commands.add_parser("backup", help="Снять резервную копию")
+    backup_parser.add_argument("--full", action="store_true", help="Полная копия вместо инкрементальной")
+    commands.add_parser("list", help="Показать резервные копии")
+    restore_parser = commands.add_parser("restore", help="Восстановить из резервной копии")
+    restore_parser.add_argument("name", nargs="?", help="Набор (по умолчанию последний)")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    asyncio.run(_main(args))
+
+if __name__ == "__main__":
+    main()
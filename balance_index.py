@@ -0,0 +1,110 @@
+"""
+Компактный индекс балансов user_id -> balance в памяти процесса.
+
+Индекс загружается из таблицы users одним проходом в два отсортированных
+массива array('q') (16 байт на пользователя против ~100 байт у dict) и ищет
+баланс бинарным поиском. Пользователи, появившиеся после загрузки, хранятся в
+небольшом словаре до следующей сверки с БД, при которой индекс собирается заново.
+Балансы активных пользователей после первого чтения копируются в словарь, поэтому
+повторные чтения обходятся без бинарного поиска.
+"""
+import sys
+from array import array
+from bisect import bisect_left
+from typing import Dict, Optional
+
+# Сколько балансов активных пользователей держать в словаре для быстрого чтения
+HOT_ENTRIES_MAX = 100_000
+
+class BalanceIndex:
+    """
+    Индекс балансов на отсортированных массивах.
+
+    Args:
+        user_ids: Отсортированные по возрастанию ID пользователей
+        balances: Балансы в том же порядке
+    """
+
+    __slots__ = ("user_ids", "balances", "_extra", "_hot", "lookups", "hits")
+
+    def __init__(self, user_ids: Optional[array] = None, balances: Optional[array] = None):
+        self.user_ids = user_ids if user_ids is not None else array("q")
+        self.balances = balances if balances is not None else array("q")
+        # Изменения вне массивов: новые пользователи и удаленные (None)
+        self._extra: Dict[int, Optional[int]] = {}
+        # Копии балансов из массивов для недавно читавшихся пользователей
+        self._hot: Dict[int, int] = {}
+        self.lookups = 0
+        self.hits = 0
+
+    def _position(self, user_id: int) -> int:
+        i = bisect_left(self.user_ids, user_id)
+        return i if i < len(self.user_ids) and self.user_ids[i] == user_id else -1
+
+    def get(self, user_id: int) -> Optional[int]:
+        """Баланс пользователя или None, если его нет в индексе."""
+        self.lookups += 1
+        balance = self._hot.get(user_id)
+        if balance is not None:
+            self.hits += 1
+            return balance
+        if user_id in self._extra:
+            balance = self._extra[user_id]
+        else:
+            i = self._position(user_id)
+            if i < 0:
+                return None
+            balance = self.balances[i]
+            if len(self._hot) >= HOT_ENTRIES_MAX:
+                self._hot.clear()
+            self._hot[user_id] = balance
+        if balance is not None:
+            self.hits += 1
+        return balance
+
+    def peek(self, user_id: int) -> Optional[int]:
+        """Баланс без учета в статистике и без копирования в словарь активных (для сверки)."""
+        if user_id in self._extra:
+            return self._extra[user_id]
+        i = self._position(user_id)
+        return self.balances[i] if i >= 0 else None
+
+    def set(self, user_id: int, balance: int) -> None:
+        self._hot.pop(user_id, None)
+        i = self._position(user_id)
+        if i >= 0 and user_id not in self._extra:
+            self.balances[i] = balance
+        else:
+            self._extra[user_id] = balance
+
+    def remove(self, user_id: int) -> None:
+        self._hot.pop(user_id, None)
+        self._extra[user_id] = None
+
+    def __len__(self) -> int:
+        size = len(self.user_ids)
+        for user_id, balance in self._extra.items():
+            in_arrays = self._position(user_id) >= 0
+            if balance is None and in_arrays:
+                size -= 1
+            elif balance is not None and not in_arrays:
+                size += 1
+        return size
+
+    def memory_bytes(self) -> int:
+        return (
+            self.user_ids.itemsize * len(self.user_ids)
+            + self.balances.itemsize * len(self.balances)
+            + sys.getsizeof(self._extra)
+            + sys.getsizeof(self._hot)
+        )
+
+    def get_stats(self) -> dict:
+        return {
+            "users": len(self),
+            "unmerged": len(self._extra),
+            "hot": len(self._hot),
+            "memory_bytes": self.memory_bytes(),
+            "lookups": self.lookups,
+            "hits": self.hits,
+        }
@@ -0,0 +1,8 @@
+"""
+Бенчмарки бота с локальными заглушками OpenAI и Telegram Bot API.
+
+Запуск из корня репозитория, например:
+    python -m benchmarks.load_test --users 50
+    python -m benchmarks.replay traffic.jsonl --speed 10
+    python -m benchmarks.db_bench --concurrency 1,10,50
+"""
@@ -0,0 +1,199 @@
+"""
+Общие утилиты бенчмарков: подключение к одноразовой БД, подсчет обращений
+к PostgreSQL, перцентили и запись отчетов.
+"""
+import os
+import sys
+import json
+import math
+import time
+import platform
+import subprocess
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+def require_bench_database() -> str:
+    """
+    Получить строку подключения к одноразовой БД для бенчмарков.
+
+    db.py по умолчанию подключается к боевой базе, поэтому бенчмарки работают
+    только с явно указанной BENCH_DATABASE_URL. Функцию нужно вызвать до импорта db.
+    """
+    url = os.getenv("BENCH_DATABASE_URL")
+    if not url:
+        print("ОШИБКА: укажите BENCH_DATABASE_URL - строку подключения к одноразовой базе PostgreSQL")
+        sys.exit(2)
+    # db.py берет строку подключения из DATABASE_PUBLIC_URL
+    os.environ["DATABASE_PUBLIC_URL"] = url
+    return url
+
+class _CountingTransaction:
+    """Транзакция, учитывающая BEGIN и COMMIT/ROLLBACK как обращения к БД."""
+
+    def __init__(self, transaction, pool: "InstrumentedPool"):
+        self._transaction = transaction
+        self._pool = pool
+
+    async def __aenter__(self):
+        self._pool.round_trips += 1
+        return await self._transaction.__aenter__()
+
+    async def __aexit__(self, *exc):
+        self._pool.round_trips += 1
+        return await self._transaction.__aexit__(*exc)
+
+class CountingConnection:
+    """Обертка над соединением asyncpg, считающая обращения к серверу."""
+
+    _QUERY_METHODS = {
+        "execute", "executemany", "fetch", "fetchrow", "fetchval",
+        "copy_from_table", "copy_from_query", "copy_to_table", "copy_records_to_table",
+    }
+
+    def __init__(self, connection, pool: "InstrumentedPool"):
+        self._connection = connection
+        self._pool = pool
+
+    def transaction(self, *args, **kwargs):
+        return _CountingTransaction(self._connection.transaction(*args, **kwargs), self._pool)
+
+    def __getattr__(self, name):
+        attr = getattr(self._connection, name)
+        if name not in self._QUERY_METHODS:
+            return attr
+
+        async def counted(*args, **kwargs):
+            self._pool.round_trips += 1
+            return await attr(*args, **kwargs)
+        return counted
+
+class _AcquireContext:
+    """Контекст pool.acquire(), измеряющий время ожидания соединения."""
+
+    def __init__(self, pool: "InstrumentedPool", timeout=None):
+        self._pool = pool
+        self._timeout = timeout
+        self._connection = None
+
+    async def _acquire(self):
+        started = time.perf_counter()
+        self._connection = await self._pool.pool.acquire(timeout=self._timeout)
+        self._pool.record_acquire(time.perf_counter() - started)
+        return CountingConnection(self._connection, self._pool)
+
+    def __await__(self):
+        # Как у asyncpg: await pool.acquire() без async with (так берет соединение PoolSupervisor)
+        return self._acquire().__await__()
+
+    async def __aenter__(self):
+        return await self._acquire()
+
+    async def __aexit__(self, *exc):
+        await self._pool.pool.release(self._connection)
+
+class InstrumentedPool:
+    """
+    Обертка над пулом asyncpg для бенчмарков.
+
+    Считает обращения к серверу и время ожидания свободного соединения.
+    Устанавливается вместо db._pool после инициализации базы.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.round_trips = 0
+        self.acquires = 0
+        self.acquire_waits: List[float] = []
+
+    def acquire(self, *, timeout=None):
+        return _AcquireContext(self, timeout)
+
+    async def release(self, connection, **kwargs):
+        if isinstance(connection, CountingConnection):
+            connection = connection._connection
+        await self.pool.release(connection, **kwargs)
+
+    def record_acquire(self, wait_seconds: float) -> None:
+        self.acquires += 1
+        self.acquire_waits.append(wait_seconds)
+
+    def reset(self) -> None:
+        self.round_trips = 0
+        self.acquires = 0
+        self.acquire_waits = []
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+async def instrument_db_pool():
+    """Подменить пул db.py на инструментированный и вернуть его."""
+    import db
+    pool = await db.get_pool()
+    if not isinstance(pool, InstrumentedPool):
+        pool = InstrumentedPool(pool)
+        db._pool = pool
+        # Запросы db.py берут соединения через супервизор пула
+        db.pool_supervisor.pool = pool
+    return pool
+
+def percentile(values: List[float], p: float) -> float:
+    """Перцентиль по методу ближайшего ранга (p от 0 до 100)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def latency_summary(values_seconds: List[float]) -> Dict[str, float]:
+    """Сводка задержек в миллисекундах."""
+    ms = [v * 1000 for v in values_seconds]
+    return {
+        "count": len(ms),
+        "mean_ms": round(sum(ms) / len(ms), 2) if ms else 0.0,
+        "p50_ms": round(percentile(ms, 50), 2),
+        "p95_ms": round(percentile(ms, 95), 2),
+        "p99_ms": round(percentile(ms, 99), 2),
+        "max_ms": round(max(ms), 2) if ms else 0.0,
+    }
+
+def peak_memory_mb() -> Optional[float]:
+    """Пиковое потребление памяти процессом (RSS) в МБ."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux возвращает килобайты, macOS - байты
+    if sys.platform == "darwin":
+        return round(peak / (1024 * 1024), 2)
+    return round(peak / 1024, 2)
+
+def git_revision() -> Optional[str]:
+    """Текущий коммит репозитория (для сравнения отчетов между коммитами)."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+def report_metadata() -> Dict[str, Any]:
+    """Общие поля отчета: коммит, время запуска, окружение."""
+    return {
+        "commit": git_revision(),
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+    }
+
+def write_report(report: Dict[str, Any], path: Optional[str]) -> None:
+    """Вывести отчет и при необходимости сохранить его в JSON-файл."""
+    text = json.dumps(report, ensure_ascii=False, indent=2, default=str)
+    print(text)
+    if path:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
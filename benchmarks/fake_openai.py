@@ -0,0 +1,113 @@
+"""
+Локальная заглушка OpenAI Images API (POST /v1/images/edits).
+
+Имитирует задержку генерации, долю ошибок и размер ответа, чтобы нагрузочные
+тесты не тратили деньги на реальные запросы.
+
+Самостоятельный запуск:
+    python -m benchmarks.fake_openai --port 8081 --latency 2.0 --error-rate 0.05
+"""
+import os
+import zlib
+import math
+import base64
+import random
+import struct
+import asyncio
+import argparse
+import logging
+from typing import Dict, Optional
+
+from aiohttp import web
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+def make_png(width: int, height: int) -> bytes:
+    """Создать корректный PNG со случайным (несжимаемым) содержимым."""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (struct.pack(">I", len(data)) + kind + data
+                + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF))
+
+    row_size = width * 3
+    raw = b"".join(b"\x00" + os.urandom(row_size) for _ in range(height))
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b""))
+
+class FakeOpenAI:
+    """
+    Заглушка эндпоинта /v1/images/edits.
+
+    Args:
+        latency: Средняя задержка ответа (в секундах)
+        jitter: Разброс задержки (стандартное отклонение, в секундах)
+        error_rate: Доля запросов, завершающихся ошибкой 500/429
+        payload_kb: Примерный размер возвращаемого PNG (в килобайтах)
+    """
+
+    def __init__(self, latency: float = 2.0, jitter: float = 0.5,
+                 error_rate: float = 0.0, payload_kb: int = 1500):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        side = max(8, int(math.sqrt(payload_kb * 1024 / 3)))
+        self.payload_b64 = base64.b64encode(make_png(side, side)).decode("ascii")
+        self.stats: Dict[str, int] = {"requests": 0, "errors": 0, "bytes_received": 0}
+        self._runner: Optional[web.AppRunner] = None
+
+    async def handle_edit(self, request: web.Request) -> web.Response:
+        """Обработать запрос редактирования изображения."""
+        self.stats["requests"] += 1
+        # Полностью вычитываем multipart-форму, как это сделал бы реальный сервер
+        body = await request.read()
+        self.stats["bytes_received"] += len(body)
+
+        delay = max(0.0, random.gauss(self.latency, self.jitter))
+        await asyncio.sleep(delay)
+
+        if random.random() < self.error_rate:
+            self.stats["errors"] += 1
+            status = random.choice([429, 500])
+            return web.json_response({"error": {"message": "fake error", "type": "server_error"}}, status=status)
+
+        return web.json_response({"created": 0, "data": [{"b64_json": self.payload_b64}]})
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_post("/v1/images/edits", self.handle_edit)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запустить сервер и вернуть базовый URL (аналог https://api.openai.com/v1)."""
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        actual_port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{actual_port}/v1"
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+async def _serve(args) -> None:
+    server = FakeOpenAI(args.latency, args.jitter, args.error_rate, args.payload_kb)
+    url = await server.start(args.host, args.port)
+    print(f"Заглушка OpenAI запущена: OPENAI_BASE_URL={url}")
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await server.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальная заглушка OpenAI Images API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=2.0, help="Средняя задержка, сек.")
+    parser.add_argument("--jitter", type=float, default=0.5, help="Разброс задержки, сек.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ошибок 0..1")
+    parser.add_argument("--payload-kb", type=int, default=1500, help="Размер PNG в ответе, КБ")
+    asyncio.run(_serve(parser.parse_args()))
@@ -0,0 +1,177 @@
+"""
+Локальная заглушка Telegram Bot API.
+
+Отвечает на методы, которые использует бот (sendMessage, editMessageText,
+sendPhoto, sendMediaGroup, getFile и т.д.), отдает файлы фотографий и
+записывает все вызовы, чтобы нагрузочный тест мог измерить задержку
+доставки результатов.
+
+Самостоятельный запуск:
+    python -m benchmarks.fake_telegram --port 8082
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import logging
+from collections import Counter
+from typing import Any, Callable, Dict, Optional
+
+from aiohttp import web
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+BOT_USER = {
+    "id": 1000000001,
+    "is_bot": True,
+    "first_name": "Bench",
+    "username": "bench_bot",
+    "can_join_groups": True,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False,
+}
+
+class FakeTelegram:
+    """
+    Заглушка Bot API.
+
+    Args:
+        latency: Задержка ответа на каждый вызов (в секундах)
+        photo_kb: Размер файла фотографии, отдаваемого по getFile (в килобайтах)
+        on_call: Функция (method, params, timestamp), вызываемая на каждый запрос
+    """
+
+    def __init__(self, latency: float = 0.02, photo_kb: int = 200,
+                 on_call: Optional[Callable[[str, Dict[str, Any], float], None]] = None):
+        self.latency = latency
+        self.photo_bytes = os.urandom(photo_kb * 1024)
+        self.on_call = on_call
+        self.calls: Counter = Counter()
+        self.bytes_received = 0
+        self._message_id = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    def _next_message(self, chat_id: Any, **fields) -> Dict[str, Any]:
+        """Сформировать объект Message для ответа."""
+        self._message_id += 1
+        chat_id = int(chat_id) if chat_id is not None else 0
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {k: BOT_USER[k] for k in ("id", "is_bot", "first_name", "username")},
+            **fields,
+        }
+
+    async def _read_params(self, request: web.Request) -> Dict[str, Any]:
+        """Прочитать параметры вызова (JSON, form-urlencoded или multipart)."""
+        if request.content_type == "application/json":
+            body = await request.read()
+            self.bytes_received += len(body)
+            return json.loads(body or b"{}")
+
+        params: Dict[str, Any] = {}
+        form = await request.post()
+        for key, value in form.items():
+            if hasattr(value, "file"):
+                data = value.file.read()
+                self.bytes_received += len(data)
+                params[key] = f"<file {len(data)} bytes>"
+            else:
+                self.bytes_received += len(value)
+                params[key] = value
+        return params
+
+    def _result(self, method: str, params: Dict[str, Any]) -> Any:
+        """Сформировать результат вызова метода."""
+        chat_id = params.get("chat_id")
+        if method == "getMe":
+            return BOT_USER
+        if method in ("sendMessage", "editMessageText"):
+            return self._next_message(chat_id, text=params.get("text", ""))
+        if method == "sendPhoto":
+            photo = [{"file_id": "result", "file_unique_id": "result", "width": 1024, "height": 1536}]
+            return self._next_message(chat_id, photo=photo, caption=params.get("caption"))
+        if method == "sendDocument":
+            document = {"file_id": "doc", "file_unique_id": "doc", "file_name": "image.png"}
+            return self._next_message(chat_id, document=document)
+        if method == "sendMediaGroup":
+            media = params.get("media")
+            if isinstance(media, str):
+                media = json.loads(media)
+            return [
+                self._next_message(chat_id, photo=[{"file_id": "m", "file_unique_id": "m", "width": 1, "height": 1}])
+                for _ in (media or [None])
+            ]
+        if method == "sendInvoice":
+            return self._next_message(chat_id, text="invoice")
+        if method == "getFile":
+            file_id = params.get("file_id", "photo")
+            return {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_size": len(self.photo_bytes),
+                "file_path": f"photos/{file_id}.jpg",
+            }
+        if method == "getWebhookInfo":
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        if method == "getUpdates":
+            return []
+        # deleteMessage, answerCallbackQuery, answerPreCheckoutQuery и прочие
+        return True
+
+    async def handle_method(self, request: web.Request) -> web.Response:
+        """Обработать вызов метода Bot API."""
+        method = request.match_info["method"]
+        params = await self._read_params(request)
+        self.calls[method] += 1
+        if self.on_call:
+            self.on_call(method, params, time.monotonic())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    async def handle_file(self, request: web.Request) -> web.Response:
+        """Отдать содержимое файла по file_path."""
+        self.calls["file_download"] += 1
+        return web.Response(body=self.photo_bytes, content_type="image/jpeg")
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=100 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.handle_file)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запустить сервер и вернуть базовый URL (аналог https://api.telegram.org)."""
+        self._runner = web.AppRunner(self.make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        actual_port = site._server.sockets[0].getsockname()[1]
+        return f"http://{host}:{actual_port}"
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+async def _serve(args) -> None:
+    server = FakeTelegram(args.latency, args.photo_kb)
+    url = await server.start(args.host, args.port)
+    print(f"Заглушка Telegram Bot API запущена: TELEGRAM_API_BASE={url}")
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await server.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальная заглушка Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=0.02, help="Задержка ответа, сек.")
+    parser.add_argument("--photo-kb", type=int, default=200, help="Размер фото для getFile, КБ")
+    asyncio.run(_serve(parser.parse_args()))
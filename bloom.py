@@ -0,0 +1,92 @@
+"""
+Фильтр Блума для быстрого ответа "пользователь точно не зарегистрирован".
+
+Фильтр не дает ложноотрицательных ответов: если ID не найден, его точно нет
+среди добавленных. Положительный ответ означает "возможно есть" и проверяется
+запросом к БД. Доля таких напрасных проверок (false positive) считается и
+отдается в метриках вместе с занимаемой памятью.
+"""
+import math
+import hashlib
+from typing import Iterable
+
+class BloomFilter:
+    """
+    Фильтр Блума по целочисленным ID на битовом массиве bytearray.
+
+    Args:
+        capacity: Ожидаемое количество элементов
+        error_rate: Целевая доля ложноположительных ответов при capacity элементах
+    """
+
+    __slots__ = ("capacity", "error_rate", "size", "hashes", "bits", "count",
+                 "false_positives", "true_negatives")
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        # Оптимальные размер массива и число хешей для заданной вероятности ошибки
+        self.size = max(8, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self.false_positives = 0
+        self.true_negatives = 0
+
+    def _positions(self, item: int):
+        # Двойное хеширование: k позиций из двух независимых 64-битных хешей
+        digest = hashlib.blake2b(item.to_bytes(8, "little", signed=True), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, item: int) -> None:
+        """Добавить ID в фильтр."""
+        added = False
+        for position in self._positions(item):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                added = True
+        # Повторное добавление не меняет битов и не увеличивает счетчик (ID, все биты
+        # которого уже были выставлены, тоже не учитывается - счетчик слегка занижен)
+        if added:
+            self.count += 1
+
+    def update(self, items: Iterable[int]) -> None:
+        for item in items:
+            self.add(item)
+
+    def __contains__(self, item: int) -> bool:
+        for position in self._positions(item):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                self.true_negatives += 1
+                return False
+        return True
+
+    def record_false_positive(self) -> None:
+        """Отметить, что положительный ответ фильтра не подтвердился в БД."""
+        self.false_positives += 1
+
+    @property
+    def overfilled(self) -> bool:
+        """Элементов больше расчетного - доля ошибок растет, фильтр пора пересобрать."""
+        return self.count > self.capacity
+
+    def estimated_error_rate(self) -> float:
+        """Теоретическая доля ложноположительных ответов при текущем заполнении."""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+    def get_stats(self) -> dict:
+        checked = self.false_positives + self.true_negatives
+        return {
+            "items": self.count,
+            "capacity": self.capacity,
+            "hashes": self.hashes,
+            "memory_bytes": len(self.bits),
+            "estimated_fp_rate": round(self.estimated_error_rate(), 5),
+            "observed_fp_rate": round(self.false_positives / checked, 5) if checked else None,
+            "false_positives": self.false_positives,
+            "true_negatives": self.true_negatives,
+        }
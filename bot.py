@@ -6,20 +6,33 @@ import sys
 import json
 from datetime import datetime
 import os
-import glob
 import time
-import shutil
 import asyncio
 import asyncpg
+import uuid
 from datetime import datetime
 from io import BytesIO
 # Импортируем функции и переменные из модуля db
-from db import PG_CONNECTION_STRING, init_db, get_user_balance, update_user_balance, create_user, check_balance_sufficient, get_user
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice, InputMediaPhoto
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, PreCheckoutQueryHandler
+from db import PG_CONNECTION_STRING, init_db, get_user_balance, update_user_balance, create_user, check_balance_sufficient, get_user, user_exists
+from db import cache_stats as db_cache_stats, single_flight_stats as db_single_flight_stats, get_user_bloom_stats
+from db import get_pool_stats, get_balance_index_stats, InsufficientBalance
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LabeledPrice, InputMediaPhoto, InputMediaDocument
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackQueryHandler, PreCheckoutQueryHandler, TypeHandler
 from telegram.error import Forbidden, BadRequest
 from openai import OpenAI
 from openai import OpenAIError
+from rate_limit import admission, admission_control, GLOBAL_CONCURRENCY
+from media_groups import MediaGroupCollector
+from status_ticker import status_ticker
+from send_queue import outbound, PRIORITY_RESULT, PRIORITY_MESSAGE, PRIORITY_STATUS
+from image_output import prepare_for_delivery, store_originals, get_originals
+import image_output
+from traffic_capture import traffic_recorder
+from stats import stats_collector, build_report as build_stats_report
+from ledger import balance_ledger
+from temp_files import temp_files, TEMP_DIR
+from backup import backup_engine, BACKUP_INTERVAL
+from shutdown import shutdown, SHUTDOWN_STEP_TIMEOUT
 
 async def safe_send(awaitable):
     try: 
@@ -35,9 +48,28 @@ async def safe_edit(awaitable):
             return None
         raise
 
-# Создаем директории для временных файлов
-TEMP_DIR = "images/temp"
-os.makedirs(TEMP_DIR, exist_ok=True)
+async def scheduled_send(chat_id, factory, priority=PRIORITY_MESSAGE):
+    """Отправить запрос через очередь исходящих с учетом флуд-лимитов Telegram."""
+    return await safe_send(outbound.submit(factory, chat_id, priority))
+
+# Сколько ждать применения платежа, чтобы показать новый баланс (в секундах)
+PAYMENT_APPLY_WAIT = 3
+
+async def credit_stars(user_id, amount, key, operation, wait=0):
+    """
+    Изменить баланс через журнал начислений: однократно по ключу и с гарантией применения.
+
+    Args:
+        key: Ключ идемпотентности (ID платежа Telegram, ID задачи генерации)
+        wait: Сколько секунд ждать применения; 0 - не ждать
+
+    Returns:
+        Tuple[bool, Optional[int]]: Новая ли запись (False - ключ уже был в журнале) и новый
+            баланс, если запись применилась за wait секунд, иначе None
+    """
+    if wait:
+        return await balance_ledger.submit_and_wait(key, user_id, amount, operation, wait)
+    return await balance_ledger.submit(key, user_id, amount, operation), None
 
 # Configure logging
 logging.basicConfig(
@@ -57,6 +89,10 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 BOT_USERNAME = os.getenv("BOT_USERNAME")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+# Адреса API (переопределяются для локальных заглушек в бенчмарках)
+OPENAI_API_BASE = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org").rstrip("/")
+
 # Проверка наличия необходимых переменных окружения
 if not TELEGRAM_TOKEN or not OPENAI_API_KEY:
     print("ОШИБКА: Не найдены необходимые переменные окружения TELEGRAM_TOKEN или OPENAI_API_KEY")
@@ -69,6 +105,9 @@ print(f"TELEGRAM_TOKEN: {'***' + TELEGRAM_TOKEN[-4:] if TELEGRAM_TOKEN else 'Н
 print(f"BOT_USERNAME: {BOT_USERNAME if BOT_USERNAME else 'Не установлен'}")
 print(f"OPENAI_API_KEY: {'***' + OPENAI_API_KEY[-4:] if OPENAI_API_KEY else 'Не установлен'}")
 
+# Администраторы, которым доступна команда /stats (ID через запятую)
+ADMIN_USER_IDS = {int(x) for x in os.getenv("ADMIN_USER_IDS", "").replace(" ", "").split(",") if x.isdigit()}
+
 # Constants for balance system
 INITIAL_BALANCE = 20  # Stars (увеличено для стартового баланса)
 GENERATION_COST = 100  # Stars per generation (увеличено в 4 раза)
@@ -82,6 +121,20 @@ STARS_PACKAGES = [
     {"stars": 2000, "price": 2000, "label": "20 фото"}
 ]
 
+# Style display names for messages
+STYLE_DISPLAY_NAMES = {
+    "ghibli": "Ghibli (Аниме)",
+    "disney": "Disney",
+    "pixar": "Pixar",
+    "zootopia": "Zootopia",
+    "lego": "Lego",
+    "minecraft": "Minecraft",
+    "blythe": "Кукла Блайз",
+    "simpsons": "Симпсоны",
+    "toy": "Игрушка",
+    "custom": "Свой стиль"
+}
+
 # Импортируем асинхронные функции для работы с PostgreSQL
 from db import (
     init_db,
@@ -136,52 +189,6 @@ async def async_remove_file(file_path):
         logger.warning(f"Не удалось удалить файл {file_path}: {e}")
         return False
 
-def backup_db():
-    """Create a backup of the database."""
-    try:
-        # Получаем путь к базе данных
-        db_dir = os.path.dirname(os.path.abspath(__file__))  # Всегда используем директорию с ботом
-        db_path = os.path.join(db_dir, 'users.db')
-        
-        # Создаем директорию для резервных копий
-        backup_dir = os.path.join(db_dir, 'backups')
-        os.makedirs(backup_dir, exist_ok=True)
-        
-        # Создаем имя файла с текущей датой
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        backup_path = os.path.join(backup_dir, f'users_backup_{timestamp}.db')
-        
-        # Проверяем, существует ли исходная база данных
-        if os.path.exists(db_path):
-            # Копируем базу данных
-            shutil.copy2(db_path, backup_path)
-            logger.info(f"Создана резервная копия базы данных: {backup_path}")
-            
-            # Также создаем постоянную резервную копию
-            permanent_backup_path = os.path.join(backup_dir, 'users_permanent_backup.db')
-            shutil.copy2(db_path, permanent_backup_path)
-            logger.info(f"Создана постоянная резервная копия базы данных: {permanent_backup_path}")
-            
-            # Удаляем старые резервные копии (оставляем только 5 последних)
-            backup_files = sorted(glob.glob(os.path.join(backup_dir, 'users_backup_*.db')))
-            if len(backup_files) > 5:
-                for old_backup in backup_files[:-5]:
-                    os.remove(old_backup)
-                    logger.info(f"Удалена старая резервная копия: {old_backup}")
-            
-            return True
-        else:
-            logger.warning(f"Не удалось создать резервную копию: файл базы данных не найден: {db_path}")
-            return False
-    except Exception as e:
-        logger.error(f"Ошибка при создании резервной копии базы данных: {e}")
-        return False
-
-def restore_db_from_backup():
-    """Эта функция больше не используется с PostgreSQL. Оставлена для совместимости."""
-    logger.info("Функция восстановления базы данных не требуется для PostgreSQL")
-    return True
-
 # Initialize OpenAI client
 client = OpenAI(api_key=OPENAI_API_KEY)
 
@@ -191,59 +198,81 @@ import aiohttp
 # Фоновая задача для генерации и отправки изображения
 async def generate_and_send_image(chat_id, image_data, prompt, context, user_id, style_name):
     """Фоновая задача для генерации и отправки изображения без блокировки основного потока"""
+    status = None
+    status_job = None
+    # Идентификатор задачи - ключ возврата звезд в журнале начислений
+    job_id = uuid.uuid4().hex
+    delivered = False
     try:
         # Отправляем статусное сообщение
-        status = await context.bot.send_message(chat_id, f"⏳ Генерирую ваше изображение в стиле {style_name}…")
-        
-        # Запускаем периодическое обновление статуса
-        status_task = asyncio.create_task(
-            update_status_periodically(context.bot, chat_id, status.message_id)
+        status = await outbound.submit(
+            lambda: context.bot.send_message(chat_id, f"⏳ Генерирую ваше изображение в стиле {style_name}…"),
+            chat_id, PRIORITY_MESSAGE
         )
         
+        # Регистрируем статусное сообщение в общем тикере обновлений
+        status_job = status_ticker.register(context.bot, chat_id, status.message_id)
+        
         # Генерируем изображение
+        generation_started = time.monotonic()
         output = await asyncio.wait_for(async_openai_edit_image(image_data, prompt), timeout=90)
+        stats_collector.record_generation(style_name, True, (time.monotonic() - generation_started) * 1000)
         
-        # Отменяем задачу обновления статуса
-        status_task.cancel()
+        # Прекращаем обновление статуса
+        status_ticker.unregister(status_job)
         
         # Звезды уже были списаны в функции process_photo, повторное списание не нужно
         current_balance = await get_user_balance(user_id)
         
-        # Создаем кнопки для добавления после генерации - строго 3 кнопки
-        keyboard = [
-            [InlineKeyboardButton("Сгенерировать еще", callback_data="generate_new")],
-            [InlineKeyboardButton("Купить звезды", callback_data="topup_balance")],
-            [InlineKeyboardButton("Главное меню", callback_data="back_to_menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        # Перекодируем результат для быстрой отправки, оригинал сохраняем для скачивания
+        photo, filename = await prepare_for_delivery(output)
+        originals_token = store_originals([output])
+        
+        # Создаем кнопки для добавления после генерации
+        reply_markup = create_result_menu(originals_token)
         
-        # Отправляем фото
-        await context.bot.send_photo(
+        # Отправляем фото в приоритетной очереди, раньше обновлений статусов
+        await scheduled_send(chat_id, lambda: context.bot.send_photo(
             chat_id=chat_id,
-            photo=output,
+            photo=photo,
+            filename=filename,
             caption=f"Ваше изображение в стиле {style_name}! 🌟\n\nСписано: ⭐ {GENERATION_COST} звезд\nТекущий баланс: ⭐ {current_balance} звезд",
             reply_markup=reply_markup
-        )
+        ), PRIORITY_RESULT)
+        delivered = True
         
+    except asyncio.CancelledError:
+        # Бот останавливается, а генерацию не дождались: возвращаем звезды до закрытия журнала
+        if not delivered:
+            await credit_stars(user_id, GENERATION_COST, f"refund:{job_id}", "refund")
+            stats_collector.record_refund(style_name, GENERATION_COST)
+            await scheduled_send(chat_id, lambda: context.bot.send_message(chat_id, "⚠️ Бот перезапускается, генерация прервана. Звезды возвращены, попробуйте еще раз через минуту."))
+        raise
     except asyncio.TimeoutError:
-        await context.bot.send_message(chat_id, "⚠️ Генерация изображения заняла слишком много времени. Пожалуйста, попробуйте еще раз.")
         # Возвращаем звезды в случае неудачи
-        await update_user_balance(user_id, GENERATION_COST)
+        await credit_stars(user_id, GENERATION_COST, f"refund:{job_id}", "refund")
+        stats_collector.record_generation(style_name, False)
+        stats_collector.record_refund(style_name, GENERATION_COST)
+        await scheduled_send(chat_id, lambda: context.bot.send_message(chat_id, "⚠️ Генерация изображения заняла слишком много времени. Пожалуйста, попробуйте еще раз."))
     except Exception as e:
         logger.error(f"Ошибка при генерации изображения: {e}")
-        await context.bot.send_message(chat_id, f"❌ Ошибка при генерации изображения. Попробуйте еще раз.")
         # Возвращаем звезды в случае неудачи
-        await update_user_balance(user_id, GENERATION_COST)
+        await credit_stars(user_id, GENERATION_COST, f"refund:{job_id}", "refund")
+        stats_collector.record_generation(style_name, False)
+        stats_collector.record_refund(style_name, GENERATION_COST)
+        await scheduled_send(chat_id, lambda: context.bot.send_message(chat_id, f"❌ Ошибка при генерации изображения. Попробуйте еще раз."))
     finally:
+        status_ticker.unregister(status_job)
         # Удаляем статусное сообщение
-        try: 
-            await context.bot.delete_message(chat_id, status.message_id)
-        except Exception as msg_error:
-            logger.warning(f"Не удалось удалить статусное сообщение: {msg_error}")
+        if status:
+            try: 
+                await outbound.submit(lambda: context.bot.delete_message(chat_id, status.message_id), chat_id, PRIORITY_STATUS, idempotent=True)
+            except Exception as msg_error:
+                logger.warning(f"Не удалось удалить статусное сообщение: {msg_error}")
 
 async def async_openai_edit_image(image_data: bytes, prompt: str) -> bytes:
     """Асинхронный HTTP-запрос к OpenAI Images API через aiohttp."""
-    url = "https://api.openai.com/v1/images/edits"
+    url = f"{OPENAI_API_BASE}/images/edits"
     headers = {"Authorization": f"Bearer {OPENAI_API_KEY}"}
     
     # Создаем FormData для отправки файлов и параметров
@@ -264,7 +293,8 @@ async def async_openai_edit_image(image_data: bytes, prompt: str) -> bytes:
                 resp.raise_for_status()
                 obj = await resp.json()
                 b64 = obj["data"][0]["b64_json"]
-                return base64.b64decode(b64)
+                # Декодируем в пуле потоков, чтобы не блокировать цикл событий
+                return await async_decode_base64(b64)
     except aiohttp.ClientError as e:
         logger.error(f"Ошибка HTTP при обращении к OpenAI API: {e}")
         raise Exception(f"Ошибка OpenAI API: {str(e)}")
@@ -272,44 +302,6 @@ async def async_openai_edit_image(image_data: bytes, prompt: str) -> bytes:
         logger.error(f"Ошибка при генерации изображения: {e}")
         raise
 
-# Функция для периодического обновления статуса генерации изображения
-async def update_status_periodically(bot, chat_id, message_id, interval=15):
-    """Периодически обновляет статусное сообщение во время генерации."""
-    status_emojis = ["⏱", "⏲", "⏳", "⌛"]
-    status_texts = [
-        "Генерирую изображение... Это может занять несколько секунд.",
-        "Искусственный интеллект творит изображение...",
-        "Добавляю штрихи в стиле... Почти готово!",
-        "Завершаю работу над изображением..."
-    ]
-    
-    # Бесконечный цикл обновления, пока задача не будет отменена
-    i = 0
-    try:
-        while True:
-            # Сначала делаем задержку перед обновлением
-            await asyncio.sleep(interval)  # Обновляем статус каждые 15 секунд
-            
-            status_emoji = status_emojis[i % len(status_emojis)]
-            status_text = status_texts[i % len(status_texts)]
-            
-            try:
-                # Используем safe_edit вместо прямого вызова
-                await safe_edit(bot.edit_message_text(
-                    chat_id=chat_id,
-                    message_id=message_id,
-                    text=f"{status_emoji} {status_text}"
-                ))
-            except Exception as e:
-                logger.warning(f"Не удалось обновить статус: {e}")
-            
-            i += 1
-    except asyncio.CancelledError:
-        # Задача была отменена, выходим из цикла
-        pass
-    except Exception as e:
-        logger.error(f"Неожиданная ошибка в update_status_periodically: {e}")
-
 # Функция для проверки соединения с OpenAI API
 def test_openai_connection():
     """Test connection to OpenAI API."""
@@ -339,6 +331,18 @@ def create_main_menu():
     ]
     return InlineKeyboardMarkup(keyboard)
 
+def create_result_menu(originals_token=None):
+    """Create the keyboard shown under a generated image."""
+    keyboard = []
+    if originals_token:
+        keyboard.append([InlineKeyboardButton("📥 Скачать в полном качестве", callback_data=f"full_{originals_token}")])
+    keyboard += [
+        [InlineKeyboardButton("Сгенерировать еще", callback_data="generate_new")],
+        [InlineKeyboardButton("Купить звезды", callback_data="topup_balance")],
+        [InlineKeyboardButton("Главное меню", callback_data="back_to_menu")]
+    ]
+    return InlineKeyboardMarkup(keyboard)
+
 def create_topup_menu():
     """Create the topup menu keyboard."""
     keyboard = []
@@ -355,11 +359,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
     user = update.effective_user
     
-    # Create or update user in database
-    await create_user(user.id, user.username, user.first_name, user.last_name)
-    
-    # Get user balance
-    balance = await get_user_balance(user.id)
+    # Create or update user in database (возвращает текущий баланс)
+    balance = await create_user(user.id, user.username, user.first_name, user.last_name)
     
     # Отправляем приветственное сообщение
     welcome_text = (
@@ -482,6 +483,67 @@ async def balance_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         reply_markup=reply_markup
     ))
 
+def format_stats_report(report):
+    """Краткое текстовое представление отчета для администратора."""
+    users = report["users"]
+    generations = report["generations"]
+    latency = report["openai_latency_ms"]
+    revenue = report["revenue"]
+    
+    def ms(value):
+        return f"{value / 1000:.1f} с" if value is not None else "—"
+    
+    lines = [
+        f"📊 Статистика за {report['period_hours']} ч",
+        "",
+        f"👥 Пользователей всего: {users['total_users']}",
+        f"Активных за последний час: {report['active_users']['last_hour']} (пик: {report['active_users']['peak_hour']})",
+        "",
+        f"🎨 Генераций: {generations['total']}, ошибок: {generations['errors']}",
+        f"Доля возвратов: {report['refund_rate'] * 100:.1f}%",
+    ]
+    for style, values in generations["by_style"].items():
+        lines.append(f"  • {style}: {values['generations']} (ошибок {values['errors']})")
+    lines += [
+        "",
+        f"⏱ OpenAI: среднее {ms(latency['mean'])}, p50 ≤ {ms(latency['p50'])}, p95 ≤ {ms(latency['p95'])}, p99 ≤ {ms(latency['p99'])}",
+        "",
+        f"⭐ Выручка: {revenue['stars']:.0f} звезд",
+    ]
+    for stars, values in revenue["by_package"].items():
+        lines.append(f"  • пакет {stars}: {values['payments']} оплат, {values['stars']} звезд")
+    lines.append(f"\nОбновлено: {report['generated_at']}")
+    return "\n".join(lines)
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Admin-only operator view: /stats [hours] [json]."""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        return
+    
+    hours = 24
+    export_json = False
+    for arg in context.args or []:
+        if arg.isdigit():
+            hours = max(1, min(int(arg), 24 * 31))
+        elif arg.lower() == "json":
+            export_json = True
+    
+    try:
+        report = await build_stats_report(hours)
+    except Exception as e:
+        logger.error(f"Ошибка при построении отчета статистики: {e}")
+        await safe_send(update.message.reply_text("❌ Не удалось получить статистику."))
+        return
+    
+    if export_json:
+        data = json.dumps(report, ensure_ascii=False, indent=2, default=str).encode("utf-8")
+        await safe_send(update.message.reply_document(
+            document=BytesIO(data),
+            filename=f"stats_{hours}h_{datetime.now():%Y%m%d_%H%M}.json"
+        ))
+    else:
+        await safe_send(update.message.reply_text(format_stats_report(report)))
+
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle button presses."""
     query = update.callback_query
@@ -825,6 +887,31 @@ async def handle_button_logic(query, context: ContextTypes.DEFAULT_TYPE) -> None
                 reply_markup=reply_markup
             ))
     
+    elif query.data.startswith("full_"):
+        # Отправляем оригиналы сгенерированных изображений без сжатия
+        originals = get_originals(query.data[len("full_"):])
+        chat_id = query.message.chat_id
+        
+        if not originals:
+            await scheduled_send(chat_id, lambda: context.bot.send_message(
+                chat_id=chat_id,
+                text="Оригинал больше недоступен. Оригиналы хранятся в течение часа после генерации."
+            ))
+            return
+        
+        if len(originals) == 1:
+            await scheduled_send(chat_id, lambda: context.bot.send_document(
+                chat_id=chat_id,
+                document=originals[0],
+                filename="image_original.png"
+            ), PRIORITY_RESULT)
+        else:
+            media = [
+                InputMediaDocument(media=original, filename=f"image_original_{i + 1}.png")
+                for i, original in enumerate(originals)
+            ]
+            await scheduled_send(chat_id, lambda: context.bot.send_media_group(chat_id=chat_id, media=media), PRIORITY_RESULT)
+    
     elif query.data == "back_to_menu":
         menu_text = f"Главное меню\n\n"\
                   f"Ваш текущий баланс: ⭐ {balance} звезд\n"\
@@ -885,9 +972,22 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
         logger.info(f"Успешный платеж: user_id={user_id}, stars={stars}, total_amount={payment.total_amount}")
         
         if user_id and stars:
-            # Add stars to user balance
-            await update_user_balance(user_id, stars)
-            new_balance = await get_user_balance(user_id)
+            # Одна запись в журнал начислений; повтор того же платежа не начислит звезды дважды
+            is_new, new_balance = await credit_stars(
+                user_id, stars, f"payment:{payment.telegram_payment_charge_id}", "payment", wait=PAYMENT_APPLY_WAIT
+            )
+            # Повторно доставленный платеж не должен завышать выручку в статистике
+            if is_new:
+                stats_collector.record_payment(stars)
+            
+            if new_balance is None:
+                # Платеж записан в журнал, звезды будут зачислены фоновым обработчиком
+                await update.message.reply_text(
+                    f"✅ Оплата получена!\n\n"
+                    f"⭐ {stars} звезд будут зачислены на баланс в ближайшие минуты.",
+                    reply_markup=create_main_menu()
+                )
+                return
             
             # Send confirmation message
             await update.message.reply_text(
@@ -912,11 +1012,353 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
             reply_markup=create_main_menu()
         )
 
+def build_style_prompt(selected_style, user_data, user_name):
+    """
+    Собрать промпт для OpenAI в зависимости от выбранного стиля.
+    
+    Args:
+        selected_style: Ключ стиля ("ghibli", "toy", "custom" и т.д.)
+        user_data: Сохраненные данные пользователя (context.user_data['user_data'])
+        user_name: Имя для гравировки по умолчанию (для стиля "Игрушка")
+    
+    Returns:
+        str: Текст промпта
+    """
+    if selected_style == "ghibli":
+        prompt = """
+        Transform this person into a Studio Ghibli animation character. 
+        Use Ghibli's distinctive hand-drawn style with soft watercolor backgrounds and warm color palette.
+        Add characteristic Ghibli lighting and atmosphere.
+        Maintain the person's likeness and key features while adapting to Ghibli style.
+        Include some Ghibli-style environment elements that complement the character.
+        """
+    elif selected_style == "disney":
+        prompt = """
+        Transform this person into a Disney 3D animation character.
+        Use vibrant colors, expressive features, and Disney's characteristic lighting style.
+        Add Disney-style magical environment elements.
+        Maintain the person's likeness and key features while adapting to Disney animation style.
+        """
+    elif selected_style == "lego":
+        prompt = """
+        Transform this person into a LEGO minifigure.
+        Use authentic LEGO minifigure appearance with plastic toy aesthetic.
+        Add characteristic LEGO shapes and bright LEGO colors palette.
+        Include a LEGO brick background/environment.
+        Maintain the person's distinguishing features translated to LEGO style.
+        """
+    elif selected_style == "simpsons":
+        prompt = """
+        Transform this person into a Simpsons character.
+        Use classic Simpsons yellow skin and distinctive art style.
+        Add Simpsons character proportions with overbite and four fingers per hand.
+        Include typical Simpsons background elements.
+        Maintain the person's distinguishing features adapted to Simpsons style.
+        """
+    elif selected_style == "toy":
+        # Проверяем, есть ли аксессуары в данных пользователя
+        accessories = ""
+        
+        if 'accessories' in user_data:
+            accessories = user_data['accessories']
+        if 'custom_name' in user_data:
+            user_name = user_data['custom_name']
+        
+        prompt = f"""
+        Основное:
+        Это 3D-кукла в стиле Bratz, из soft touch пластика.
+        Персонаж — во весь рост, повторяет внешность с первого фото.
+        Копируй каждую деталь: прическу, губы, глаза, черты и пропорции лица. Одежда — с акцентом на стиль и текстуры.
+        Кукла лежит в пластиковом углублении, которое повторяет её силуэт.
+
+        Упаковка:
+        Стиль коробки современный.
+        Коробка: прозрачный пластик спереди, картон сзади.
+        Вверху коробки должно быть написано имя персонажа
+        {user_name} — буквы впечатаны и выгравированы на коробке
+
+        Аксессуары внутри коробки:
+        Разложены рядом с куклой по своим местам в отдельных ячейках: {accessories if accessories else 'стильные аксессуары и модные предметы'}
+        Аксессуары — максимально фотореалистичные и детализированные мини-версии.
+        Ключ: стиль, визуал и детализация - как у премиальной коллекционной игрушки
+        """
+    elif selected_style == "custom":
+        # Проверяем, есть ли пользовательское описание стиля
+        custom_style_description = "уникальный стиль"
+        
+        if 'custom_style' in user_data:
+            custom_style_description = user_data['custom_style']
+        
+        prompt = f"""
+        Создай художественное изображение этого человека в следующем стиле:
+        {custom_style_description}
+        
+        Сохрани узнаваемость и ключевые черты человека, но адаптируй их к запрошенному стилю.
+        """
+    elif selected_style == "minecraft":
+        prompt = """
+        Transform this person into a Minecraft character.
+        Use characteristic Minecraft voxel/blocky style with pixelated features.
+        Keep consistent with Minecraft's distinct block-based aesthetic.
+        Maintain the person's key features while adapting them to the cube-based Minecraft style.
+        Include some Minecraft environment elements or items in the background.
+        """
+    elif selected_style == "pixar":
+        prompt = """
+        Transform this person into a Pixar animation character.
+        Use Pixar's distinctive 3D animation style with expressive features.
+        Add characteristic Pixar lighting and vibrant colors.
+        Maintain the person's likeness and key features while adapting to Pixar style.
+        Include suitable Pixar-style environment elements in the background.
+        """
+    elif selected_style == "zootopia":
+        prompt = """
+        Transform this person into a Zootopia-style anthropomorphic animal character.
+        Choose an animal that matches their personality and features.
+        Use Zootopia's distinctive animation style with expressive features.
+        Maintain recognizable elements of the person's appearance adapted to animal form.
+        Include Zootopia-style city elements in the background.
+        """
+    elif selected_style == "blythe":
+        prompt = """
+        Transform this person into a Blythe doll.
+        Use characteristic Blythe doll aesthetic with large head and oversized eyes.
+        Add distinctive glossy finish and porcelain-like skin texture.
+        Include pastel or vibrant colors typical for Blythe dolls.
+        Add cute, slightly dreamy expression and Blythe doll fashion elements.
+        """
+    else:
+        # Default to Ghibli if style not recognized
+        prompt = """
+        Transform this person into a Studio Ghibli animation character. 
+        Use Ghibli's distinctive hand-drawn style with soft watercolor backgrounds and warm color palette.
+        Add characteristic Ghibli lighting and atmosphere.
+        Maintain the person's likeness and key features while adapting to Ghibli style.
+        Include some Ghibli-style environment elements that complement the character.
+        """
+    
+    
+    return prompt
+
+# Сколько изображений альбома генерируется одновременно
+ALBUM_PARALLELISM = int(os.getenv("ALBUM_PARALLELISM", "3"))
+
+async def process_album(media_group_id, items):
+    """Process a multi-photo album as one job: one balance check and one debit."""
+    # Альбом обрабатывается вне обработчиков, поэтому встает в очередь обновлений пользователя сам
+    async with admission.user_turn(items[0][0]) as admitted:
+        if admitted:
+            await _process_album(media_group_id, items)
+
+async def _process_album(media_group_id, items):
+    update, context = items[0]
+    user_id = update.effective_user.id
+    chat_id = update.effective_chat.id
+    charged = None
+    
+    try:
+        # Проверяем, на сколько фотографий альбома хватает баланса
+        balance = await get_user_balance(user_id)
+        affordable = min(len(items), balance // GENERATION_COST)
+        
+        if affordable <= 0:
+            await safe_send(update.message.reply_text(
+                f"У вас недостаточно звезд для генерации изображения.\n"
+                f"Текущий баланс: ⭐ {balance} звезд\n"
+                f"Стоимость одной генерации: ⭐ {GENERATION_COST} звезд\n"
+            ))
+            return
+        
+        if 'user_data' not in context.user_data:
+            context.user_data['user_data'] = {}
+        user_data = context.user_data['user_data']
+        selected_style = user_data.get('selected_style', "ghibli")
+        
+        # Подпись альбома приходит только с одной из фотографий
+        caption_text = next((u.message.caption for u, _ in items if u.message.caption), None)
+        if caption_text:
+            if selected_style == "toy":
+                user_data['accessories'] = caption_text
+            elif selected_style == "custom":
+                user_data['custom_style'] = caption_text
+        
+        # Для своего стиля нужно описание - если его нет, просим прислать
+        if selected_style == "custom" and 'custom_style' not in user_data:
+            user_data['waiting_for_custom_style'] = True
+            await safe_send(update.message.reply_text(
+                "Пожалуйста, опишите желаемый стиль в текстовом сообщении."
+            ))
+            return
+        
+        style_name = STYLE_DISPLAY_NAMES.get(selected_style, "выбранном стиле")
+        prompt = build_style_prompt(selected_style, user_data, update.effective_user.first_name)
+        
+        skipped = len(items) - affordable
+        items = items[:affordable]
+        
+        # Загружаем все фотографии альбома параллельно
+        async def download_photo(photo_update):
+            photo_file = await context.bot.get_file(photo_update.message.photo[-1].file_id)
+            return bytes(await photo_file.download_as_bytearray())
+        
+        images = await asyncio.gather(*(download_photo(u) for u, _ in items))
+        
+        # Одно списание на весь альбом (будет частично возвращено при ошибках)
+        try:
+            charged = await update_user_balance(user_id, -GENERATION_COST * len(images))
+        except InsufficientBalance:
+            # Баланс успел уменьшиться после проверки (параллельная генерация)
+            await safe_send(context.bot.send_message(
+                chat_id,
+                f"У вас недостаточно звезд для генерации {len(images)} изображений.\n"
+                f"Текущий баланс: ⭐ {await get_user_balance(user_id)} звезд\n"
+                f"Стоимость одной генерации: ⭐ {GENERATION_COST} звезд\n"
+            ))
+            return
+        if charged is None:
+            await safe_send(context.bot.send_message(chat_id, "⚠️ Сервис временно недоступен. Попробуйте через пару минут."))
+            return
+        logger.info(f"Альбом {media_group_id} пользователя {user_id}: {len(images)} фото в стиле {style_name}")
+        
+        notice = f"Делаю {len(images)} изображений в стиле {style_name}. Я пришлю результат, как только он будет готов! 💫"
+        if skipped:
+            notice += f"\n\nЗвезд хватает только на {len(images)} фото, остальные {skipped} пропущены."
+        await safe_send(context.bot.send_message(chat_id=chat_id, text=notice))
+        
+        shutdown.spawn(
+            generate_and_send_album(chat_id, images, prompt, context, user_id, style_name),
+            f"album:{user_id}:{len(images)}"
+        )
+        charged = None
+    except asyncio.CancelledError:
+        # Бот останавливается после списания, но до запуска генерации
+        if charged is not None:
+            await credit_stars(user_id, GENERATION_COST * len(images), f"refund:album:{media_group_id}", "refund")
+            await safe_send(context.bot.send_message(chat_id, "⚠️ Бот перезапускается, генерация прервана. Звезды возвращены, попробуйте еще раз через минуту."))
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при обработке альбома {media_group_id}: {e}")
+        await safe_send(context.bot.send_message(chat_id, "❌ Ошибка при обработке альбома. Попробуйте еще раз."))
+
+async def generate_and_send_album(chat_id, images, prompt, context, user_id, style_name):
+    """Background task: generate album images with bounded parallelism and send them as one media group."""
+    semaphore = asyncio.Semaphore(ALBUM_PARALLELISM)
+    status = None
+    status_job = None
+    # Сколько генераций уже доставлено или возвращено, чтобы не вернуть звезды дважды
+    settled = 0
+    job_id = uuid.uuid4().hex
+    
+    async def generate_one(image_data):
+        async with semaphore:
+            started = time.monotonic()
+            try:
+                output = await asyncio.wait_for(async_openai_edit_image(image_data, prompt), timeout=90)
+            except BaseException:
+                stats_collector.record_generation(style_name, False)
+                raise
+            stats_collector.record_generation(style_name, True, (time.monotonic() - started) * 1000)
+            return output
+    
+    try:
+        status = await outbound.submit(
+            lambda: context.bot.send_message(chat_id, f"⏳ Генерирую {len(images)} изображений в стиле {style_name}…"),
+            chat_id, PRIORITY_MESSAGE
+        )
+        status_job = status_ticker.register(context.bot, chat_id, status.message_id)
+        
+        results = await asyncio.gather(*(generate_one(image) for image in images), return_exceptions=True)
+        status_ticker.unregister(status_job)
+        outputs = []
+        for result in results:
+            if isinstance(result, BaseException):
+                logger.error(f"Ошибка при генерации изображения альбома: {result!r}")
+            else:
+                outputs.append(result)
+        
+        # Возвращаем звезды за неудачные генерации одной операцией
+        failed = len(images) - len(outputs)
+        if failed:
+            await credit_stars(user_id, GENERATION_COST * failed, f"refund:{job_id}:failed", "refund")
+            stats_collector.record_refund(style_name, GENERATION_COST * failed, failed)
+        settled += failed
+        
+        if not outputs:
+            await scheduled_send(chat_id, lambda: context.bot.send_message(chat_id, "❌ Ошибка при генерации изображений. Звезды возвращены, попробуйте еще раз."))
+            return
+        
+        current_balance = await get_user_balance(user_id)
+        
+        # Перекодируем результаты для быстрой отправки, оригиналы сохраняем для скачивания
+        prepared = await asyncio.gather(*(prepare_for_delivery(output) for output in outputs))
+        originals_token = store_originals(outputs)
+        
+        caption = (
+            f"Ваши изображения в стиле {style_name}! 🌟\n\n"
+            f"Списано: ⭐ {GENERATION_COST * len(outputs)} звезд\n"
+            f"Текущий баланс: ⭐ {current_balance} звезд"
+        )
+        if failed:
+            caption += f"\n\nНе удалось создать {failed} из {len(images)} изображений, звезды за них возвращены."
+        
+        if len(outputs) == 1:
+            await outbound.submit(
+                lambda: context.bot.send_photo(
+                    chat_id=chat_id, photo=prepared[0][0], filename=prepared[0][1],
+                    caption=caption, reply_markup=create_result_menu(originals_token)
+                ),
+                chat_id, PRIORITY_RESULT
+            )
+            settled += len(outputs)
+        else:
+            # Подпись ставим только у первого элемента, клавиатуру к альбому прикрепить нельзя
+            media = [
+                InputMediaPhoto(media=photo, filename=filename, caption=caption if i == 0 else None)
+                for i, (photo, filename) in enumerate(prepared)
+            ]
+            await outbound.submit(lambda: context.bot.send_media_group(chat_id=chat_id, media=media), chat_id, PRIORITY_RESULT)
+            settled += len(outputs)
+            # Изображения уже доставлены: ошибка меню не должна приводить к возврату звезд
+            try:
+                await scheduled_send(chat_id, lambda: context.bot.send_message(chat_id, "Что дальше?", reply_markup=create_result_menu(originals_token)), PRIORITY_RESULT)
+            except Exception as menu_error:
+                logger.warning(f"Не удалось отправить меню после альбома: {menu_error}")
+        
+    except asyncio.CancelledError:
+        # Бот останавливается: возвращаем звезды за все недоставленные изображения
+        if len(images) - settled > 0:
+            await credit_stars(user_id, GENERATION_COST * (len(images) - settled), f"refund:{job_id}:undelivered", "refund")
+            stats_collector.record_refund(style_name, GENERATION_COST * (len(images) - settled), len(images) - settled)
+            await scheduled_send(chat_id, lambda: context.bot.send_message(chat_id, "⚠️ Бот перезапускается, генерация прервана. Звезды возвращены, попробуйте еще раз через минуту."))
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при генерации альбома: {e}")
+        await scheduled_send(chat_id, lambda: context.bot.send_message(chat_id, "❌ Ошибка при генерации изображений. Попробуйте еще раз."))
+        # Возвращаем звезды за все недоставленные изображения
+        if len(images) - settled > 0:
+            await credit_stars(user_id, GENERATION_COST * (len(images) - settled), f"refund:{job_id}:undelivered", "refund")
+            stats_collector.record_refund(style_name, GENERATION_COST * (len(images) - settled), len(images) - settled)
+    finally:
+        status_ticker.unregister(status_job)
+        if status:
+            try:
+                await outbound.submit(lambda: context.bot.delete_message(chat_id, status.message_id), chat_id, PRIORITY_STATUS, idempotent=True)
+            except Exception as msg_error:
+                logger.warning(f"Не удалось удалить статусное сообщение: {msg_error}")
+
+# Коллектор фотографий из альбомов
+album_collector = MediaGroupCollector(process_album)
+
 async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Process a photo and convert it to the selected style."""
     # Декоратор log_processing_time теперь сам измеряет время выполнения
     user_id = update.effective_user.id
     
+    # Фотографии из альбома собираем и обрабатываем одной пакетной задачей
+    if update.message.media_group_id:
+        album_collector.add(update.message.media_group_id, (update, context))
+        return
+    
     # Асинхронная проверка баланса
     is_balance_sufficient = await check_balance_sufficient(user_id)
     
@@ -953,21 +1395,7 @@ async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             context.user_data['user_data']['custom_style'] = caption_text
             logger.info(f"Сохранено описание для своего стиля: {caption_text}")
     
-    # Style display names for messages
-    style_display_names = {
-        "ghibli": "Ghibli (Аниме)",
-        "disney": "Disney",
-        "pixar": "Pixar",
-        "zootopia": "Zootopia",
-        "lego": "Lego",
-        "minecraft": "Minecraft",
-        "blythe": "Кукла Блайз",
-        "simpsons": "Симпсоны",
-        "toy": "Игрушка",
-        "custom": "Свой стиль"
-    }
-    
-    style_name = style_display_names.get(selected_style, "выбранном стиле")
+    style_name = STYLE_DISPLAY_NAMES.get(selected_style, "выбранном стиле")
     
     # Создаем список разнообразных статусных сообщений
     status_messages = [
@@ -984,6 +1412,8 @@ async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     import random
     status_message = await update.message.reply_text(random.choice(status_messages))
     
+    # ID задачи: по нему регистрируются и удаляются ее временные файлы
+    unique_id = None
     try:
         # Get the photo with the highest resolution
         photo = update.message.photo[-1]
@@ -1000,9 +1430,11 @@ async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         from datetime import datetime
         unique_id = f"{update.effective_user.id}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{str(uuid.uuid4())[:8]}"
         file_path = f"{tmp_dir}/{unique_id}.png"
+        temp_files.begin(unique_id)
         
         # Асинхронно сохраняем фото во временный файл
         await async_save_file(file_path, photo_bytes)
+        temp_files.register(file_path, unique_id, size=len(photo_bytes))
         
         logger.info(f"Обработка изображения для пользователя {update.effective_user.id} в стиле {style_name}")
         # Создаем список разнообразных сообщений для фазы создания
@@ -1030,138 +1462,29 @@ async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             text=random.choice(creation_messages)
         )
         
-        # Выбираем промпт в зависимости от выбранного стиля
-        if selected_style == "ghibli":
-            prompt = """
-            Transform this person into a Studio Ghibli animation character. 
-            Use Ghibli's distinctive hand-drawn style with soft watercolor backgrounds and warm color palette.
-            Add characteristic Ghibli lighting and atmosphere.
-            Maintain the person's likeness and key features while adapting to Ghibli style.
-            Include some Ghibli-style environment elements that complement the character.
-            """
-        elif selected_style == "disney":
-            prompt = """
-            Transform this person into a Disney 3D animation character.
-            Use vibrant colors, expressive features, and Disney's characteristic lighting style.
-            Add Disney-style magical environment elements.
-            Maintain the person's likeness and key features while adapting to Disney animation style.
-            """
-        elif selected_style == "lego":
-            prompt = """
-            Transform this person into a LEGO minifigure.
-            Use authentic LEGO minifigure appearance with plastic toy aesthetic.
-            Add characteristic LEGO shapes and bright LEGO colors palette.
-            Include a LEGO brick background/environment.
-            Maintain the person's distinguishing features translated to LEGO style.
-            """
-        elif selected_style == "simpsons":
-            prompt = """
-            Transform this person into a Simpsons character.
-            Use classic Simpsons yellow skin and distinctive art style.
-            Add Simpsons character proportions with overbite and four fingers per hand.
-            Include typical Simpsons background elements.
-            Maintain the person's distinguishing features adapted to Simpsons style.
-            """
-        elif selected_style == "toy":
-            # Проверяем, есть ли аксессуары в данных пользователя
-            accessories = ""
-            user_name = update.effective_user.first_name
-            
-            if 'user_data' in context.user_data:
-                if 'accessories' in context.user_data['user_data']:
-                    accessories = context.user_data['user_data']['accessories']
-                if 'custom_name' in context.user_data['user_data']:
-                    user_name = context.user_data['user_data']['custom_name']
-            
-            prompt = f"""
-            Основное:
-            Это 3D-кукла в стиле Bratz, из soft touch пластика.
-            Персонаж — во весь рост, повторяет внешность с первого фото.
-            Копируй каждую деталь: прическу, губы, глаза, черты и пропорции лица. Одежда — с акцентом на стиль и текстуры.
-            Кукла лежит в пластиковом углублении, которое повторяет её силуэт.
-
-            Упаковка:
-            Стиль коробки современный.
-            Коробка: прозрачный пластик спереди, картон сзади.
-            Вверху коробки должно быть написано имя персонажа
-            {user_name} — буквы впечатаны и выгравированы на коробке
-
-            Аксессуары внутри коробки:
-            Разложены рядом с куклой по своим местам в отдельных ячейках: {accessories if accessories else 'стильные аксессуары и модные предметы'}
-            Аксессуары — максимально фотореалистичные и детализированные мини-версии.
-            Ключ: стиль, визуал и детализация - как у премиальной коллекционной игрушки
-            """
-        elif selected_style == "custom":
-            # Проверяем, есть ли пользовательское описание стиля
-            custom_style_description = "уникальный стиль"
-            
-            if 'user_data' in context.user_data and 'custom_style' in context.user_data['user_data']:
-                custom_style_description = context.user_data['user_data']['custom_style']
-            
-            prompt = f"""
-            Создай художественное изображение этого человека в следующем стиле:
-            {custom_style_description}
+        user_data = context.user_data.get('user_data', {})
+        
+        # Если нет пользовательского описания, отправляем сообщение с просьбой указать стиль
+        if selected_style == "custom" and 'custom_style' not in user_data:
+            await context.bot.edit_message_text(
+                chat_id=update.effective_chat.id,
+                message_id=status_message.message_id,
+                text="Пожалуйста, опишите желаемый стиль в текстовом сообщении."
+            )
             
-            Сохрани узнаваемость и ключевые черты человека, но адаптируй их к запрошенному стилю.
-            """
+            # Сохраняем информацию о том, что пользователь выбрал свой стиль
+            if 'user_data' not in context.user_data:
+                context.user_data['user_data'] = {}
+            context.user_data['user_data']['waiting_for_custom_style'] = True
+            context.user_data['user_data']['photo_file_path'] = file_path
+            # Фото ждет описания стиля: передаем его пользователю, файл удалится по сроку жизни
+            temp_files.register(file_path, f"user:{user_id}", size=len(photo_bytes))
             
-            # Если нет пользовательского описания, отправляем сообщение с просьбой указать стиль
-            if 'user_data' not in context.user_data or 'custom_style' not in context.user_data['user_data']:
-                await context.bot.edit_message_text(
-                    chat_id=update.effective_chat.id,
-                    message_id=status_message.message_id,
-                    text="Пожалуйста, опишите желаемый стиль в текстовом сообщении."
-                )
-                
-                # Сохраняем информацию о том, что пользователь выбрал свой стиль
-                if 'user_data' not in context.user_data:
-                    context.user_data['user_data'] = {}
-                context.user_data['user_data']['waiting_for_custom_style'] = True
-                context.user_data['user_data']['photo_file_path'] = file_path
-                
-                # Выходим из функции, чтобы не генерировать изображение пока
-                return
-        elif selected_style == "minecraft":
-            prompt = """
-            Transform this person into a Minecraft character.
-            Use characteristic Minecraft voxel/blocky style with pixelated features.
-            Keep consistent with Minecraft's distinct block-based aesthetic.
-            Maintain the person's key features while adapting them to the cube-based Minecraft style.
-            Include some Minecraft environment elements or items in the background.
-            """
-        elif selected_style == "pixar":
-            prompt = """
-            Transform this person into a Pixar animation character.
-            Use Pixar's distinctive 3D animation style with expressive features.
-            Add characteristic Pixar lighting and vibrant colors.
-            Maintain the person's likeness and key features while adapting to Pixar style.
-            Include suitable Pixar-style environment elements in the background.
-            """
-        elif selected_style == "zootopia":
-            prompt = """
-            Transform this person into a Zootopia-style anthropomorphic animal character.
-            Choose an animal that matches their personality and features.
-            Use Zootopia's distinctive animation style with expressive features.
-            Maintain recognizable elements of the person's appearance adapted to animal form.
-            Include Zootopia-style city elements in the background.
-            """
-        elif selected_style == "blythe":
-            prompt = """
-            Transform this person into a Blythe doll.
-            Use characteristic Blythe doll aesthetic with large head and oversized eyes.
-            Add distinctive glossy finish and porcelain-like skin texture.
-            Include pastel or vibrant colors typical for Blythe dolls.
-            Add cute, slightly dreamy expression and Blythe doll fashion elements.
-            """
-        else:
-            # Default to Ghibli if style not recognized
-            prompt = """
-            Transform this person into a Studio Ghibli animation character. 
-            Use Ghibli's distinctive hand-drawn style with soft watercolor backgrounds and warm color palette.
-            Add characteristic Ghibli lighting and atmosphere.
-            Maintain the person's likeness and key features while adapting to Ghibli style.
-            Include some Ghibli-style environment elements that complement the character.
-            """
+            # Выходим из функции, чтобы не генерировать изображение пока
+            return
+        
+        # Выбираем промпт в зависимости от выбранного стиля
+        prompt = build_style_prompt(selected_style, user_data, update.effective_user.first_name)
         
         # Подготовим файл изображения для передачи в OpenAI API
         with open(file_path, "rb") as img_file:
@@ -1176,13 +1499,25 @@ async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         except Exception as msg_error:
             logger.warning(f"Не удалось удалить статусное сообщение: {msg_error}")
         
-        # Списываем звёзды сразу (будут возвращены при ошибке)
-        await update_user_balance(user_id, -GENERATION_COST)
+        # Списываем звёзды сразу (будут возвращены при ошибке); списание проверяет баланс
+        # атомарно, поэтому параллельные фото не уведут его в минус
+        try:
+            charged = await update_user_balance(user_id, -GENERATION_COST)
+        except InsufficientBalance:
+            await safe_send(update.message.reply_text(
+                f"У вас недостаточно звезд для генерации изображения.\n"
+                f"Текущий баланс: ⭐ {await get_user_balance(user_id)} звезд\n"
+                f"Стоимость одной генерации: ⭐ {GENERATION_COST} звезд\n"
+            ))
+            return
+        if charged is None:
+            await safe_send(update.message.reply_text("⚠️ Сервис временно недоступен. Попробуйте через пару минут."))
+            return
         context.user_data['was_charged'] = True  # Отмечаем, что списание произошло
         
         # Запускаем фоновую задачу для генерации изображения
-        style_name = style_display_names.get(selected_style, "выбранном стиле")
-        asyncio.create_task(
+        style_name = STYLE_DISPLAY_NAMES.get(selected_style, "выбранном стиле")
+        shutdown.spawn(
             generate_and_send_image(
                 update.effective_chat.id,
                 image_data,
@@ -1190,90 +1525,27 @@ async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
                 context,
                 user_id,
                 style_name
-            )
+            ),
+            f"image:{user_id}"
         )
         
         # Удаляем временный файл
-        try:
-            os.remove(file_path)
-            logger.info(f"Временный файл {file_path} удален")
-        except Exception as file_error:
-            logger.warning(f"Не удалось удалить временный файл {file_path}: {file_error}")
+        await temp_files.remove(file_path)
             
         # Сразу возвращаемся из функции, чтобы не блокировать цикл событий
-        await context.bot.send_message(
+        await scheduled_send(update.effective_chat.id, lambda: context.bot.send_message(
             chat_id=update.effective_chat.id,
             text=f"Делаю ваше изображение в стиле {style_name}. Я пришлю результат, как только он будет готов! 💫"  
-        )
+        ))
         
         # Выходим сразу, не ждем ответа от API
         return
-        
-        # Сохраняем изображение во временный файл для отправки
-        # output_image_data уже содержит декодированные байты изображения
-        generated_file_path = f"{tmp_dir}/generated_{unique_id}.png"
-        with open(generated_file_path, "wb") as f:
-            f.write(output_image_data)
-            
-        logger.info(f"Изображение успешно сгенерировано и сохранено в {generated_file_path}")
-        
-        # Удаляем временный файл изображения, чтобы не занимать дисковое пространство
-        try:
-            os.remove(file_path)
-            logger.info(f"Временный файл {file_path} успешно удален")
-        except Exception as file_error:
-            logger.warning(f"Не удалось удалить временный файл {file_path}: {file_error}")
-        
-        # Звезды уже списаны выше (строка ~1150), повторное списание не требуется
-        current_balance = await get_user_balance(user_id)
-        
-        # Устанавливаем флаг, что баланс был списан - это поможет избежать двойного возврата при ошибке
-        if 'user_data' not in context.user_data:
-            context.user_data['user_data'] = {}
-        context.user_data['was_charged'] = True
-        
-        # Создаем кнопки для добавления после генерации - строго 3 кнопки
-        keyboard = [
-            [InlineKeyboardButton("Сгенерировать еще", callback_data="generate_new")],
-            [InlineKeyboardButton("Купить звезды", callback_data="topup_balance")],
-            [InlineKeyboardButton("Главное меню", callback_data="back_to_menu")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        
-        # Отправляем изображение пользователю из локального файла
-        with open(generated_file_path, 'rb') as photo_file:
-            await context.bot.send_photo(
-                chat_id=update.effective_chat.id,
-                photo=photo_file,
-                caption=f"Ваше изображение в стиле {style_name}! 🌟\n\nСписано: ⭐ {GENERATION_COST} звезд\nТекущий баланс: ⭐ {current_balance} звезд",
-                reply_markup=reply_markup
-            )
-        
-        # Удаляем сгенерированный файл после отправки
-        try:
-            os.remove(generated_file_path)
-            logger.info(f"Сгенерированный файл {generated_file_path} успешно удален")
-        except Exception as file_error:
-            logger.warning(f"Не удалось удалить сгенерированный файл {generated_file_path}: {file_error}")
-        
-        # Удаляем статусное сообщение
-        try:
-            await context.bot.delete_message(
-                chat_id=update.effective_chat.id,
-                message_id=status_message.message_id
-            )
-        except Exception as msg_error:
-            logger.warning(f"Не удалось удалить статусное сообщение: {msg_error}")
             
     except OpenAIError as e:
         logger.error(f"Ошибка OpenAI при обработке изображения: {e}")
         
         # Удаляем временный файл в случае ошибки
-        try:
-            os.remove(file_path)
-            logger.info(f"Временный файл {file_path} удален после ошибки OpenAI")
-        except Exception as file_error:
-            logger.warning(f"Не удалось удалить временный файл {file_path}: {file_error}")
+        await temp_files.remove(file_path)
         
         # Запасной вариант: попробуем DALL-E 2 вариации
         try:
@@ -1354,9 +1626,7 @@ async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             img_bytes = await async_read_file(file_path)
             
             # Отправляем периодические обновления статуса, чтобы пользователь знал, что бот работает
-            status_update_task = asyncio.create_task(
-                update_status_periodically(context.bot, update.effective_chat.id, status_message.message_id)
-            )
+            status_job = status_ticker.register(context.bot, update.effective_chat.id, status_message.message_id)
             
             # Запускаем запрос к OpenAI API в отдельном потоке
             from functools import partial
@@ -1372,8 +1642,8 @@ async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
                 )
             )
             
-            # Останавливаем задачу обновления статуса
-            status_update_task.cancel()
+            # Прекращаем обновление статуса
+            status_ticker.unregister(status_job)
             
             # Получаем изображение в формате base64
             image_base64 = image_response.data[0].b64_json
@@ -1383,15 +1653,17 @@ async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             # Сохраняем изображение во временный файл для отправки - асинхронно
             generated_file_path = f"{tmp_dir}/generated_{unique_id}.png"
             await async_save_file(generated_file_path, image_bytes)
+            temp_files.register(generated_file_path, unique_id, size=len(image_bytes))
                 
             logger.info(f"Изображение успешно сгенерировано и сохранено в {generated_file_path}")
             
             # Асинхронно удаляем временный файл изображения
-            await async_remove_file(file_path)
+            await temp_files.remove(file_path)
             
-            # Асинхронно обновляем баланс пользователя
-            await update_user_balance(user_id, -GENERATION_COST)
-            current_balance = await get_user_balance(user_id)
+            # Асинхронно обновляем баланс пользователя (изображение уже готово, поэтому при сбое списываем позже)
+            _, current_balance = await credit_stars(user_id, -GENERATION_COST, f"charge:{unique_id}", "charge", wait=PAYMENT_APPLY_WAIT)
+            if current_balance is None:
+                current_balance = await get_user_balance(user_id) - GENERATION_COST
             
             # Создаем кнопки для добавления после генерации - строго 3 кнопки
             keyboard = [
@@ -1414,7 +1686,7 @@ async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             )
             
             # Асинхронно удаляем сгенерированный файл после отправки
-            await async_remove_file(generated_file_path)
+            await temp_files.remove(generated_file_path)
             
             # Удаляем статусное сообщение
             try:
@@ -1429,11 +1701,7 @@ async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             logger.error(f"Ошибка OpenAI при обработке изображения: {e}")
             
             # Удаляем временный файл в случае ошибки
-            try:
-                os.remove(file_path)
-                logger.info(f"Временный файл {file_path} удален после ошибки OpenAI")
-            except Exception as file_error:
-                logger.warning(f"Не удалось удалить временный файл {file_path}: {file_error}")
+            await temp_files.remove(file_path)
             
             # Запасной вариант: попробуем DALL-E 2 вариации
             try:
@@ -1468,12 +1736,14 @@ async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
                 # Сохраняем изображение во временный файл для отправки - асинхронно
                 backup_file_path = f"{tmp_dir}/backup_{unique_id}.png"
                 await async_save_file(backup_file_path, image_bytes)
+                temp_files.register(backup_file_path, unique_id, size=len(image_bytes))
                 
                 logger.info("Альтернативное изображение успешно создано")
                 
-                # Асинхронно обновляем баланс пользователя
-                await update_user_balance(user_id, -GENERATION_COST)
-                current_balance = await get_user_balance(user_id)
+                # Асинхронно обновляем баланс пользователя (при сбое списываем позже)
+                _, current_balance = await credit_stars(user_id, -GENERATION_COST, f"charge:{unique_id}", "charge", wait=PAYMENT_APPLY_WAIT)
+                if current_balance is None:
+                    current_balance = await get_user_balance(user_id) - GENERATION_COST
                 
                 # Асинхронно читаем файл для отправки
                 photo_content = await async_read_file(backup_file_path)
@@ -1486,7 +1756,7 @@ async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
                 )
                 
                 # Асинхронно удаляем временный файл после отправки
-                await async_remove_file(backup_file_path)
+                await temp_files.remove(backup_file_path)
                 
                 # Удаляем статусное сообщение
                 await context.bot.delete_message(
@@ -1512,6 +1782,10 @@ async def process_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             )
         except:
             await update.message.reply_text(f"Произошла ошибка при обработке изображения: {str(e)}")
+    finally:
+        # Задача завершена: удаляем все ее временные файлы, включая оставшиеся после ошибок
+        if unique_id is not None:
+            await temp_files.finish(unique_id)
 
 async def text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработка текстовых сообщений."""
@@ -1527,104 +1801,6 @@ async def text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         reply_markup=create_main_menu()
     )
 
-# Функции управления временными файлами
-def cleanup_temp_files(context: ContextTypes.DEFAULT_TYPE = None):
-    """Очистка временных файлов изображений для экономии места на PythonAnywhere."""
-    logger.info("Запуск плановой очистки временных файлов...")
-    
-    # Определяем директории для проверки
-    temp_dirs = ["/tmp", "images/temp"] 
-    if not os.path.exists("images/temp"):
-        os.makedirs("images/temp", exist_ok=True)
-    
-    # Максимальный возраст файла (30 минут)
-    max_age_seconds = 30 * 60
-    current_time = time.time()
-    deleted_count = 0
-    freed_space_bytes = 0
-    
-    # Проходим по всем временным директориям
-    for temp_dir in temp_dirs:
-        if os.path.exists(temp_dir):
-            # Ищем все файлы изображений
-            for pattern in ["*.png", "*.jpg", "*.jpeg"]:
-                for file_path in glob.glob(os.path.join(temp_dir, pattern)):
-                    try:
-                        # Проверяем время последнего изменения
-                        file_age = current_time - os.path.getmtime(file_path)
-                        
-                        # Удаляем старые файлы
-                        if file_age > max_age_seconds:
-                            # Получаем размер файла перед удалением
-                            file_size = os.path.getsize(file_path)
-                            os.remove(file_path)
-                            deleted_count += 1
-                            freed_space_bytes += file_size
-                            logger.debug(f"Удален временный файл {file_path}, возраст: {file_age:.0f} сек.")
-                    except Exception as e:
-                        logger.warning(f"Ошибка при очистке файла {file_path}: {e}")
-    
-    # Конвертируем байты в МБ для логов
-    freed_space_mb = freed_space_bytes / (1024 * 1024)
-    logger.info(f"Очистка временных файлов: удалено {deleted_count} файлов, освобождено {freed_space_mb:.2f} МБ")
-    
-    # Проверяем оставшееся место на диске
-    check_disk_space()
-
-def check_disk_space(min_free_mb=50):
-    """Проверка доступного дискового пространства."""
-    try:
-        # Проверяем пространство в текущей директории
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        total, used, free = shutil.disk_usage(current_dir)
-        free_mb = free / (1024 * 1024)
-        
-        logger.info(f"Доступно дискового пространства: {free_mb:.2f} МБ")
-        
-        # Если свободного места слишком мало, выполняем экстренную очистку
-        if free_mb < min_free_mb:
-            logger.warning(f"Критически мало места на диске: {free_mb:.2f} МБ. Запуск экстренной очистки.")
-            emergency_cleanup()
-            
-        return free_mb
-    except Exception as e:
-        logger.error(f"Ошибка при проверке дискового пространства: {e}")
-        return None
-
-def emergency_cleanup():
-    """Экстренная очистка всех временных файлов при критически низком месте на диске."""
-    logger.warning("Выполняется экстренная очистка временных файлов!")
-    
-    temp_dirs = ["/tmp", "images/temp"]
-    deleted_count = 0
-    
-    for temp_dir in temp_dirs:
-        if os.path.exists(temp_dir):
-            for pattern in ["*.png", "*.jpg", "*.jpeg"]:
-                for file_path in glob.glob(os.path.join(temp_dir, pattern)):
-                    try:
-                        os.remove(file_path)
-                        deleted_count += 1
-                    except Exception as e:
-                        logger.warning(f"Не удалось удалить {file_path}: {e}")
-    
-    logger.info(f"Экстренная очистка: удалено {deleted_count} файлов")
-
-# Функция для настройки регулярных задач
-def setup_scheduled_tasks(updater):
-    """Настройка регулярных задач обслуживания."""
-    job_queue = updater.job_queue
-    
-    # Очистка временных файлов каждые 30 минут
-    job_queue.run_repeating(cleanup_temp_files, interval=30*60, first=10)
-    
-    # Более тщательная очистка раз в день - в 3 часа ночи
-    from datetime import time
-    time_of_day = time(3, 0, 0)  # 3:00 AM
-    job_queue.run_daily(cleanup_temp_files, time=time_of_day)
-    
-    logger.info("Запланированы регулярные задачи очистки временных файлов")
-
 async def text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle text messages."""
     # Декоратор log_processing_time теперь сам измеряет время выполнения
@@ -1729,11 +1905,9 @@ async def text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 
         # Если пользователь отправил сообщение до использования /start
         elif update.message.text and not update.message.text.startswith('/'):
-            # Проверяем, существует ли пользователь в базе
-            user = await get_user(user_id)
-            
+            # Проверяем, существует ли пользователь в базе (обычно без обращения к БД)
             # Если пользователя нет в базе, отправляем ему информацию о боте
-            if not user:
+            if not await user_exists(user_id):
                 bot_description = (
                     "✨ Что может делать этот бот? ✨\n\n"
                     "🎨 Этот бот может преобразовать любую фотографию в различные художественные стили с помощью продвинутого Искусственного Интеллекта!\n\n"
@@ -1756,6 +1930,105 @@ async def text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     else:
         logger.error(f"Ошибка в text_message: update = {update}")
 
+def register_handlers(application):
+    """Register all update handlers on the application."""
+    # Простой декоратор для измерения времени выполнения
+    def log_processing_time(handler):
+        async def wrapper(update, context, *args, **kwargs):
+            # Просто запоминаем время начала
+            start_time = time.time()
+            
+            # Учитываем активного пользователя в почасовой статистике
+            if update.effective_user:
+                stats_collector.record_active_user(update.effective_user.id)
+            
+            try:
+                # Вызываем оригинальный обработчик
+                result = await handler(update, context, *args, **kwargs)
+                
+                # Рассчитываем время выполнения
+                processing_time = (time.time() - start_time) * 1000  # в мс
+                
+                # Определяем тип обновления
+                update_type = 'unknown'
+                if hasattr(update, 'message') and update.message:
+                    update_type = 'message'
+                elif hasattr(update, 'callback_query') and update.callback_query:
+                    update_type = 'callback'
+                elif hasattr(update, 'edited_message') and update.edited_message:
+                    update_type = 'edited_message'
+                
+                # Логируем результат
+                logger.info(f'Обработка {update_type} заняла {processing_time:.1f} мс')
+                return result
+            except Exception as e:
+                # В случае ошибки тоже логируем время
+                processing_time = (time.time() - start_time) * 1000
+                logger.error(f'Ошибка при обработке: {e}, время: {processing_time:.1f} мс')
+                raise
+        return wrapper
+        
+    # Регистрируем обработчик ошибок
+    async def error_handler(update, context):
+        # Записываем ошибку в лог, не пытаясь получить время обработки
+        logger.error(f"Ошибка при обработке обновления: {context.error}")
+        
+        if update:
+            logger.error(f"Обновление, вызвавшее ошибку: {update}")
+            
+    application.add_error_handler(error_handler)
+    
+    # Запись обезличенного трафика для бенчмарков (группа -2 выполняется раньше остальных)
+    if traffic_recorder.enabled:
+        application.add_handler(TypeHandler(Update, traffic_recorder.capture), group=-2)
+        logger.info("Зарегистрирован обработчик записи трафика")
+    
+    # Add handlers with processing time logging
+    application.add_handler(CommandHandler("start", log_processing_time(admission_control(start))))
+    logger.info("Зарегистрирован обработчик /start")
+    
+    application.add_handler(CommandHandler("menu", log_processing_time(admission_control(menu_command))))
+    logger.info("Зарегистрирован обработчик /menu")
+    
+    application.add_handler(CommandHandler("help", log_processing_time(admission_control(help_command))))
+    logger.info("Зарегистрирован обработчик /help")
+    
+    application.add_handler(CommandHandler("balance", log_processing_time(admission_control(balance_command))))
+    logger.info("Зарегистрирован обработчик /balance")
+    
+    application.add_handler(CommandHandler("stats", log_processing_time(admission_control(stats_command))))
+    logger.info("Зарегистрирован обработчик /stats")
+    
+    application.add_handler(CallbackQueryHandler(log_processing_time(admission_control(button_handler))))
+    logger.info("Зарегистрирован обработчик для кнопок")
+    
+    application.add_handler(MessageHandler(filters.PHOTO, log_processing_time(admission_control(process_photo))))
+    logger.info("Зарегистрирован обработчик для фотографий")
+    
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, log_processing_time(admission_control(text_message))))
+    logger.info("Зарегистрирован обработчик для текстовых сообщений")
+    
+    # Add payment handlers
+    application.add_handler(PreCheckoutQueryHandler(precheckout_callback))
+    application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback))
+    logger.info("Зарегистрированы обработчики для платежей")
+
+def build_application():
+    """Build the Application with extended timeouts and the configured Bot API endpoint."""
+    from telegram.ext import ApplicationBuilder
+    
+    # Обновления обрабатываются параллельно, общий потолок задает контроль допуска
+    return (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .base_url(f"{TELEGRAM_API_BASE}/bot")
+        .base_file_url(f"{TELEGRAM_API_BASE}/file/bot")
+        .read_timeout(30)
+        .connect_timeout(30)
+        .concurrent_updates(GLOBAL_CONCURRENCY * 2)
+        .build()
+    )
+
 async def main() -> None:
     """Start the bot."""
     print(f"Запуск бота @{BOT_USERNAME}...")
@@ -1763,7 +2036,7 @@ async def main() -> None:
     # Проверка на дубликаты экземпляров бота
     try:
         import requests
-        bot_info = requests.get(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getWebhookInfo", timeout=5).json()
+        bot_info = requests.get(f"{TELEGRAM_API_BASE}/bot{TELEGRAM_TOKEN}/getWebhookInfo", timeout=5).json()
         if bot_info.get('result', {}).get('url'):
             logger.warning("Обнаружен запущенный webhook. Возможно, бот уже запущен в другом месте.")
             print("ВНИМАНИЕ: Обнаружен запущенный webhook. Возможно, бот уже запущен в другом месте.")
@@ -1777,6 +2050,9 @@ async def main() -> None:
         success = await init_db()
         if success:
             logger.info("База данных PostgreSQL успешно инициализирована")
+            stats_collector.start()
+            balance_ledger.start()
+            temp_files.start()
         else:
             logger.error("Ошибка при инициализации базы данных PostgreSQL")
             print("Ошибка при инициализации базы данных PostgreSQL. Проверьте настройки подключения.")
@@ -1806,12 +2082,12 @@ async def main() -> None:
         for user_id, amount in special_users.items():
             # Проверяем, существует ли пользователь в базе
             if user_id in all_users:
-                await update_user_balance(user_id, amount)
+                await credit_stars(user_id, amount, f"bonus:{user_id}", "bonus")
                 logger.info(f"Пополнен баланс пользователя {user_id} на {amount} звезд")
             else:
                 # Если пользователя нет в базе, создаем его с указанным балансом
                 await create_user(user_id, None, None, None)
-                await update_user_balance(user_id, amount)
+                await credit_stars(user_id, amount, f"bonus:{user_id}", "bonus")
                 logger.info(f"Создан новый пользователь {user_id} с балансом {amount} звезд")
         
         # ВСЕМ остальным пользователям ничего не начисляем!
@@ -1830,104 +2106,28 @@ async def main() -> None:
     
     try:
         # Create the Application with extended timeout settings
-        from telegram.ext import ApplicationBuilder
-        
-        # Создаем приложение с расширенными настройками таймаута
-        application = ApplicationBuilder().token(TELEGRAM_TOKEN).read_timeout(30).connect_timeout(30).build()
+        application = build_application()
         logger.info(f"Бот инициализирован с токеном: {TELEGRAM_TOKEN[:5]}...")
 
-        # Простой декоратор для измерения времени выполнения
-        def log_processing_time(handler):
-            async def wrapper(update, context, *args, **kwargs):
-                # Просто запоминаем время начала
-                start_time = time.time()
-                
-                try:
-                    # Вызываем оригинальный обработчик
-                    result = await handler(update, context, *args, **kwargs)
-                    
-                    # Рассчитываем время выполнения
-                    processing_time = (time.time() - start_time) * 1000  # в мс
-                    
-                    # Определяем тип обновления
-                    update_type = 'unknown'
-                    if hasattr(update, 'message') and update.message:
-                        update_type = 'message'
-                    elif hasattr(update, 'callback_query') and update.callback_query:
-                        update_type = 'callback'
-                    elif hasattr(update, 'edited_message') and update.edited_message:
-                        update_type = 'edited_message'
-                    
-                    # Логируем результат
-                    logger.info(f'Обработка {update_type} заняла {processing_time:.1f} мс')
-                    return result
-                except Exception as e:
-                    # В случае ошибки тоже логируем время
-                    processing_time = (time.time() - start_time) * 1000
-                    logger.error(f'Ошибка при обработке: {e}, время: {processing_time:.1f} мс')
-                    raise
-            return wrapper
-            
-        # Регистрируем обработчик ошибок
-        async def error_handler(update, context):
-            # Записываем ошибку в лог, не пытаясь получить время обработки
-            logger.error(f"Ошибка при обработке обновления: {context.error}")
-            
-            if update:
-                logger.error(f"Обновление, вызвавшее ошибку: {update}")
-                
-        application.add_error_handler(error_handler)
-        
-        # Add handlers with processing time logging
-        application.add_handler(CommandHandler("start", log_processing_time(start)))
-        logger.info("Зарегистрирован обработчик /start")
-        
-        application.add_handler(CommandHandler("menu", log_processing_time(menu_command)))
-        logger.info("Зарегистрирован обработчик /menu")
-        
-        application.add_handler(CommandHandler("help", log_processing_time(help_command)))
-        logger.info("Зарегистрирован обработчик /help")
-        
-        application.add_handler(CommandHandler("balance", log_processing_time(balance_command)))
-        logger.info("Зарегистрирован обработчик /balance")
-        
-        application.add_handler(CallbackQueryHandler(log_processing_time(button_handler)))
-        logger.info("Зарегистрирован обработчик для кнопок")
-        
-        application.add_handler(MessageHandler(filters.PHOTO, log_processing_time(process_photo)))
-        logger.info("Зарегистрирован обработчик для фотографий")
-        
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, log_processing_time(text_message)))
-        logger.info("Зарегистрирован обработчик для текстовых сообщений")
-        
-        # Add payment handlers
-        application.add_handler(PreCheckoutQueryHandler(precheckout_callback))
-        application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback))
-        logger.info("Зарегистрированы обработчики для платежей")
+        # Регистрируем обработчики команд, кнопок, фото и платежей
+        register_handlers(application)
 
         # Start the Bot with more log info
         print("Запуск бота через polling...")
         logger.info("Запуск бота через polling...")
         
-        # Настройка задач очистки временных файлов и резервного копирования
+        # Настройка задачи резервного копирования
         # Обновленная версия для python-telegram-bot v20.x
         job_queue = application.job_queue
         if job_queue is not None:
-            # Задача очистки временных файлов каждые 30 минут
-            job_queue.run_repeating(cleanup_temp_files, interval=30*60, first=10)
-            logger.info("Задача очистки временных файлов добавлена в расписание")
-            
-            # Задача резервного копирования базы данных каждые 6 часов
+            # Резервное копирование users и balance_history (COPY со сжатием, не блокирует обработчики)
             async def scheduled_backup(context: ContextTypes.DEFAULT_TYPE):
                 logger.info("Запуск планового резервного копирования базы данных...")
-                backup_db()
+                await backup_engine.create_backup()
                 
-            job_queue.run_repeating(scheduled_backup, interval=6*60*60, first=60*60)
+            job_queue.run_repeating(scheduled_backup, interval=BACKUP_INTERVAL, first=60*60)
             logger.info("Задача резервного копирования базы данных добавлена в расписание")
         
-        # Выполняем первоначальную очистку временных файлов при запуске
-        cleanup_temp_files()
-        
         # Start the Bot
         print("Бот запущен и готов к работе! Нажмите Ctrl+C для остановки.")
         logger.info("Бот успешно запущен и ждет сообщения!")
@@ -1942,28 +2142,58 @@ async def main() -> None:
             drop_pending_updates=True
         )
         
+        # SIGTERM (Railway) и Ctrl+C запускают корректную остановку
+        shutdown.install_signal_handlers()
+        
         try:
-            # Запускаем бесконечный цикл, чтобы бот работал
+            # Работаем до сигнала остановки
             while True:
-                # Проверяем свободное место на диске каждый час
-                if check_disk_space():
-                    # Если места достаточно, продолжаем работу
-                    pass
-                else:
-                    # Если места мало, выполняем экстренную очистку
-                    emergency_cleanup()
+                # Логируем счетчики контроля допуска и тикера статусов
+                logger.info(f"Контроль допуска: {admission.get_stats()}")
+                logger.info(f"Тикер статусов: {status_ticker.get_stats()}")
+                logger.info(f"Очередь исходящих: {outbound.get_stats()}")
+                logger.info(f"Подготовка изображений: {image_output.get_stats()}")
+                logger.info(f"Статистика: {stats_collector.get_stats()}")
+                logger.info(f"Кэш балансов: {db_cache_stats}, объединение запросов: {db_single_flight_stats}")
+                logger.info(f"Фильтр Блума пользователей: {get_user_bloom_stats()}")
+                logger.info(f"Индекс балансов: {get_balance_index_stats()}")
+                logger.info(f"Пул соединений: {get_pool_stats()}")
+                logger.info(f"Журнал начислений: {balance_ledger.get_stats()}")
+                logger.info(f"Временные файлы: {temp_files.get_stats()}")
+                logger.info(f"Резервные копии: {backup_engine.get_stats()}")
+                logger.info(f"Фоновые генерации: {shutdown.get_stats()}")
+                if traffic_recorder.enabled:
+                    logger.info(f"Запись трафика: {traffic_recorder.get_stats()}")
                 
-                # Спим, чтобы не загружать процессор
-                await asyncio.sleep(3600)  # 1 час
-        except KeyboardInterrupt:
-            # Закрываем пул соединений при завершении работы
-            from db import close_pool
-            await close_pool()
-            logger.info("Пул соединений PostgreSQL закрыт")
+                # Ждем час или сигнала остановки
+                if await shutdown.wait(3600):
+                    break
         finally:
-            # Закрываем бот
-            await application.stop()
-            await application.shutdown()
+            # Сначала прекращаем прием обновлений, дожидаемся обработчиков (они еще могут
+            # запустить генерацию) и отдаем в обработку недособранные альбомы; затем ждем
+            # генераций, дописываем накопленное (журнал начислений и статистика - пока пул
+            # еще открыт) и закрываем пул
+            async def drain_outbound():
+                await outbound.drain(SHUTDOWN_STEP_TIMEOUT / 2)
+                await outbound.stop()
+
+            await shutdown.shutdown(
+                stop_intake=[
+                    ("Прием обновлений", application.updater.stop),
+                    ("Обработчики обновлений", application.stop),
+                    ("Сборка альбомов", album_collector.flush_all),
+                ],
+                flush=[
+                    ("Тикер статусов", status_ticker.stop),
+                    ("Очередь исходящих", drain_outbound),
+                    ("Бот", application.shutdown),
+                    ("Временные файлы", temp_files.stop),
+                    ("Запись трафика", traffic_recorder.close),
+                    ("Статистика", stats_collector.stop),
+                    ("Журнал начислений", balance_ledger.stop),
+                    ("Пул соединений", close_pool),
+                ],
+            )
         
     except Exception as e:
         logger.error(f"Критическая ошибка при запуске бота: {e}")
@@ -1976,7 +2206,7 @@ async def check_for_duplicate_bots():
         import httpx
         async with httpx.AsyncClient() as client:
             # Проверяем getMe - если бот уже работает, ответ должен быть быстрым
-            response = await client.post(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getUpdates", 
+            response = await client.post(f"{TELEGRAM_API_BASE}/bot{TELEGRAM_TOKEN}/getUpdates", 
                                          json={"offset": -1, "limit": 1, "timeout": 1})
             if response.status_code == 409:  # Conflict - значит, есть другой экземпляр
                 logger.error("Обнаружен другой запущенный экземпляр бота! Этот экземпляр будет остановлен.")
@@ -1984,7 +2214,7 @@ async def check_for_duplicate_bots():
                 return True
                 
             # Дополнительная проверка - есть ли webhook
-            webhook_response = await client.post(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/getWebhookInfo")
+            webhook_response = await client.post(f"{TELEGRAM_API_BASE}/bot{TELEGRAM_TOKEN}/getWebhookInfo")
             if webhook_response.status_code == 200:
                 webhook_info = webhook_response.json()
                 if webhook_info.get('result', {}).get('url'):
@@ -2,13 +2,21 @@
 Модуль для асинхронной работы с базой данных PostgreSQL.
 """
 import os
+import re
+import json
 import logging
 import asyncio
 import asyncpg
 import time
+from dataclasses import dataclass
+from contextlib import asynccontextmanager
+from array import array
 from datetime import datetime
 from dotenv import load_dotenv
-from typing import Dict, Any, Optional
+from bloom import BloomFilter
+from balance_index import BalanceIndex
+from pool_supervisor import PoolSupervisor, DatabaseUnavailable, ACQUIRE_TIMEOUT
+from typing import Dict, Any, Optional, Callable, Awaitable
 
 # Загрузка переменных окружения
 load_dotenv()
@@ -37,31 +45,267 @@ elif DATABASE_URL and DATABASE_URL != "None" and DATABASE_URL != "":
     PG_CONNECTION_STRING = DATABASE_URL
     logger.info("Используем DATABASE_URL для подключения к PostgreSQL")
 
+# Размеры пула соединений и таймаут запросов (подбираются по benchmarks/db_bench.py)
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "5"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "20"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "5"))
+DB_CONNECT_TIMEOUT = float(os.getenv("DB_CONNECT_TIMEOUT", "10"))
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", "60"))
+
+# Реплика только для чтения (необязательно). Чтения идут на нее, пока отставание
+# репликации не превышает REPLICA_MAX_LAG секунд, иначе - на основную базу
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL") or None
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "5"))
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv("REPLICA_LAG_CHECK_INTERVAL", "5"))
+DB_REPLICA_POOL_MAX_SIZE = int(os.getenv("DB_REPLICA_POOL_MAX_SIZE", str(DB_POOL_MAX_SIZE)))
+
+# Секционирование user_actions по месяцам
+USER_ACTIONS_PARTITIONS_AHEAD = int(os.getenv("USER_ACTIONS_PARTITIONS_AHEAD", "2"))
+# Сколько месяцев хранить действия пользователей (0 - не удалять)
+USER_ACTIONS_RETENTION_MONTHS = int(os.getenv("USER_ACTIONS_RETENTION_MONTHS", "6"))
+_PARTITION_NAME = re.compile(r"^user_actions_(\d{4})_(\d{2})$")
+
 # Глобальные переменные
 _pool = None
+pool_supervisor: Optional[PoolSupervisor] = None
+_replica_pool = None
+replica_supervisor: Optional[PoolSupervisor] = None
+_replica_lag_task = None
+# Отставание реплики в секундах (None - неизвестно или реплика недоступна)
+_replica_lag: Optional[float] = None
+replica_stats = {'reads': 0, 'primary_reads': 0, 'lag_checks': 0, 'lag_failures': 0}
 _background_worker_task = None
+_partition_task = None
+
+@dataclass(slots=True)
+class UserProfile:
+    """
+    Компактная запись кэша о пользователе.
+
+    Поля со значением None еще не загружены из БД. complete=True означает, что
+    профиль прочитан целиком (get_user/create_user), а не только баланс.
+    """
+    user_id: int
+    balance: Optional[int] = None
+    username: Optional[str] = None
+    first_name: Optional[str] = None
+    last_name: Optional[str] = None
+    total_generations: Optional[int] = None
+    created_at: Optional[datetime] = None
+    exists: Optional[bool] = None
+    complete: bool = False
+    last_updated: float = 0.0
+
+# Колонки, из которых собирается UserProfile (вместо SELECT *)
+PROFILE_COLUMNS = "user_id, balance, username, first_name, last_name, total_generations, created_at"
 
 # Структуры для кэширования
-# Кэш данных пользователей {user_id: {"balance": value, "last_updated": timestamp, ...}}
-user_cache: Dict[int, Dict[str, Any]] = {}
+# Кэш данных пользователей {user_id: UserProfile}
+user_cache: Dict[int, UserProfile] = {}
 
 # Максимальное время жизни записи в кэше (в секундах)
 CACHE_TTL = 300  # 5 минут
+# TTL, пока активна подписка на уведомления об изменениях баланса (LISTEN/NOTIFY)
+CACHE_TTL_WITH_NOTIFY = int(os.getenv("CACHE_TTL_WITH_NOTIFY", "3600"))
+# Канал уведомлений, в который пишет триггер таблицы users
+BALANCE_CHANNEL = "user_balance"
+
+# Подписка на изменения баланса: при активном соединении кэш можно держать дольше
+_cache_listener_task = None
+_cache_listener_connected = False
+cache_stats = {'hits': 0, 'misses': 0, 'notifications': 0, 'reconnects': 0}
+
+# Фильтр Блума по зарегистрированным пользователям: отрицательный ответ не требует запроса к БД.
+# Пересобирается при каждом подключении подписки на уведомления
+USER_BLOOM_ERROR_RATE = float(os.getenv("USER_BLOOM_ERROR_RATE", "0.01"))
+USER_BLOOM_MIN_CAPACITY = int(os.getenv("USER_BLOOM_MIN_CAPACITY", "100000"))
+user_bloom: Optional[BloomFilter] = None
+
+# Индекс балансов в памяти: пока активна подписка на уведомления, чтение баланса не
+# обращается к БД. Индекс и фильтр Блума собираются одним проходом по users и
+# периодически сверяются с БД
+BALANCE_INDEX_RECONCILE_INTERVAL = int(os.getenv("BALANCE_INDEX_RECONCILE_INTERVAL", "600"))
+balance_index: Optional[BalanceIndex] = None
+balance_index_stats = {'rebuilds': 0, 'mismatches': 0, 'last_mismatches': 0, 'last_duration_ms': 0}
+# Изменения во время пересборки {user_id: баланс, None - удален} (None - пересборка не идет)
+_index_pending: Optional[Dict[int, Optional[int]]] = None
+_index_rebuild_task = None
+_index_reconcile_task = None
+
+# Выполняющиеся запросы для объединения одинаковых обращений {key: Task}
+_in_flight: Dict[Any, asyncio.Task] = {}
+single_flight_stats = {'leaders': 0, 'joined': 0}
+
+# Начальный баланс нового пользователя (в звездах)
+INITIAL_BALANCE = 20
+
+def _cache_ttl() -> float:
+    return CACHE_TTL_WITH_NOTIFY if _cache_listener_connected else CACHE_TTL
 
 def get_from_cache(user_id: int, key: str) -> Optional[Any]:
     """Получить значение из кэша по идентификатору пользователя и ключу"""
-    if user_id in user_cache and key in user_cache[user_id]:
+    profile = user_cache.get(user_id)
+    if profile is not None:
+        value = getattr(profile, key, None)
         # Проверяем актуальность данных
-        if time.time() - user_cache[user_id].get('last_updated', 0) < CACHE_TTL:
-            return user_cache[user_id][key]
+        if value is not None and time.time() - profile.last_updated < _cache_ttl():
+            cache_stats['hits'] += 1
+            return value
+    cache_stats['misses'] += 1
     return None
 
 def update_cache(user_id: int, key: str, value: Any) -> None:
     """Обновить значение в кэше"""
-    if user_id not in user_cache:
-        user_cache[user_id] = {}
-    user_cache[user_id][key] = value
-    user_cache[user_id]['last_updated'] = time.time()
+    profile = user_cache.get(user_id)
+    if profile is None:
+        profile = user_cache[user_id] = UserProfile(user_id)
+    setattr(profile, key, value)
+    profile.last_updated = time.time()
+
+def cache_profile(row) -> UserProfile:
+    """Сохранить в кэш полный профиль из строки users с колонками PROFILE_COLUMNS."""
+    profile = UserProfile(
+        user_id=row['user_id'],
+        balance=row['balance'],
+        username=row['username'],
+        first_name=row['first_name'],
+        last_name=row['last_name'],
+        total_generations=row['total_generations'],
+        created_at=row['created_at'],
+        exists=True,
+        complete=True,
+        last_updated=time.time(),
+    )
+    user_cache[profile.user_id] = profile
+    return profile
+
+def user_definitely_missing(user_id: int) -> bool:
+    """
+    Пользователь точно не зарегистрирован (по фильтру Блума, без запроса к БД).
+
+    Фильтру доверяем, только пока активна подписка на уведомления: через нее
+    приходят вставки из других экземпляров и ручные вставки через SQL.
+    """
+    return user_bloom is not None and _cache_listener_connected and user_id not in user_bloom
+
+def record_balance(user_id: int, balance: int) -> None:
+    """Учесть зафиксированный в БД баланс: кэш, индекс балансов и фильтр Блума."""
+    update_cache(user_id, 'balance', balance)
+    update_cache(user_id, 'exists', True)
+    if _index_pending is not None:
+        _index_pending[user_id] = balance
+    if balance_index is not None:
+        balance_index.set(user_id, balance)
+    if user_bloom is not None:
+        user_bloom.add(user_id)
+        if user_bloom.overfilled:
+            _start_index_rebuild()
+
+def forget_user(user_id: int) -> None:
+    """Убрать удаленного пользователя из кэша и индекса балансов."""
+    invalidate_cache(user_id)
+    if _index_pending is not None:
+        _index_pending[user_id] = None
+    if balance_index is not None:
+        balance_index.remove(user_id)
+
+def indexed_balance(user_id: int) -> Optional[int]:
+    """Баланс из индекса в памяти; None, если индексу сейчас нельзя доверять или пользователя в нем нет."""
+    if balance_index is not None and _cache_listener_connected:
+        return balance_index.get(user_id)
+    return None
+
+def _bloom_miss(user_id: int) -> None:
+    """Учесть, что фильтр ответил "возможно есть", а строки в БД нет."""
+    if user_bloom is not None and _cache_listener_connected:
+        user_bloom.record_false_positive()
+
+async def rebuild_user_indexes() -> None:
+    """
+    Пересобрать индекс балансов и фильтр Блума одним проходом по users.
+
+    Заодно сверяет прежний индекс с БД: расхождения (кроме пользователей, чей
+    баланс изменился во время прохода) считаются и логируются.
+    """
+    global user_bloom, balance_index, _index_pending
+    started = time.perf_counter()
+    _index_pending = {}
+    previous = balance_index
+    mismatched = []
+    try:
+        user_ids, balances = array('q'), array('q')
+        async with acquire() as conn:
+            async with conn.transaction(isolation='repeatable_read', readonly=True):
+                count = await conn.fetchval("SELECT count(*) FROM users")
+                bloom = BloomFilter(max(USER_BLOOM_MIN_CAPACITY, count * 2), USER_BLOOM_ERROR_RATE)
+                async for row in conn.cursor("SELECT user_id, balance FROM users ORDER BY user_id", prefetch=10000):
+                    user_id, balance = row['user_id'], row['balance'] or 0
+                    user_ids.append(user_id)
+                    balances.append(balance)
+                    bloom.add(user_id)
+                    if previous is not None and previous.peek(user_id) != balance:
+                        mismatched.append(user_id)
+        
+        # Изменения, пришедшие во время чтения, новее прочитанного снимка
+        index = BalanceIndex(user_ids, balances)
+        for user_id, balance in _index_pending.items():
+            if balance is None:
+                index.remove(user_id)
+            else:
+                index.set(user_id, balance)
+                bloom.add(user_id)
+        mismatched = [user_id for user_id in mismatched if user_id not in _index_pending]
+        balance_index, user_bloom = index, bloom
+        
+        duration_ms = int((time.perf_counter() - started) * 1000)
+        balance_index_stats['rebuilds'] += 1
+        balance_index_stats['mismatches'] += len(mismatched)
+        balance_index_stats['last_mismatches'] = len(mismatched)
+        balance_index_stats['last_duration_ms'] = duration_ms
+        if mismatched:
+            logger.warning(f"Индекс балансов расходился с БД у {len(mismatched)} пользователей "
+                           f"(например, {mismatched[:5]}), исправлено")
+        logger.info(
+            f"Индекс балансов и фильтр Блума собраны за {duration_ms} мс: {len(index)} пользователей, "
+            f"{index.memory_bytes() // 1024} КБ + {len(bloom.bits) // 1024} КБ"
+        )
+    except Exception as e:
+        # Без индекса и фильтра все чтения просто идут в кэш и БД
+        logger.error(f"Ошибка при построении индекса балансов: {e}")
+        balance_index, user_bloom = None, None
+    finally:
+        _index_pending = None
+
+def _start_index_rebuild():
+    """Запустить пересборку индекса балансов в фоне, если она еще не идет."""
+    global _index_rebuild_task
+    if _index_rebuild_task is None or _index_rebuild_task.done():
+        _index_rebuild_task = asyncio.create_task(rebuild_user_indexes())
+
+async def _index_reconcile_loop() -> None:
+    """Периодически сверять индекс балансов с БД."""
+    while True:
+        await asyncio.sleep(BALANCE_INDEX_RECONCILE_INTERVAL)
+        if _cache_listener_connected:
+            _start_index_rebuild()
+            await _index_rebuild_task
+
+def _start_index_reconcile():
+    global _index_reconcile_task
+    if BALANCE_INDEX_RECONCILE_INTERVAL > 0 and (_index_reconcile_task is None or _index_reconcile_task.done()):
+        _index_reconcile_task = asyncio.create_task(_index_reconcile_loop())
+
+def get_balance_index_stats() -> dict:
+    """Метрики индекса балансов: размер, память, попадания и расхождения с БД."""
+    if balance_index is None:
+        return {"enabled": False}
+    return {"enabled": True, "trusted": _cache_listener_connected, **balance_index.get_stats(), **balance_index_stats}
+
+def get_user_bloom_stats() -> dict:
+    """Метрики фильтра Блума: заполнение, память и доля ложноположительных ответов."""
+    if user_bloom is None:
+        return {"enabled": False}
+    return {"enabled": True, "trusted": _cache_listener_connected, **user_bloom.get_stats()}
 
 def invalidate_cache(user_id: int) -> None:
     """Инвалидировать кэш пользователя"""
@@ -70,77 +314,151 @@ def invalidate_cache(user_id: int) -> None:
 
 async def get_pool():
     """Получить пул соединений с базой данных."""
-    global _pool
+    global _pool, pool_supervisor
     if _pool is None:
         try:
             # Оптимизированные настройки для высокой нагрузки
             _pool = await asyncpg.create_pool(
                 PG_CONNECTION_STRING, 
-                min_size=5,       # Увеличиваем минимальное количество соединений для обслуживания большего количества пользователей
-                max_size=20,      # Увеличиваем максимум для большего параллелизма
-                command_timeout=5,   # Уменьшаем таймаут, чтобы не блокировать соединения надолго
-                max_inactive_connection_lifetime=60,  # Дольше держим соединения для сокращения накладных расходов
+                min_size=DB_POOL_MIN_SIZE,       # Минимальное количество соединений для обслуживания большего количества пользователей
+                max_size=DB_POOL_MAX_SIZE,       # Максимум для большего параллелизма
+                command_timeout=DB_COMMAND_TIMEOUT,   # Короткий таймаут, чтобы не блокировать соединения надолго
+                timeout=DB_CONNECT_TIMEOUT,           # Не ждать установки соединения дольше этого времени
+                max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,  # Простаивающие соединения закрываются
                 server_settings={'application_name': 'telegram-ghibli-bot'}  # Добавляем идентификацию приложения
             )
+            # Супервизор подстраивает лимит соединений, проверяет их и размыкает цепь при сбоях
+            pool_supervisor = PoolSupervisor(_pool, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE)
+            pool_supervisor.start()
             logger.info(f"Создан оптимизированный пул соединений с базой данных PostgreSQL")
         except Exception as e:
             logger.error(f"Ошибка при создании пула соединений с PostgreSQL: {e}")
             raise
     return _pool
 
+@asynccontextmanager
+async def acquire(timeout: float = ACQUIRE_TIMEOUT):
+    """
+    Взять соединение из пула через супервизор.
+
+    Во время недоступности БД сразу выбрасывает DatabaseUnavailable вместо
+    ожидания таймаута на каждом запросе.
+    """
+    if pool_supervisor is not None and pool_supervisor.breaker.state == "open":
+        # Не пытаемся создавать пул, пока цепь разомкнута
+        pool_supervisor.breaker.before_call()
+    await get_pool()
+    async with pool_supervisor.acquire(timeout) as connection:
+        yield connection
+
+def replica_usable() -> bool:
+    """Реплика подключена, цепь замкнута и отставание в пределах REPLICA_MAX_LAG."""
+    return (
+        replica_supervisor is not None
+        and replica_supervisor.breaker.state != "open"
+        and _replica_lag is not None
+        and _replica_lag <= REPLICA_MAX_LAG
+    )
+
+@asynccontextmanager
+async def acquire_read(timeout: float = ACQUIRE_TIMEOUT):
+    """
+    Взять соединение для запросов только на чтение.
+
+    Если реплика настроена и не отстает, соединение берется из ее пула, иначе
+    из основного. Запросы, после которых меняется баланс, должны использовать acquire().
+    """
+    if replica_usable():
+        replica_stats['reads'] += 1
+        async with replica_supervisor.acquire(timeout) as connection:
+            yield connection
+    else:
+        replica_stats['primary_reads'] += 1
+        async with acquire(timeout) as connection:
+            yield connection
+
+async def _check_replica_lag() -> None:
+    """Измерить отставание реплики; при ошибке реплика не используется до следующей проверки."""
+    global _replica_lag
+    replica_stats['lag_checks'] += 1
+    try:
+        async with _replica_pool.acquire(timeout=ACQUIRE_TIMEOUT) as conn:
+            # Если все полученные WAL уже применены, реплика не отстает, даже если
+            # последняя транзакция была давно (простаивающая основная база)
+            lag = await conn.fetchval('''
+                SELECT CASE
+                    WHEN NOT pg_is_in_recovery() THEN 0
+                    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                    ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                END
+            ''', timeout=ACQUIRE_TIMEOUT)
+        lag = float(lag)
+        if _replica_lag is not None and _replica_lag <= REPLICA_MAX_LAG < lag:
+            logger.warning(f"Отставание реплики {lag:.1f} с, чтения переключены на основную базу")
+        elif (_replica_lag is None or _replica_lag > REPLICA_MAX_LAG) and lag <= REPLICA_MAX_LAG:
+            logger.info(f"Отставание реплики {lag:.1f} с, чтения идут на реплику")
+        _replica_lag = lag
+    except Exception as e:
+        replica_stats['lag_failures'] += 1
+        if _replica_lag is not None:
+            logger.warning(f"Реплика недоступна, чтения переключены на основную базу: {e}")
+        _replica_lag = None
+
+async def _replica_lag_loop() -> None:
+    while True:
+        await _check_replica_lag()
+        await asyncio.sleep(REPLICA_LAG_CHECK_INTERVAL)
+
+async def _start_replica() -> None:
+    """Создать пул реплики и запустить контроль отставания, если задан DATABASE_REPLICA_URL."""
+    global _replica_pool, replica_supervisor, _replica_lag_task
+    if not DATABASE_REPLICA_URL or _replica_pool is not None:
+        return
+    try:
+        _replica_pool = await asyncpg.create_pool(
+            DATABASE_REPLICA_URL,
+            min_size=1,
+            max_size=DB_REPLICA_POOL_MAX_SIZE,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            timeout=DB_CONNECT_TIMEOUT,
+            max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+            server_settings={'application_name': 'telegram-ghibli-bot-replica'}
+        )
+    except Exception as e:
+        # Без реплики все запросы просто идут на основную базу
+        logger.error(f"Не удалось подключиться к реплике, чтения идут на основную базу: {e}")
+        return
+    replica_supervisor = PoolSupervisor(_replica_pool, 1, DB_REPLICA_POOL_MAX_SIZE, name="replica")
+    replica_supervisor.start()
+    _replica_lag_task = asyncio.create_task(_replica_lag_loop())
+    logger.info("Создан пул соединений с репликой PostgreSQL")
+
+def get_pool_stats() -> dict:
+    """Метрики пулов соединений: загрузка, ожидание, лимит, состояние цепи и отставание реплики."""
+    stats = pool_supervisor.get_stats() if pool_supervisor is not None else {}
+    if replica_supervisor is not None:
+        stats['replica'] = {**replica_supervisor.get_stats(), **replica_stats, 'lag_s': _replica_lag}
+    return stats
+
 async def init_db():
-    """Инициализировать базу данных и создать необходимые таблицы."""
+    """Инициализировать базу данных: применить миграции схемы и запустить фоновые задачи."""
     try:
+        # Миграции выполняются на отдельном соединении; при актуальной схеме это один запрос
+        from migrations import run_migrations
+        await run_migrations()
+        
         # Создаем пул соединений, если его еще нет
-        pool = await get_pool()
+        await get_pool()
+        await _start_replica()
+        logger.info("\u0411аза данных успешно инициализирована")
         
-        async with pool.acquire() as conn:
-            # Создаем таблицу пользователей, если ее нет
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id BIGINT PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    balance INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    last_generation TIMESTAMP,
-                    total_generations INTEGER DEFAULT 0
-                )
-            ''')
-            
-            # Создаем таблицу для истории изменений баланса
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS balance_history (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT REFERENCES users(user_id),
-                    amount INTEGER NOT NULL,
-                    operation_type TEXT NOT NULL,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Создаем таблицу для логирования действий пользователей (для фоновых задач)
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS user_actions (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT REFERENCES users(user_id),
-                    action TEXT NOT NULL,
-                    details JSONB,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            # Создаем таблицу для статистики бота
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS bot_stats (
-                    stat_name TEXT PRIMARY KEY,
-                    value INTEGER DEFAULT 0,
-                    last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
-            logger.info("\u0411аза данных успешно инициализирована")
+        # Секции user_actions на ближайшие месяцы и удаление устаревших
+        await maintain_user_actions_partitions()
+        _start_partition_maintenance()
+        
+        # Согласованность кэша балансов между экземплярами через LISTEN/NOTIFY
+        _start_cache_listener()
+        _start_index_reconcile()
             
         # Запускаем обработчик фоновых задач
         await start_background_worker()
@@ -153,24 +471,170 @@ async def init_db():
         logger.error(f"Ошибка при инициализации базы данных: {e}")
         return False
 
+def _month_start(moment: datetime) -> datetime:
+    return datetime(moment.year, moment.month, 1)
+
+def _next_month(moment: datetime) -> datetime:
+    return datetime(moment.year + moment.month // 12, moment.month % 12 + 1, 1)
+
+async def ensure_user_actions_partitions(conn, start: Optional[datetime] = None,
+                                         end: Optional[datetime] = None) -> int:
+    """
+    Создать помесячные секции user_actions для диапазона дат.
+
+    По умолчанию создаются секции с текущего месяца на USER_ACTIONS_PARTITIONS_AHEAD месяцев вперед.
+
+    Returns:
+        int: Количество созданных секций
+    """
+    month = _month_start(start or datetime.now())
+    if end is None:
+        end = month
+        for _ in range(USER_ACTIONS_PARTITIONS_AHEAD):
+            end = _next_month(end)
+
+    existing = {row['name'] for row in await conn.fetch('''
+        SELECT c.relname AS name FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'user_actions'::regclass
+    ''')}
+
+    created = 0
+    while month <= end:
+        upper = _next_month(month)
+        name = f"user_actions_{month:%Y_%m}"
+        if name not in existing:
+            await conn.execute(f'''
+                CREATE TABLE IF NOT EXISTS {name} PARTITION OF user_actions
+                FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{upper:%Y-%m-%d}')
+            ''')
+            created += 1
+        month = upper
+
+    if created:
+        logger.info(f"Создано секций user_actions: {created}")
+    return created
+
+async def prune_user_actions_partitions(conn, retention_months: int) -> int:
+    """
+    Удалить секции user_actions старше срока хранения.
+
+    Returns:
+        int: Количество удаленных секций
+    """
+    if retention_months <= 0:
+        return 0
+
+    cutoff = _month_start(datetime.now())
+    for _ in range(retention_months):
+        cutoff = datetime(cutoff.year - (1 if cutoff.month == 1 else 0), (cutoff.month - 2) % 12 + 1, 1)
+
+    rows = await conn.fetch('''
+        SELECT c.relname AS name FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'user_actions'::regclass
+    ''')
+    dropped = 0
+    for row in rows:
+        match = _PARTITION_NAME.match(row['name'])
+        if not match:
+            continue  # секция по умолчанию
+        if datetime(int(match.group(1)), int(match.group(2)), 1) < cutoff:
+            await conn.execute(f"DROP TABLE IF EXISTS {row['name']}")
+            dropped += 1
+
+    if dropped:
+        logger.info(f"Удалено устаревших секций user_actions: {dropped}")
+    return dropped
+
+async def maintain_user_actions_partitions() -> None:
+    """Создать секции на ближайшие месяцы и удалить устаревшие."""
+    try:
+        async with acquire() as conn:
+            await ensure_user_actions_partitions(conn)
+            await prune_user_actions_partitions(conn, USER_ACTIONS_RETENTION_MONTHS)
+    except Exception as e:
+        logger.error(f"Ошибка при обслуживании секций user_actions: {e}")
+
+async def _partition_maintenance_loop() -> None:
+    """Раз в сутки обслуживать секции user_actions."""
+    try:
+        while True:
+            await asyncio.sleep(24 * 3600)
+            await maintain_user_actions_partitions()
+    except asyncio.CancelledError:
+        pass
+
+async def single_flight(key, factory: Callable[[], Awaitable[Any]]) -> Any:
+    """
+    Объединить одновременные одинаковые запросы в один.
+
+    Первый вызов с ключом запускает factory() отдельной задачей, остальные вызовы
+    с тем же ключом до ее завершения ждут тот же результат. Отмена одного из
+    ожидающих не отменяет общий запрос.
+
+    Args:
+        key: Ключ запроса, например ('balance', user_id)
+        factory: Функция без аргументов, возвращающая корутину запроса
+    """
+    task = _in_flight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(factory())
+        _in_flight[key] = task
+
+        def _done(finished, key=key):
+            if _in_flight.get(key) is finished:
+                del _in_flight[key]
+        task.add_done_callback(_done)
+        single_flight_stats['leaders'] += 1
+    else:
+        single_flight_stats['joined'] += 1
+    return await asyncio.shield(task)
+
 async def get_user_balance(user_id):
-    """Асинхронно получить баланс пользователя с использованием кэша."""
-    # Сначала проверяем кэш
+    """Асинхронно получить баланс пользователя из индекса в памяти или с использованием кэша."""
+    # Индекс балансов актуален, пока активна подписка на уведомления
+    balance = indexed_balance(user_id)
+    if balance is not None:
+        return balance
+    
+    # Затем проверяем кэш
     cached_balance = get_from_cache(user_id, 'balance')
     if cached_balance is not None:
         return cached_balance
+    if user_definitely_missing(user_id):
+        return 0
         
-    # Если данных нет в кэше, запрашиваем из БД
+    # Если данных нет в кэше, запрашиваем из БД; одновременные промахи по одному
+    # пользователю разделяют один запрос
+    return await single_flight(('balance', user_id), lambda: _fetch_user_balance(user_id))
+
+async def _fetch_user_row(query, user_id):
+    """
+    Прочитать строку users по user_id, по возможности с реплики.
+
+    Отсутствие строки на реплике перепроверяется на основной базе: реплика могла
+    еще не получить только что созданного пользователя.
+    """
+    async with acquire_read() as conn:
+        row = await conn.fetchrow(query, user_id)
+    if row is None and DATABASE_REPLICA_URL:
+        async with acquire() as conn:
+            row = await conn.fetchrow(query, user_id)
+    return row
+
+async def _fetch_user_balance(user_id):
+    """Прочитать баланс из БД и положить его в кэш."""
     try:
-        pool = await get_pool()
-        async with pool.acquire() as connection:
-            query = "SELECT balance FROM users WHERE user_id = $1"
-            row = await connection.fetchrow(query, user_id)
-            balance = row['balance'] if row else 0
-            
-            # Кэшируем полученное значение
-            update_cache(user_id, 'balance', balance)
-            return balance
+        row = await _fetch_user_row("SELECT balance FROM users WHERE user_id = $1", user_id)
+        balance = row['balance'] if row else 0
+        if row is None:
+            _bloom_miss(user_id)
+        
+        # Кэшируем полученное значение и заодно факт существования пользователя
+        update_cache(user_id, 'balance', balance)
+        update_cache(user_id, 'exists', row is not None)
+        return balance
     except Exception as e:
         logger.error(f"Ошибка при получении баланса пользователя {user_id}: {e}")
         return 0
@@ -187,53 +651,82 @@ async def check_balance_sufficient(user_id, cost=1):
         return False
 
 async def create_user(user_id, username=None, first_name=None, last_name=None):
-    """Асинхронно создать нового пользователя с обновлением кэша."""
+    """
+    Асинхронно создать пользователя или обновить его данные за одно обращение к БД.
+
+    Новый пользователь получает начальный баланс и запись 'initial' в истории баланса.
+    Если имя пользователя не изменилось, строка users не перезаписывается.
+
+    Returns:
+        int: Текущий баланс пользователя
+    """
     try:
-        pool = await get_pool()
-        async with pool.acquire() as conn:
-            # Проверяем, существует ли пользователь
-            user_exists = await conn.fetchval('SELECT COUNT(1) FROM users WHERE user_id = $1', user_id)
-            
-            if not user_exists:
-                # Создаем нового пользователя с начальным балансом 20 звезд
-                # Это позволит пользователю сразу попробовать больше стилей и возможностей бота
-                initial_balance = 20
-                
-                await conn.execute('''
-                    INSERT INTO users(user_id, username, first_name, last_name, balance, created_at, total_generations) 
+        async with acquire() as conn:
+            # Начальный баланс позволяет сразу попробовать несколько стилей.
+            # xmax = 0 означает, что строка только что вставлена, а не обновлена
+            row = await conn.fetchrow('''
+                WITH upserted AS (
+                    INSERT INTO users(user_id, username, first_name, last_name, balance, created_at, total_generations)
                     VALUES($1, $2, $3, $4, $5, CURRENT_TIMESTAMP, 0)
-                ''', user_id, username, first_name, last_name, initial_balance)
-                
-                # Кэшируем баланс нового пользователя
-                update_cache(user_id, 'balance', initial_balance)
-                
-                logger.info(f"Создан новый пользователь {user_id} {username} {first_name} {last_name} с балансом {initial_balance} звезд")
-                
-                # Добавляем запись в историю баланса
-                await conn.execute('''
+                    ON CONFLICT (user_id) DO UPDATE
+                        SET username = EXCLUDED.username,
+                            first_name = EXCLUDED.first_name,
+                            last_name = EXCLUDED.last_name
+                        WHERE (users.username, users.first_name, users.last_name)
+                            IS DISTINCT FROM (EXCLUDED.username, EXCLUDED.first_name, EXCLUDED.last_name)
+                    RETURNING user_id, balance, username, first_name, last_name, total_generations, created_at,
+                        (xmax = 0) AS inserted
+                ), history AS (
                     INSERT INTO balance_history(user_id, amount, operation_type, timestamp)
-                    VALUES($1, $2, 'initial', CURRENT_TIMESTAMP)
-                ''', user_id, initial_balance)
-                
-                return initial_balance
-            else:
-                # Пользователь уже существует, обновляем данные
-                await conn.execute('''
-                    UPDATE users 
-                    SET username = $2, first_name = $3, last_name = $4
-                    WHERE user_id = $1
-                ''', user_id, username, first_name, last_name)
-                
-                logger.info(f"Обновлены данные пользователя {user_id} {username} {first_name} {last_name}")
-                
-                # Используем кэшированную функцию для получения баланса
-                return await get_user_balance(user_id)
+                    SELECT $1, $5, 'initial', CURRENT_TIMESTAMP
+                    FROM upserted WHERE inserted
+                )
+                SELECT * FROM upserted
+                UNION ALL
+                SELECT user_id, balance, username, first_name, last_name, total_generations, created_at, FALSE
+                FROM users
+                WHERE user_id = $1 AND NOT EXISTS (SELECT 1 FROM upserted)
+            ''', user_id, username, first_name, last_name, INITIAL_BALANCE)
+
+        if row is None:
+            # Строку вставила параллельная транзакция уже после начала запроса
+            invalidate_cache(user_id)
+            return await get_user_balance(user_id)
+
+        balance = row['balance']
+        cache_profile(row)
+        record_balance(user_id, balance)
+        if row['inserted']:
+            logger.info(f"Создан новый пользователь {user_id} {username} {first_name} {last_name} с балансом {balance} звезд")
+        return balance
     except Exception as e:
         logger.error(f"Ошибка при создании/обновлении пользователя {user_id}: {e}")
         # Инвалидируем кэш в случае ошибки
         invalidate_cache(user_id)
         return 0
 
+class InsufficientBalance(Exception):
+    """Списание не применено: на балансе пользователя недостаточно звезд."""
+
+    def __init__(self, user_id: int, amount: int):
+        super().__init__(f"Недостаточно звезд у пользователя {user_id} для списания {-amount}")
+        self.user_id = user_id
+        self.amount = amount
+
+# Изменение баланса и запись в историю одним запросом; списание применяется,
+# только если баланс не уходит в минус (проверка и списание атомарны)
+UPDATE_BALANCE_QUERY = """
+    WITH updated AS (
+        UPDATE users SET balance = balance + $2
+        WHERE user_id = $1 AND ($2 >= 0 OR balance + $2 >= 0)
+        RETURNING balance
+    ), history AS (
+        INSERT INTO balance_history (user_id, amount, operation_type, timestamp)
+        SELECT $1, abs($2), $3, $4 FROM updated
+    )
+    SELECT balance FROM updated
+"""
+
 async def update_user_balance(user_id, amount):
     """
     Асинхронно обновить баланс пользователя с обновлением кэша.
@@ -243,81 +736,133 @@ async def update_user_balance(user_id, amount):
         amount: Сумма для добавления (положительное число) или списания (отрицательное число)
     
     Returns:
-        int: Новый баланс пользователя
+        int: Новый баланс пользователя или None, если изменение не применено
+            (пользователь не найден или БД недоступна)
+    
+    Raises:
+        InsufficientBalance: списание больше текущего баланса (баланс не изменен)
     """
     try:
-        pool = await get_pool()
-        async with pool.acquire() as connection:
-            # Используем транзакцию для обеспечения атомарности операции
-            async with connection.transaction():
-                # Получаем текущий баланс (не используем кэш для надежности)
-                current_balance_query = "SELECT balance FROM users WHERE user_id = $1"
-                row = await connection.fetchrow(current_balance_query, user_id)
-                
-                if row:
-                    # Пользователь существует - обновляем баланс
-                    current_balance = row['balance']
-                    new_balance = current_balance + amount
-                    
-                    # Обновляем запись в базе данных
-                    update_query = """
-                    UPDATE users 
-                    SET balance = $1
-                    WHERE user_id = $2
-                    """
-                    await connection.execute(update_query, new_balance, user_id)
-                    
-                    # Обновляем значение в кэше
-                    update_cache(user_id, 'balance', new_balance)
-                    
-                    # Логируем транзакцию
-                    log_query = """
-                    INSERT INTO balance_history (user_id, amount, operation_type, timestamp)
-                    VALUES ($1, $2, $3, $4)
-                    """
-                    operation_type = "add" if amount > 0 else "subtract"
-                    await connection.execute(log_query, user_id, abs(amount), operation_type, datetime.now())
-                    
-                    return new_balance
-                else:
-                    # Такого не должно быть, так как мы создаем пользователя при первом взаимодействии
-                    logger.error(f"Попытка обновить баланс для несуществующего пользователя: {user_id}")
-                    return 0
+        async with acquire() as connection:
+            operation_type = "add" if amount > 0 else "subtract"
+            new_balance = await connection.fetchval(
+                UPDATE_BALANCE_QUERY, user_id, amount, operation_type, datetime.now()
+            )
+            if new_balance is None:
+                if await connection.fetchval("SELECT 1 FROM users WHERE user_id = $1", user_id):
+                    raise InsufficientBalance(user_id, amount)
+                # Такого не должно быть, так как мы создаем пользователя при первом взаимодействии
+                logger.error(f"Попытка обновить баланс для несуществующего пользователя: {user_id}")
+                return None
+        
+        # Кэш и индекс балансов обновляются только после фиксации изменения
+        record_balance(user_id, new_balance)
+        return new_balance
+    except InsufficientBalance:
+        # Баланс в кэше мог устареть - перечитаем его при следующем запросе
+        invalidate_cache(user_id)
+        raise
     except Exception as e:
-        logger.error(f"Ошибка при обновлении баланса пользователя {user_id}: {e}")
-        # Инвалидируем кэш в случае ошибки
+        logger.error(f"Ошибка при обновлении баланса пользователя {user_id} на {amount}: {e}")
+        # Инвалидируем кэш в случае ошибки; вызывающий код решает, повторять ли операцию
         invalidate_cache(user_id)
-        return await get_user_balance(user_id)  # Возвращаем текущий баланс в случае ошибки
+        return None
+
+async def get_user(user_id) -> Optional[UserProfile]:
+    """Асинхронно получить профиль пользователя по user_id (из кэша, если он загружен целиком)."""
+    profile = user_cache.get(user_id)
+    if profile is not None:
+        age = time.time() - profile.last_updated
+        if profile.complete and age < _cache_ttl():
+            cache_stats['hits'] += 1
+            return profile
+        # Триггер уведомляет и о новых пользователях (record_balance снимет отметку),
+        # поэтому отрицательный ответ живет столько же, сколько и профиль
+        if profile.exists is False and age < _cache_ttl():
+            cache_stats['hits'] += 1
+            return None
+    if user_definitely_missing(user_id):
+        return None
+    cache_stats['misses'] += 1
+    return await single_flight(('user', user_id), lambda: _fetch_user(user_id))
 
-async def get_user(user_id):
-    """Асинхронно получить данные пользователя по user_id."""
+async def _fetch_user(user_id) -> Optional[UserProfile]:
+    """Прочитать профиль пользователя из БД и положить его в кэш."""
     try:
-        pool = await get_pool()
-        async with pool.acquire() as conn:
-            user = await conn.fetchrow('SELECT * FROM users WHERE user_id = $1', user_id)
-            return user
+        started = time.time()
+        row = await _fetch_user_row(f'SELECT {PROFILE_COLUMNS} FROM users WHERE user_id = $1', user_id)
+        if row is None:
+            _bloom_miss(user_id)
+            # Уведомление о вставке могло прийти, пока шел запрос - не затираем его
+            profile = user_cache.get(user_id)
+            if profile is None or not profile.exists or profile.last_updated < started:
+                update_cache(user_id, 'exists', False)
+            return None
+        return cache_profile(row)
     except Exception as e:
         logger.error(f"Ошибка при получении данных пользователя {user_id}: {e}")
         return None
 
-async def get_user_stats():
-    """Асинхронно получить статистику по пользователям."""
+async def user_exists(user_id) -> bool:
+    """
+    Проверить, зарегистрирован ли пользователь.
+
+    Пользователи не удаляются в обычной работе (удаление приходит через NOTIFY
+    и сбрасывает кэш), поэтому положительный ответ из кэша не устаревает.
+    """
+    profile = user_cache.get(user_id)
+    if profile is not None and profile.exists:
+        cache_stats['hits'] += 1
+        return True
+    return await get_user(user_id) is not None
+
+# Сводка по пользователям, которую пересчитывает stats.py
+USER_STATS_ROLLUP = ('total_users', 'total_generations', 'avg_balance')
+
+async def refresh_user_stats_rollup():
+    """Пересчитать сводку по пользователям в stats_rollup (по расписанию, а не на каждый запрос)."""
     try:
-        pool = await get_pool()
-        async with pool.acquire() as conn:
-            stats = await conn.fetch('''
-                SELECT 
-                    COUNT(1) as total_users,
-                    SUM(total_generations) as total_generations,
-                    AVG(balance) as avg_balance
-                FROM users
+        async with acquire() as conn:
+            await conn.execute('''
+                WITH totals AS (
+                    SELECT COUNT(1) AS total_users,
+                           COALESCE(SUM(total_generations), 0) AS total_generations,
+                           COALESCE(AVG(balance), 0) AS avg_balance
+                    FROM users
+                )
+                INSERT INTO stats_rollup (name, value, refreshed_at)
+                SELECT name, value, CURRENT_TIMESTAMP FROM totals,
+                    LATERAL (VALUES ('total_users', total_users::float8),
+                                    ('total_generations', total_generations::float8),
+                                    ('avg_balance', avg_balance::float8)) AS v(name, value)
+                ON CONFLICT (name) DO UPDATE SET value = EXCLUDED.value, refreshed_at = EXCLUDED.refreshed_at
             ''')
-            
-            return {
-                'total_users': stats[0]['total_users'] or 0,
-                'total_generations': stats[0]['total_generations'] or 0,
-                'avg_balance': round(stats[0]['avg_balance'] or 0, 2)
-            }
+            return True
+    except Exception as e:
+        logger.error(f"Ошибка при пересчете сводки по пользователям: {e}")
+        return False
+
+async def get_user_stats():
+    """Асинхронно получить статистику по пользователям из заранее посчитанной сводки."""
+    try:
+        query = 'SELECT name, value FROM stats_rollup WHERE name = ANY($1::text[])'
+        async with acquire_read() as conn:
+            rows = await conn.fetch(query, list(USER_STATS_ROLLUP))
+        if len(rows) < len(USER_STATS_ROLLUP):
+            # Сводка еще не посчитана (первый запуск) - считаем один раз сейчас
+            # и читаем с основной базы, куда она только что записана
+            await refresh_user_stats_rollup()
+            async with acquire() as conn:
+                rows = await conn.fetch(query, list(USER_STATS_ROLLUP))
+            if len(rows) < len(USER_STATS_ROLLUP):
+                raise RuntimeError("сводка по пользователям недоступна")
+        
+        values = {row['name']: row['value'] for row in rows}
+        return {
+            'total_users': int(values['total_users']),
+            'total_generations': int(values['total_generations']),
+            'avg_balance': round(values['avg_balance'], 2)
+        }
     except Exception as e:
         logger.error(f"Ошибка при получении статистики пользователей: {e}")
         return {
@@ -333,14 +878,11 @@ async def process_background_tasks():
     try:
         logger.info("Запущен обработчик фоновых задач с БД")
         while True:
+            # Ждем новую задачу из очереди
+            task = await background_tasks.get()
             try:
-                # Ждем новую задачу из очереди
-                task = await background_tasks.get()
                 task_type, data = task
                 
-                # Получаем пул соединений
-                pool = await get_pool()
-                
                 # Обрабатываем задачу в зависимости от типа
                 if task_type == "log_action":
                     # Логирование действия пользователя
@@ -348,7 +890,7 @@ async def process_background_tasks():
                     action = data.get("action")
                     details = data.get("details")
                     
-                    async with pool.acquire() as conn:
+                    async with acquire() as conn:
                         await conn.execute(
                             "INSERT INTO user_actions (user_id, action, details, timestamp) VALUES ($1, $2, $3, $4)",
                             user_id, action, details, datetime.now()
@@ -357,7 +899,7 @@ async def process_background_tasks():
                         
                 elif task_type == "update_stats":
                     # Обновление статистики
-                    async with pool.acquire() as conn:
+                    async with acquire() as conn:
                         # Обновляем статистику
                         await conn.execute(
                             "UPDATE bot_stats SET value = value + 1 WHERE stat_name = $1",
@@ -365,12 +907,12 @@ async def process_background_tasks():
                         )
                         logger.debug(f"Обновлена статистика: {data.get('stat_name')}")
                 
-                # Отметить задачу как выполненную
-                background_tasks.task_done()
-                
             except Exception as e:
                 logger.error(f"Ошибка при обработке фоновой задачи: {e}")
                 # Не прерываем цикл при ошибке
+            finally:
+                # Отметить задачу как выполненную (и при ошибке, чтобы close_pool не ждал ее)
+                background_tasks.task_done()
     except asyncio.CancelledError:
         logger.info("Обработчик фоновых задач остановлен")
 
@@ -405,12 +947,111 @@ async def start_background_worker():
     _background_worker_task.add_done_callback(lambda _: None)
 
 
-async def close_pool():
-    """Закрыть пул соединений с базой данных."""
-    global _pool, _background_worker_task
+def _start_partition_maintenance():
+    """Запустить ежедневное обслуживание секций user_actions."""
+    global _partition_task
+    if _partition_task is None or _partition_task.done():
+        _partition_task = asyncio.create_task(_partition_maintenance_loop())
+
+def _on_balance_notification(connection, pid, channel, payload) -> None:
+    """Обработать уведомление об изменении баланса из триггера users."""
+    try:
+        data = json.loads(payload)
+        user_id = int(data['user_id'])
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Некорректное уведомление {channel}: {payload} ({e})")
+        return
+    cache_stats['notifications'] += 1
+    if data.get('balance') is None:
+        forget_user(user_id)
+    else:
+        # Уведомление приходит и о новых пользователях, в том числе из других экземпляров
+        record_balance(user_id, data['balance'])
+
+async def _cache_listener_loop() -> None:
+    """
+    Держать отдельное соединение с LISTEN на канал изменений баланса.
+
+    При потере соединения уведомления могли быть пропущены, поэтому кэш
+    очищается целиком, а TTL возвращается к короткому до переподключения.
+    """
+    global _cache_listener_connected
+    delay = 1
+    while True:
+        connection = None
+        try:
+            connection = await asyncpg.connect(PG_CONNECTION_STRING)
+            lost = asyncio.Event()
+            connection.add_termination_listener(lambda _: lost.set())
+            await connection.add_listener(BALANCE_CHANNEL, _on_balance_notification)
+            
+            # Изменения между потерей соединения и новым LISTEN могли пройти мимо
+            user_cache.clear()
+            await rebuild_user_indexes()
+            _cache_listener_connected = True
+            delay = 1
+            logger.info(f"Подписка на уведомления {BALANCE_CHANNEL} активна, TTL кэша {CACHE_TTL_WITH_NOTIFY} с")
+            
+            # asyncpg не всегда замечает обрыв без запросов, поэтому периодически проверяем соединение
+            while not lost.is_set():
+                try:
+                    await asyncio.wait_for(lost.wait(), timeout=30)
+                except asyncio.TimeoutError:
+                    await connection.execute('SELECT 1', timeout=10)
+        except asyncio.CancelledError:
+            _cache_listener_connected = False
+            if connection is not None and not connection.is_closed():
+                await connection.close()
+            raise
+        except Exception as e:
+            logger.warning(f"Подписка на уведомления {BALANCE_CHANNEL} потеряна: {e}")
+        
+        _cache_listener_connected = False
+        user_cache.clear()
+        cache_stats['reconnects'] += 1
+        if connection is not None and not connection.is_closed():
+            connection.terminate()
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 60)
+
+def _start_cache_listener():
+    """Запустить подписку на изменения баланса."""
+    global _cache_listener_task
+    if _cache_listener_task is None or _cache_listener_task.done():
+        _cache_listener_task = asyncio.create_task(_cache_listener_loop())
+
+async def close_pool(drain_timeout: float = 5):
+    """
+    Закрыть пул соединений с базой данных.
+
+    Args:
+        drain_timeout: Сколько ждать записи накопленных фоновых задач (действий пользователей)
+    """
+    global _pool, pool_supervisor, _background_worker_task
+    global _replica_pool, replica_supervisor, _replica_lag
+    
+    if _partition_task and not _partition_task.done():
+        _partition_task.cancel()
+    
+    for task in (_index_rebuild_task, _index_reconcile_task):
+        if task and not task.done():
+            task.cancel()
     
-    # Останавливаем фоновую задачу, если она запущена
+    # Останавливаем подписку на изменения баланса
+    if _cache_listener_task and not _cache_listener_task.done():
+        _cache_listener_task.cancel()
+        try:
+            await _cache_listener_task
+        except asyncio.CancelledError:
+            pass
+    
+    # Останавливаем фоновую задачу, если она запущена, дописав накопленную очередь
     if _background_worker_task and not _background_worker_task.done():
+        if background_tasks.qsize():
+            try:
+                await asyncio.wait_for(background_tasks.join(), drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Не записано фоновых задач при остановке: {background_tasks.qsize()}")
         _background_worker_task.cancel()
         try:
             await _background_worker_task
@@ -418,6 +1059,19 @@ async def close_pool():
             pass
             
     # Закрываем пул соединений
+    if _replica_lag_task and not _replica_lag_task.done():
+        _replica_lag_task.cancel()
+    if replica_supervisor is not None:
+        await replica_supervisor.stop()
+        replica_supervisor = None
+    if _replica_pool:
+        await _replica_pool.close()
+        _replica_pool = None
+        _replica_lag = None
+    
+    if pool_supervisor is not None:
+        await pool_supervisor.stop()
+        pool_supervisor = None
     if _pool:
         await _pool.close()
         _pool = None
@@ -2,6 +2,8 @@
 Скрипт для миграции данных из SQLite в PostgreSQL.
 """
 import os
+import sys
+import time
 import sqlite3
 import asyncio
 import asyncpg
@@ -42,94 +44,158 @@ elif DATABASE_URL and DATABASE_URL != "None" and DATABASE_URL != "":
 SQLITE_DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'users.db')
 
 async def create_pg_tables():
-    """Создать таблицы в PostgreSQL базе данных."""
+    """Создать таблицы в PostgreSQL через версионированные миграции (ту же схему, что использует бот)."""
     try:
-        connection = await asyncpg.connect(PG_CONNECTION_STRING)
-        
-        # Создаем таблицу users, аналогичную той, что в SQLite, но с учетом типов PostgreSQL
-        await connection.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT UNIQUE NOT NULL,
-                username VARCHAR(255),
-                first_name VARCHAR(255),
-                last_name VARCHAR(255),
-                balance INTEGER DEFAULT 0,
-                total_generations INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_generation TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-            
-            -- Создаем индекс для более быстрого поиска по user_id
-            CREATE INDEX IF NOT EXISTS idx_users_user_id ON users (user_id);
-        ''')
-        
-        logger.info("Таблицы в PostgreSQL успешно созданы")
-        await connection.close()
+        from migrations import run_migrations
+        applied = await run_migrations(PG_CONNECTION_STRING)
+        logger.info(f"Таблицы в PostgreSQL готовы, применено миграций: {applied}")
         return True
     except Exception as e:
         logger.error(f"Ошибка при создании таблиц в PostgreSQL: {e}")
         return False
 
-async def migrate_data():
-    """Мигрировать данные из SQLite в PostgreSQL."""
+# Размер пакета при переносе пользователей из SQLite
+MIGRATION_BATCH_SIZE = int(os.getenv("MIGRATION_BATCH_SIZE", "5000"))
+# Имя контрольной точки в таблице migration_checkpoints
+CHECKPOINT_NAME = "sqlite_users"
+
+USER_COLUMNS = ['user_id', 'username', 'first_name', 'last_name', 'balance',
+                'total_generations', 'created_at', 'last_generation']
+
+def _parse_timestamp(value):
+    """Преобразовать дату из SQLite, подставляя текущее время для некорректных значений."""
+    try:
+        return datetime.fromisoformat(value) if value else datetime.now()
+    except (ValueError, TypeError):
+        return datetime.now()
+
+def _to_record(row):
+    """Строка SQLite -> запись для COPY в PostgreSQL."""
+    user_id, username, first_name, last_name, balance, total_generations, created_at, last_generation = row
+    return (
+        user_id, username or "", first_name or "", last_name or "",
+        balance or 0, total_generations or 0,
+        _parse_timestamp(created_at), _parse_timestamp(last_generation),
+    )
+
+async def migrate_data(batch_size: int = MIGRATION_BATCH_SIZE, restart: bool = False):
+    """
+    Потоково перенести пользователей из SQLite в PostgreSQL.
+
+    Пользователи читаются из SQLite пакетами по возрастанию user_id. Каждый пакет
+    загружается через COPY во временную таблицу и одним запросом сливается в users;
+    в той же транзакции сохраняется контрольная точка, поэтому прерванный перенос
+    продолжается с последнего пакета. Память не зависит от размера базы.
+
+    Args:
+        batch_size: Размер пакета
+        restart: Начать перенос заново, игнорируя контрольную точку
+    """
+    sqlite_conn = None
+    pg_conn = None
     try:
         # Подключаемся к SQLite
         sqlite_conn = sqlite3.connect(SQLITE_DB_PATH)
-        sqlite_cursor = sqlite_conn.cursor()
-        
-        # Получаем всех пользователей из SQLite
-        sqlite_cursor.execute('SELECT user_id, username, first_name, last_name, balance, total_generations, created_at, last_generation FROM users')
-        users_data = sqlite_cursor.fetchall()
-        
-        if not users_data:
+        total = sqlite_conn.execute('SELECT COUNT(1) FROM users').fetchone()[0]
+        if not total:
             logger.warning("Нет данных для миграции в SQLite базе")
-            sqlite_conn.close()
             return False
         
         # Подключаемся к PostgreSQL
         pg_conn = await asyncpg.connect(PG_CONNECTION_STRING)
+        await pg_conn.execute('''
+            CREATE TABLE IF NOT EXISTS migration_checkpoints (
+                name TEXT PRIMARY KEY,
+                last_key BIGINT NOT NULL,
+                rows_done BIGINT NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        # Временная таблица очищается после каждой транзакции пакета
+        await pg_conn.execute('''
+            CREATE TEMP TABLE users_import_staging (
+                user_id BIGINT,
+                username TEXT,
+                first_name TEXT,
+                last_name TEXT,
+                balance INTEGER,
+                total_generations INTEGER,
+                created_at TIMESTAMP,
+                last_generation TIMESTAMP
+            ) ON COMMIT DELETE ROWS
+        ''')
         
-        # Мигрируем данные каждого пользователя
-        for user in users_data:
-            user_id, username, first_name, last_name, balance, total_generations, created_at, last_generation = user
-            
-            # Формируем правильные даты или используем текущее время, если дата некорректная
-            try:
-                created_at_dt = datetime.fromisoformat(created_at) if created_at else datetime.now()
-            except (ValueError, TypeError):
-                created_at_dt = datetime.now()
-                
-            try:
-                last_generation_dt = datetime.fromisoformat(last_generation) if last_generation else datetime.now()
-            except (ValueError, TypeError):
-                last_generation_dt = datetime.now()
+        if restart:
+            await pg_conn.execute('DELETE FROM migration_checkpoints WHERE name = $1', CHECKPOINT_NAME)
+        checkpoint = await pg_conn.fetchrow(
+            'SELECT last_key, rows_done FROM migration_checkpoints WHERE name = $1', CHECKPOINT_NAME
+        )
+        last_key = checkpoint['last_key'] if checkpoint else None
+        rows_done = checkpoint['rows_done'] if checkpoint else 0
+        if checkpoint:
+            logger.info(f"Продолжаем миграцию с user_id > {last_key} (уже перенесено {rows_done})")
+        
+        cursor = sqlite_conn.cursor()
+        if last_key is None:
+            cursor.execute(f'SELECT {", ".join(USER_COLUMNS)} FROM users ORDER BY user_id')
+        else:
+            cursor.execute(f'SELECT {", ".join(USER_COLUMNS)} FROM users WHERE user_id > ? ORDER BY user_id', (last_key,))
+        
+        started = time.monotonic()
+        migrated_now = 0
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            records = [_to_record(row) for row in rows]
             
-            # Вставляем данные пользователя в PostgreSQL
-            await pg_conn.execute('''
-                INSERT INTO users (user_id, username, first_name, last_name, balance, total_generations, created_at, last_generation)
-                VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
-                ON CONFLICT (user_id) DO UPDATE SET
-                    username = $2,
-                    first_name = $3,
-                    last_name = $4,
-                    balance = $5,
-                    total_generations = $6,
-                    created_at = $7,
-                    last_generation = $8
-            ''', user_id, username or "", first_name or "", last_name or "", balance, total_generations, created_at_dt, last_generation_dt)
+            async with pg_conn.transaction():
+                await pg_conn.copy_records_to_table('users_import_staging', records=records, columns=USER_COLUMNS)
+                await pg_conn.execute('''
+                    INSERT INTO users (user_id, username, first_name, last_name, balance, total_generations, created_at, last_generation)
+                    SELECT DISTINCT ON (user_id) user_id, username, first_name, last_name, balance, total_generations, created_at, last_generation
+                    FROM users_import_staging
+                    ORDER BY user_id
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        username = EXCLUDED.username,
+                        first_name = EXCLUDED.first_name,
+                        last_name = EXCLUDED.last_name,
+                        balance = EXCLUDED.balance,
+                        total_generations = EXCLUDED.total_generations,
+                        created_at = EXCLUDED.created_at,
+                        last_generation = EXCLUDED.last_generation
+                ''')
+                rows_done += len(records)
+                await pg_conn.execute('''
+                    INSERT INTO migration_checkpoints (name, last_key, rows_done, updated_at)
+                    VALUES ($1, $2, $3, CURRENT_TIMESTAMP)
+                    ON CONFLICT (name) DO UPDATE SET
+                        last_key = EXCLUDED.last_key,
+                        rows_done = EXCLUDED.rows_done,
+                        updated_at = EXCLUDED.updated_at
+                ''', CHECKPOINT_NAME, records[-1][0], rows_done)
             
-            logger.info(f"Мигрирован пользователь с ID {user_id}")
-        
-        # Закрываем соединения
-        await pg_conn.close()
-        sqlite_conn.close()
+            migrated_now += len(records)
+            elapsed = time.monotonic() - started
+            rate = migrated_now / elapsed if elapsed else 0
+            remaining = max(0, total - rows_done)
+            eta = remaining / rate if rate else 0
+            logger.info(
+                f"Перенесено {rows_done}/{total} пользователей ({rows_done * 100 / total:.1f}%), "
+                f"{rate:.0f} строк/с, осталось ~{eta:.0f} с"
+            )
         
-        logger.info(f"Миграция данных успешно завершена. Перенесено {len(users_data)} пользователей.")
+        logger.info(f"Миграция данных успешно завершена. Перенесено {rows_done} пользователей.")
         return True
     except Exception as e:
         logger.error(f"Ошибка при миграции данных: {e}")
         return False
+    finally:
+        # Закрываем соединения
+        if pg_conn is not None:
+            await pg_conn.close()
+        if sqlite_conn is not None:
+            sqlite_conn.close()
 
 async def test_pg_connection():
     """Проверить подключение к PostgreSQL."""
@@ -158,6 +224,11 @@ async def main():
         return
     
     logger.info("Структура базы данных PostgreSQL успешно создана!")
+    
+    # Перенос пользователей из SQLite по флагу --migrate (--restart - начать заново)
+    if "--migrate" in sys.argv:
+        if not await migrate_data(restart="--restart" in sys.argv):
+            logger.error("Перенос данных из SQLite не завершен. Повторный запуск продолжит с контрольной точки.")
 
 if __name__ == "__main__":
     # Запускаем миграцию
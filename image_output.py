@@ -0,0 +1,159 @@
+"""
+Модуль подготовки сгенерированных изображений к отправке в Telegram.
+
+gpt-image-1 возвращает PNG 1024x1536 размером в несколько мегабайт. Перед отправкой
+изображение можно перекодировать в JPEG/WebP высокого качества в пуле потоков,
+чтобы уменьшить объем загрузки, а оригинал сохранить в памяти для кнопки
+"скачать в полном качестве" (объем хранимых оригиналов ограничен IMAGE_ORIGINALS_MAX_MB).
+"""
+import io
+import os
+import time
+import uuid
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+# Pillow нужен только для перекодирования - без него отправляем оригинальный PNG
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Формат отправляемого изображения: "png" (без перекодирования), "jpeg" или "webp"
+OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "jpeg").lower()
+OUTPUT_QUALITY = int(os.getenv("IMAGE_OUTPUT_QUALITY", "92"))
+ENCODE_WORKERS = int(os.getenv("IMAGE_ENCODE_WORKERS", "2"))
+
+# Сколько хранить оригиналы для кнопки "скачать в полном качестве"
+ORIGINALS_TTL = int(os.getenv("IMAGE_ORIGINALS_TTL", "3600"))  # 1 час
+MAX_ORIGINALS = int(os.getenv("IMAGE_MAX_ORIGINALS", "200"))
+# Предел памяти под оригиналы: один PNG весит ~3 МБ, альбом - до 10 таких файлов
+MAX_ORIGINALS_BYTES = int(float(os.getenv("IMAGE_ORIGINALS_MAX_MB", "256")) * 1024 * 1024)
+
+_FORMATS = {
+    "jpeg": ("JPEG", "jpg"),
+    "jpg": ("JPEG", "jpg"),
+    "webp": ("WEBP", "webp"),
+}
+
+# Пул потоков для перекодирования (Pillow отпускает GIL при кодировании)
+_executor = ThreadPoolExecutor(max_workers=ENCODE_WORKERS, thread_name_prefix="image-encode")
+
+# Оригиналы изображений {token: (список PNG, время истечения)}
+_originals: "OrderedDict[str, Tuple[List[bytes], float]]" = OrderedDict()
+# Суммарный размер хранимых оригиналов в байтах
+_originals_bytes = 0
+
+# Счетчики для мониторинга
+stats = {
+    "encoded": 0,
+    "passthrough": 0,
+    "errors": 0,
+    "bytes_in": 0,
+    "bytes_out": 0,
+    "originals_evicted": 0,
+}
+
+if OUTPUT_FORMAT not in _FORMATS and OUTPUT_FORMAT != "png":
+    logger.warning(f"Неизвестный формат IMAGE_OUTPUT_FORMAT={OUTPUT_FORMAT}, используем PNG")
+    OUTPUT_FORMAT = "png"
+
+if OUTPUT_FORMAT != "png" and Image is None:
+    logger.warning("Pillow не установлен - изображения будут отправляться в PNG без перекодирования")
+
+def _transcode_sync(data: bytes, pil_format: str, quality: int) -> bytes:
+    """Синхронно перекодировать изображение (выполняется в пуле потоков)."""
+    with Image.open(io.BytesIO(data)) as img:
+        if pil_format == "JPEG" and img.mode != "RGB":
+            img = img.convert("RGB")
+        out = io.BytesIO()
+        if pil_format == "JPEG":
+            img.save(out, format="JPEG", quality=quality, optimize=True, progressive=True, subsampling=0)
+        else:
+            img.save(out, format=pil_format, quality=quality, method=4)
+        return out.getvalue()
+
+async def prepare_for_delivery(data: bytes) -> Tuple[bytes, str]:
+    """
+    Подготовить изображение к отправке в выбранном формате.
+
+    Args:
+        data: Оригинальные байты PNG
+
+    Returns:
+        Tuple[bytes, str]: Байты для отправки и имя файла с нужным расширением
+    """
+    stats["bytes_in"] += len(data)
+    if OUTPUT_FORMAT == "png" or Image is None:
+        stats["passthrough"] += 1
+        stats["bytes_out"] += len(data)
+        return data, "image.png"
+
+    pil_format, extension = _FORMATS[OUTPUT_FORMAT]
+    try:
+        loop = asyncio.get_running_loop()
+        encoded = await loop.run_in_executor(_executor, _transcode_sync, data, pil_format, OUTPUT_QUALITY)
+    except Exception as e:
+        logger.warning(f"Не удалось перекодировать изображение в {pil_format}, отправляем PNG: {e}")
+        stats["errors"] += 1
+        stats["bytes_out"] += len(data)
+        return data, "image.png"
+
+    # Перекодированный файл может оказаться больше оригинала - тогда отправляем оригинал
+    if len(encoded) >= len(data):
+        stats["passthrough"] += 1
+        stats["bytes_out"] += len(data)
+        return data, "image.png"
+
+    stats["encoded"] += 1
+    stats["bytes_out"] += len(encoded)
+    return encoded, f"image.{extension}"
+
+def _prune_originals(now: float) -> None:
+    """Удалить устаревшие оригиналы и ограничить общее количество и объем (старые - первыми)."""
+    global _originals_bytes
+    while _originals:
+        token, (images, expires_at) = next(iter(_originals.items()))
+        if expires_at > now and len(_originals) <= MAX_ORIGINALS and _originals_bytes <= MAX_ORIGINALS_BYTES:
+            break
+        del _originals[token]
+        _originals_bytes -= sum(len(image) for image in images)
+        if expires_at > now:
+            stats["originals_evicted"] += 1
+
+def store_originals(images: List[bytes]) -> str:
+    """
+    Сохранить оригиналы для последующей отправки документом.
+
+    Returns:
+        str: Короткий токен для callback_data
+    """
+    global _originals_bytes
+    now = time.time()
+    token = uuid.uuid4().hex[:16]
+    _originals[token] = (images, now + ORIGINALS_TTL)
+    _originals_bytes += sum(len(image) for image in images)
+    _prune_originals(now)
+    return token
+
+def get_originals(token: str) -> Optional[List[bytes]]:
+    """Получить оригиналы по токену (None, если срок хранения истек)."""
+    entry = _originals.get(token)
+    if entry is None or entry[1] < time.time():
+        return None
+    return entry[0]
+
+def get_stats() -> dict:
+    """Получить метрики подготовки изображений."""
+    return {
+        **stats,
+        "format": OUTPUT_FORMAT if Image is not None else "png",
+        "originals_stored": len(_originals),
+        "originals_bytes": _originals_bytes,
+    }
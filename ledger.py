@@ -0,0 +1,244 @@
+"""
+Модуль журнала начислений (outbox) для платежей и возвратов звезд.
+
+Начисление записывается одной вставкой в balance_ledger с ключом идемпотентности
+(например, "payment:<telegram_payment_charge_id>" или "refund:<job_id>"), а
+фоновый обработчик пачками применяет записи к балансу. Повторная запись с тем же
+ключом игнорируется, поэтому повторы Telegram и ретраи не начисляют звезды дважды.
+
+Если БД недоступна, запись сохраняется в локальный файл (LEDGER_SPOOL_PATH) и
+переносится в журнал после восстановления соединения.
+"""
+import os
+import json
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Размер пачки и пауза между проверками журнала (в секундах)
+LEDGER_BATCH_SIZE = int(os.getenv("LEDGER_BATCH_SIZE", "200"))
+LEDGER_POLL_INTERVAL = float(os.getenv("LEDGER_POLL_INTERVAL", "2"))
+# После стольких неудачных попыток запись остается в журнале для ручного разбора
+LEDGER_MAX_ATTEMPTS = int(os.getenv("LEDGER_MAX_ATTEMPTS", "20"))
+# Локальный файл для записей, которые не удалось вставить в БД
+LEDGER_SPOOL_PATH = os.getenv("LEDGER_SPOOL_PATH", "ledger_spool.jsonl")
+
+# Применение пачки одним запросом: баланс каждого пользователя меняется один раз
+# на сумму его записей, история пишется по каждой записи
+APPLY_BATCH_QUERY = '''
+    WITH batch AS (
+        SELECT id, idempotency_key, user_id, amount, operation_type
+        FROM balance_ledger
+        WHERE applied_at IS NULL AND attempts < $2
+        ORDER BY id
+        LIMIT $1
+        FOR UPDATE SKIP LOCKED
+    ), per_user AS (
+        SELECT user_id, sum(amount) AS amount FROM batch GROUP BY user_id
+    ), updated AS (
+        UPDATE users u SET balance = u.balance + p.amount
+        FROM per_user p
+        WHERE u.user_id = p.user_id
+        RETURNING u.user_id, u.balance
+    ), history AS (
+        INSERT INTO balance_history (user_id, amount, operation_type, timestamp)
+        SELECT b.user_id, abs(b.amount), b.operation_type, CURRENT_TIMESTAMP
+        FROM batch b JOIN updated USING (user_id)
+    ), applied AS (
+        UPDATE balance_ledger l SET applied_at = CURRENT_TIMESTAMP, attempts = l.attempts + 1
+        FROM batch b JOIN updated USING (user_id)
+        WHERE l.id = b.id
+        RETURNING l.idempotency_key
+    ), missing AS (
+        -- Пользователя нет в users: запись останется в журнале до исчерпания попыток
+        UPDATE balance_ledger l SET attempts = l.attempts + 1, last_error = 'user not found'
+        FROM batch b
+        WHERE l.id = b.id AND b.user_id NOT IN (SELECT user_id FROM updated)
+    )
+    SELECT b.idempotency_key, b.user_id, u.balance, (SELECT count(*) FROM batch) AS batch_size
+    FROM batch b JOIN updated u USING (user_id)
+'''
+
+class BalanceLedger:
+    """
+    Журнал начислений с пакетным фоновым применением.
+
+    Args:
+        spool_path: Файл для записей, которые не удалось вставить в БД
+        batch_size: Сколько записей применять за один запрос
+    """
+
+    def __init__(self, spool_path: str = LEDGER_SPOOL_PATH, batch_size: int = LEDGER_BATCH_SIZE):
+        self.spool_path = spool_path
+        self.batch_size = batch_size
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        # Ожидающие применения записи {idempotency_key: Future с новым балансом}
+        self._waiters: Dict[str, asyncio.Future] = {}
+        self.stats: Dict[str, int] = {
+            "submitted": 0,
+            "duplicates": 0,
+            "spooled": 0,
+            "applied": 0,
+            "batches": 0,
+            "failures": 0,
+        }
+
+    async def _insert(self, conn, entries: List[dict]) -> int:
+        """Вставить записи в журнал, пропуская уже известные ключи. Возвращает число новых."""
+        result = await conn.fetchval('''
+            WITH inserted AS (
+                INSERT INTO balance_ledger (idempotency_key, user_id, amount, operation_type)
+                SELECT * FROM unnest($1::text[], $2::bigint[], $3::integer[], $4::text[])
+                ON CONFLICT (idempotency_key) DO NOTHING
+                RETURNING 1
+            )
+            SELECT count(*) FROM inserted
+        ''', [e["key"] for e in entries], [e["user_id"] for e in entries],
+            [e["amount"] for e in entries], [e["operation"] for e in entries])
+        return int(result)
+
+    def _spool(self, entry: dict) -> None:
+        """Сохранить запись на диск до восстановления БД."""
+        with open(self.spool_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.stats["spooled"] += 1
+
+    async def submit(self, key: str, user_id: int, amount: int, operation: str) -> bool:
+        """
+        Записать начисление (amount > 0) или списание (amount < 0) в журнал.
+
+        Args:
+            key: Ключ идемпотентности ("payment:<charge_id>", "refund:<job_id>", ...)
+            operation: Тип операции для balance_history ("payment", "refund", ...)
+
+        Returns:
+            bool: True, если запись новая; False, если ключ уже был в журнале
+        """
+        from db import acquire
+        entry = {"key": key, "user_id": user_id, "amount": amount, "operation": operation}
+        try:
+            async with acquire() as conn:
+                inserted = await self._insert(conn, [entry])
+        except Exception as e:
+            # Запись не должна потеряться: сохраняем локально и вставим позже
+            logger.error(f"Ошибка при записи {key} в журнал начислений, запись сохранена в {self.spool_path}: {e}")
+            self._spool(entry)
+            return True
+        if inserted:
+            self.stats["submitted"] += 1
+            self._wakeup.set()
+        else:
+            self.stats["duplicates"] += 1
+            logger.warning(f"Повторная запись {key} в журнал начислений пропущена")
+        return bool(inserted)
+
+    async def submit_and_wait(self, key: str, user_id: int, amount: int, operation: str,
+                              timeout: float) -> Tuple[bool, Optional[int]]:
+        """
+        Записать начисление и дождаться его применения.
+
+        Returns:
+            Tuple[bool, Optional[int]]: Новая ли запись и новый баланс; баланс None, если
+                запись не применилась за timeout (или ключ уже был в журнале) - новая
+                запись все равно будет применена позже
+        """
+        # Ожидание регистрируется до вставки, чтобы не пропустить быстрое применение
+        future = self._waiters[key] = asyncio.get_running_loop().create_future()
+        inserted = False
+        try:
+            inserted = await self.submit(key, user_id, amount, operation)
+            if not inserted:
+                return False, None
+            return True, await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return inserted, None
+        finally:
+            self._waiters.pop(key, None)
+
+    async def _drain_spool(self) -> None:
+        """Перенести записи из локального файла в журнал (ключи защищают от дублей)."""
+        draining = self.spool_path + ".draining"
+        # Файл переименовывается, чтобы записи, добавленные во время вставки, не потерялись;
+        # если прошлая попытка не удалась, сначала дописываем ее
+        if not os.path.exists(draining):
+            if not os.path.exists(self.spool_path) or os.path.getsize(self.spool_path) == 0:
+                return
+            os.replace(self.spool_path, draining)
+        from db import acquire
+        with open(draining, encoding="utf-8") as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        if entries:
+            async with acquire() as conn:
+                inserted = await self._insert(conn, entries)
+            logger.info(f"Из {self.spool_path} в журнал начислений перенесено {inserted} записей из {len(entries)}")
+        # Файл удаляется только после успешной вставки
+        os.remove(draining)
+
+    async def process_batch(self) -> int:
+        """Применить одну пачку записей журнала. Возвращает размер пачки."""
+        from db import acquire, record_balance
+        async with acquire() as conn:
+            async with conn.transaction():
+                rows = await conn.fetch(APPLY_BATCH_QUERY, self.batch_size, LEDGER_MAX_ATTEMPTS)
+        if not rows:
+            return 0
+        self.stats["batches"] += 1
+        self.stats["applied"] += len(rows)
+        for row in rows:
+            record_balance(row['user_id'], row['balance'])
+            future = self._waiters.pop(row['idempotency_key'], None)
+            if future is not None and not future.done():
+                future.set_result(row['balance'])
+        return rows[0]['batch_size']
+
+    async def _run(self) -> None:
+        delay = LEDGER_POLL_INTERVAL
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self._drain_spool()
+                # Полная пачка - в журнале могут быть еще записи
+                while await self.process_batch() >= self.batch_size:
+                    pass
+                delay = LEDGER_POLL_INTERVAL
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.stats["failures"] += 1
+                logger.error(f"Ошибка при применении журнала начислений: {e}")
+                delay = min(delay * 2, 60)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Остановить обработчик, применив то, что успели записать."""
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        try:
+            while await self.process_batch() >= self.batch_size:
+                pass
+        except Exception as e:
+            # Непримененные записи останутся в журнале до следующего запуска
+            logger.warning(f"Журнал начислений применен не полностью: {e}")
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "waiting": len(self._waiters)}
+
+# Глобальный экземпляр
+balance_ledger = BalanceLedger()
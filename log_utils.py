@@ -6,6 +6,7 @@ import logging
 import json
 from typing import Dict, Any, Optional
 from db import add_background_task
+from stats import stats_collector
 
 # Настройка логирования
 logger = logging.getLogger(__name__)
@@ -35,14 +36,16 @@ def log_user_action(user_id: int, action: str, details: Optional[Dict[str, Any]]
 
 def update_bot_stat(stat_name: str) -> None:
     """
-    Увеличивает счетчик статистики бота в фоновом режиме.
+    Увеличивает счетчик статистики бота.
+    
+    Счетчик копится в памяти и записывается в bot_stats пакетом (см. stats.py),
+    без отдельного UPDATE на каждое событие.
     
     Args:
         stat_name: Название счетчика статистики
     """
     try:
-        # Добавляем задачу в очередь для фоновой обработки
-        add_background_task("update_stats", {"stat_name": stat_name})
+        stats_collector.increment(stat_name)
     except Exception as e:
         # В случае ошибки просто записываем в журнал и продолжаем
         logger.error(f"Ошибка при обновлении статистики бота: {e}")
@@ -0,0 +1,104 @@
+"""
+Модуль для сборки альбомов (media group) в одну пакетную задачу.
+
+Telegram присылает каждую фотографию альбома отдельным обновлением с общим
+media_group_id. Коллектор накапливает такие обновления в течение короткого окна
+и передает их обработчику одной пачкой. Обработка запускается через координатор
+остановки, поэтому при остановке бота собранные альбомы дожидаются, а еще
+собираемые обрабатываются сразу через flush_all().
+"""
+import os
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, List
+
+from shutdown import shutdown
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Окно сбора фотографий альбома (в секундах) - отсчитывается от последней полученной фотографии
+MEDIA_GROUP_WINDOW = float(os.getenv("MEDIA_GROUP_WINDOW", "1.5"))
+
+# Telegram допускает не более 10 элементов в альбоме
+MAX_MEDIA_GROUP_SIZE = 10
+
+class MediaGroupCollector:
+    """
+    Накопитель обновлений одного альбома.
+
+    Args:
+        flush_callback: Корутина (media_group_id, items), вызываемая для собранного альбома
+        window: Время ожидания следующей фотографии альбома (в секундах)
+        max_items: Максимальный размер альбома, после которого он обрабатывается сразу
+    """
+
+    def __init__(self, flush_callback: Callable[[str, List[Any]], Awaitable[None]],
+                 window: float = MEDIA_GROUP_WINDOW, max_items: int = MAX_MEDIA_GROUP_SIZE):
+        self.flush_callback = flush_callback
+        self.window = window
+        self.max_items = max_items
+        # Собираемые альбомы {media_group_id: [items]}
+        self._groups: Dict[str, List[Any]] = {}
+        # Таймеры окончания сбора {media_group_id: TimerHandle}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+
+    def add(self, media_group_id: str, item: Any) -> bool:
+        """
+        Добавить элемент в альбом.
+
+        Returns:
+            bool: True, если это первый элемент альбома
+        """
+        is_first = media_group_id not in self._groups
+        self._groups.setdefault(media_group_id, []).append(item)
+
+        # Перезапускаем таймер: альбом считается собранным, когда фотографии перестали приходить
+        self._cancel_timer(media_group_id)
+
+        if len(self._groups[media_group_id]) >= self.max_items:
+            self._schedule_flush(media_group_id)
+        else:
+            loop = asyncio.get_running_loop()
+            self._timers[media_group_id] = loop.call_later(
+                self.window, self._schedule_flush, media_group_id
+            )
+        return is_first
+
+    def _cancel_timer(self, media_group_id: str) -> None:
+        timer = self._timers.pop(media_group_id, None)
+        if timer:
+            timer.cancel()
+
+    def _schedule_flush(self, media_group_id: str) -> None:
+        """Запустить обработку собранного альбома в отдельной задаче."""
+        self._cancel_timer(media_group_id)
+        items = self._groups.pop(media_group_id, None)
+        if not items:
+            return
+        logger.info(f"Альбом {media_group_id} собран: {len(items)} фото")
+        shutdown.spawn(self._flush(media_group_id, items), f"media_group:{media_group_id}")
+
+    async def _flush(self, media_group_id: str, items: List[Any]) -> None:
+        """Передать альбом обработчику, не давая исключениям потеряться."""
+        try:
+            await self.flush_callback(media_group_id, items)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке альбома {media_group_id}: {e}")
+
+    def flush_all(self) -> int:
+        """
+        Не дожидаясь окончания окна, передать в обработку все собираемые альбомы
+        (при остановке бота: новые фото уже не придут).
+
+        Returns:
+            int: Количество запущенных альбомов
+        """
+        group_ids = list(self._groups)
+        for media_group_id in group_ids:
+            self._schedule_flush(media_group_id)
+        return len(group_ids)
+
+    def pending_count(self) -> int:
+        """Количество альбомов, которые еще собираются."""
+        return len(self._groups)
@@ -0,0 +1,338 @@
+"""
+Модуль версионированных миграций схемы PostgreSQL.
+
+Примененные миграции записываются в таблицу schema_migrations. Если база уже
+в актуальном состоянии, запуск стоит одного запроса. Миграции применяются
+по порядку под advisory-блокировкой, чтобы несколько экземпляров бота не
+выполняли их одновременно. Обычные миграции выполняются в транзакции, а
+нетранзакционные (CREATE INDEX CONCURRENTLY) - по одному запросу без нее.
+
+Самостоятельный запуск:
+    python migrations.py           # применить ожидающие миграции
+    python migrations.py --status  # показать примененные версии
+"""
+import sys
+import time
+import asyncio
+import logging
+from typing import Awaitable, Callable, List, Optional, Union
+
+import asyncpg
+
+from db import PG_CONNECTION_STRING, ensure_user_actions_partitions
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Ключ advisory-блокировки миграций (произвольная константа)
+MIGRATION_LOCK_ID = 7_281_930_114
+
+SCHEMA_MIGRATIONS_DDL = '''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        duration_ms INTEGER
+    )
+'''
+
+USER_ACTIONS_DDL = '''
+    CREATE TABLE IF NOT EXISTS user_actions (
+        id BIGSERIAL,
+        user_id BIGINT REFERENCES users(user_id),
+        action TEXT NOT NULL,
+        details JSONB,
+        timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (id, timestamp)
+    ) PARTITION BY RANGE (timestamp);
+    CREATE TABLE IF NOT EXISTS user_actions_default PARTITION OF user_actions DEFAULT;
+'''
+
+class Migration:
+    """
+    Одна миграция схемы.
+
+    Args:
+        version: Номер версии (строго возрастает)
+        name: Короткое описание
+        apply: Список SQL-запросов или корутина-функция от соединения
+        transactional: False для запросов, которые нельзя выполнять в транзакции
+            (CREATE INDEX CONCURRENTLY)
+    """
+
+    def __init__(self, version: int, name: str,
+                 apply: Union[List[str], Callable[[asyncpg.Connection], Awaitable[None]]],
+                 transactional: bool = True):
+        self.version = version
+        self.name = name
+        self.apply = apply
+        self.transactional = transactional
+
+    async def run(self, conn) -> None:
+        if callable(self.apply):
+            await self.apply(conn)
+            return
+        for statement in self.apply:
+            await conn.execute(statement)
+
+async def _partition_user_actions(conn) -> None:
+    """Создать секционированную user_actions или перенести в нее старую обычную таблицу."""
+    relkind = await conn.fetchval('''
+        SELECT c.relkind FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = current_schema() AND c.relname = 'user_actions'
+    ''')
+    if relkind is None:
+        await conn.execute(USER_ACTIONS_DDL)
+        return
+    if relkind != 'r':
+        return  # уже секционирована
+
+    logger.info("Перевод user_actions на помесячное секционирование")
+    await conn.execute('ALTER TABLE user_actions RENAME TO user_actions_legacy')
+    await conn.execute(USER_ACTIONS_DDL)
+
+    bounds = await conn.fetchrow('SELECT MIN(timestamp) AS first, MAX(timestamp) AS last FROM user_actions_legacy')
+    if bounds['first'] is not None:
+        await ensure_user_actions_partitions(conn, start=bounds['first'], end=bounds['last'])
+
+    # Секции уже созданы, поэтому строки распределяются без попадания в секцию по умолчанию
+    await conn.execute('''
+        INSERT INTO user_actions (id, user_id, action, details, timestamp)
+        SELECT id, user_id, action, details, COALESCE(timestamp, CURRENT_TIMESTAMP)
+        FROM user_actions_legacy
+    ''')
+    await conn.execute('''
+        SELECT setval(pg_get_serial_sequence('user_actions', 'id'),
+                      GREATEST((SELECT COALESCE(MAX(id), 0) FROM user_actions), 1))
+    ''')
+    await conn.execute('DROP TABLE user_actions_legacy')
+    logger.info("Таблица user_actions переведена на секционирование")
+
+# Список миграций. Новые миграции добавляются только в конец со следующим номером
+MIGRATIONS: List[Migration] = [
+    Migration(1, "base_tables", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            balance INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_generation TIMESTAMP,
+            total_generations INTEGER DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS balance_history (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT REFERENCES users(user_id),
+            amount INTEGER NOT NULL,
+            operation_type TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS bot_stats (
+            stat_name TEXT PRIMARY KEY,
+            value INTEGER DEFAULT 0,
+            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    Migration(2, "user_actions_partitioned", _partition_user_actions),
+    # Индексы на живой таблице строятся без блокировки записи
+    Migration(3, "balance_history_indexes", [
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_balance_history_user_ts ON balance_history (user_id, timestamp)",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_balance_history_ts_brin ON balance_history USING BRIN (timestamp)",
+    ], transactional=False),
+    # CONCURRENTLY не поддерживается для секционированных таблиц
+    Migration(4, "user_actions_indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_user_actions_user_ts ON user_actions (user_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_user_actions_ts_brin ON user_actions USING BRIN (timestamp)",
+    ]),
+    # Агрегаты статистики, которые накапливает stats.py
+    Migration(5, "stats_rollups", [
+        '''
+        CREATE TABLE IF NOT EXISTS stats_hourly (
+            bucket TIMESTAMP NOT NULL,
+            metric TEXT NOT NULL,
+            dimension TEXT NOT NULL DEFAULT '',
+            count BIGINT NOT NULL DEFAULT 0,
+            total DOUBLE PRECISION NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, metric, dimension)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS stats_hourly_users (
+            bucket TIMESTAMP NOT NULL,
+            user_id BIGINT NOT NULL,
+            PRIMARY KEY (bucket, user_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS stats_rollup (
+            name TEXT PRIMARY KEY,
+            value DOUBLE PRECISION NOT NULL,
+            refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        "ALTER TABLE bot_stats ALTER COLUMN value TYPE BIGINT",
+    ]),
+    # Уведомления об изменении баланса для инвалидации кэша во всех экземплярах,
+    # включая ручные начисления через SQL
+    Migration(6, "balance_notify_trigger", [
+        '''
+        CREATE OR REPLACE FUNCTION notify_user_balance() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify('user_balance', json_build_object('user_id', OLD.user_id, 'balance', NULL)::text);
+            ELSE
+                PERFORM pg_notify('user_balance', json_build_object('user_id', NEW.user_id, 'balance', NEW.balance)::text);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        ''',
+        "DROP TRIGGER IF EXISTS users_balance_notify ON users",
+        '''
+        CREATE TRIGGER users_balance_notify
+        AFTER UPDATE OF balance ON users
+        FOR EACH ROW WHEN (OLD.balance IS DISTINCT FROM NEW.balance)
+        EXECUTE FUNCTION notify_user_balance()
+        ''',
+        "DROP TRIGGER IF EXISTS users_delete_notify ON users",
+        '''
+        CREATE TRIGGER users_delete_notify
+        AFTER DELETE ON users
+        FOR EACH ROW EXECUTE FUNCTION notify_user_balance()
+        ''',
+    ]),
+    # Уведомления о новых пользователях для фильтра Блума во всех экземплярах
+    Migration(7, "user_insert_notify_trigger", [
+        "DROP TRIGGER IF EXISTS users_insert_notify ON users",
+        '''
+        CREATE TRIGGER users_insert_notify
+        AFTER INSERT ON users
+        FOR EACH ROW EXECUTE FUNCTION notify_user_balance()
+        ''',
+    ]),
+    # Журнал начислений (outbox) с ключами идемпотентности для платежей и возвратов
+    Migration(8, "balance_ledger", [
+        '''
+        CREATE TABLE IF NOT EXISTS balance_ledger (
+            id BIGSERIAL PRIMARY KEY,
+            idempotency_key TEXT NOT NULL UNIQUE,
+            user_id BIGINT NOT NULL,
+            amount INTEGER NOT NULL,
+            operation_type TEXT NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            applied_at TIMESTAMP,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_balance_ledger_pending
+        ON balance_ledger (id) WHERE applied_at IS NULL
+        ''',
+    ]),
+]
+
+async def _drop_invalid_indexes(conn) -> None:
+    """Удалить невалидные индексы, оставшиеся после прерванного CREATE INDEX CONCURRENTLY."""
+    rows = await conn.fetch('''
+        SELECT c.relname AS name FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE NOT i.indisvalid AND n.nspname = current_schema()
+    ''')
+    for row in rows:
+        logger.warning(f"Удаляем невалидный индекс {row['name']}")
+        await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{row["name"]}"')
+
+async def _apply(conn, migration: Migration) -> None:
+    """Применить одну миграцию и записать ее версию."""
+    logger.info(f"Применяем миграцию {migration.version}: {migration.name}")
+    started = time.perf_counter()
+
+    if migration.transactional:
+        async with conn.transaction():
+            await migration.run(conn)
+            await conn.execute(
+                "INSERT INTO schema_migrations (version, name, duration_ms) VALUES ($1, $2, $3)",
+                migration.version, migration.name, int((time.perf_counter() - started) * 1000)
+            )
+    else:
+        # Запросы без транзакции должны быть идемпотентными (IF NOT EXISTS),
+        # чтобы прерванную миграцию можно было повторить
+        await _drop_invalid_indexes(conn)
+        await migration.run(conn)
+        await conn.execute(
+            "INSERT INTO schema_migrations (version, name, duration_ms) VALUES ($1, $2, $3)",
+            migration.version, migration.name, int((time.perf_counter() - started) * 1000)
+        )
+
+    logger.info(f"Миграция {migration.version} применена за {(time.perf_counter() - started) * 1000:.0f} мс")
+
+async def run_migrations(dsn: Optional[str] = None) -> int:
+    """
+    Применить ожидающие миграции.
+
+    Используется отдельное соединение без command_timeout пула: перенос данных
+    и построение индексов могут занимать больше нескольких секунд.
+
+    Returns:
+        int: Количество примененных миграций
+    """
+    latest = MIGRATIONS[-1].version
+    conn = await asyncpg.connect(dsn or PG_CONNECTION_STRING)
+    try:
+        # Быстрый путь: база в актуальном состоянии - один запрос
+        try:
+            current = await conn.fetchval("SELECT MAX(version) FROM schema_migrations")
+        except asyncpg.UndefinedTableError:
+            current = None
+        if current is not None and current >= latest:
+            logger.info(f"Схема базы данных актуальна (версия {current})")
+            return 0
+
+        await conn.execute(SCHEMA_MIGRATIONS_DDL)
+        await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_ID)
+        try:
+            # Перечитываем после блокировки: другой экземпляр мог уже применить миграции
+            applied = {row['version'] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+            pending = [m for m in MIGRATIONS if m.version not in applied]
+            for migration in pending:
+                await _apply(conn, migration)
+            if pending:
+                logger.info(f"Применено миграций: {len(pending)}, версия схемы {latest}")
+            return len(pending)
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
+    finally:
+        await conn.close()
+
+async def migration_status(dsn: Optional[str] = None) -> List[dict]:
+    """Получить список примененных миграций."""
+    conn = await asyncpg.connect(dsn or PG_CONNECTION_STRING)
+    try:
+        rows = await conn.fetch("SELECT version, name, applied_at, duration_ms FROM schema_migrations ORDER BY version")
+        return [dict(row) for row in rows]
+    except asyncpg.UndefinedTableError:
+        return []
+    finally:
+        await conn.close()
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    if "--status" in sys.argv:
+        applied = asyncio.run(migration_status())
+        for row in applied:
+            print(f"{row['version']:>4}  {row['name']:<32} {row['applied_at']}  {row['duration_ms']} мс")
+        pending = [m for m in MIGRATIONS if m.version not in {row['version'] for row in applied}]
+        for migration in pending:
+            print(f"{migration.version:>4}  {migration.name:<32} ожидает применения")
+    else:
+        asyncio.run(run_migrations())
@@ -0,0 +1,297 @@
+"""
+Модуль надзора за пулом соединений PostgreSQL.
+
+Все обращения к БД берут соединение через PoolSupervisor.acquire(), который:
+- измеряет время ожидания соединения и загрузку пула;
+- ограничивает число одновременно выданных соединений и подстраивает лимит
+  в пределах [DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE] по времени ожидания и загрузке;
+- периодически проверяет соединения (SELECT 1) и пересоздает их после сбоев;
+- размыкает цепь (circuit breaker) после серии сбоев соединения, чтобы во время
+  недоступности БД обработчики сразу получали DatabaseUnavailable, а не копили
+  таймауты по DB_COMMAND_TIMEOUT секунд каждый.
+"""
+import os
+import time
+import asyncio
+import logging
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+import asyncpg
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Сколько ждать свободного соединения, прежде чем отказать (в секундах)
+ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "2"))
+# Целевое время ожидания соединения (p95, мс): выше - лимит пула увеличивается
+WAIT_TARGET_MS = float(os.getenv("DB_POOL_WAIT_TARGET_MS", "50"))
+# Как часто пересматривать лимит и проверять соединения (в секундах)
+TUNE_INTERVAL = float(os.getenv("DB_POOL_TUNE_INTERVAL", "10"))
+HEALTH_INTERVAL = float(os.getenv("DB_POOL_HEALTH_INTERVAL", "30"))
+# Сколько сбоев соединения подряд размыкают цепь и на сколько секунд
+BREAKER_FAILURES = int(os.getenv("DB_BREAKER_FAILURES", "5"))
+BREAKER_RESET_TIMEOUT = float(os.getenv("DB_BREAKER_RESET_TIMEOUT", "15"))
+
+# Ошибки, означающие недоступность БД, а не ошибку конкретного запроса
+CONNECTION_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.exceptions.PostgresConnectionError,
+    asyncpg.exceptions.OperatorInterventionError,
+    asyncpg.exceptions.ConnectionDoesNotExistError,
+)
+
+class DatabaseUnavailable(Exception):
+    """БД недоступна: цепь разомкнута или свободного соединения не дождались."""
+
+class CircuitBreaker:
+    """
+    Circuit breaker: closed -> open после failure_threshold сбоев подряд,
+    open -> half_open через reset_timeout, half_open -> closed при первом успехе
+    или снова open при первом сбое.
+    """
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURES, reset_timeout: float = BREAKER_RESET_TIMEOUT,
+                 name: str = "primary"):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.stats = {"opened": 0, "rejected": 0}
+
+    def before_call(self) -> None:
+        """Пропустить вызов или сразу отказать, пока цепь разомкнута."""
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                self.stats["rejected"] += 1
+                raise DatabaseUnavailable(f"База данных ({self.name}) недоступна (цепь разомкнута)")
+            self.state = "half_open"
+            logger.info(f"Пробный запрос к базе данных ({self.name}) после сбоя")
+
+    def record_success(self) -> None:
+        if self.state != "closed":
+            logger.info(f"Соединение с базой данных ({self.name}) восстановлено")
+        self.state = "closed"
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.stats["opened"] += 1
+            logger.error(f"База данных ({self.name}) недоступна после {self.failures} сбоев подряд, "
+                         f"запросы отклоняются на {self.reset_timeout:.0f} с")
+
+class PoolSupervisor:
+    """
+    Надзор за пулом asyncpg.
+
+    asyncpg не умеет менять max_size существующего пула, поэтому пул создается
+    с верхней границей, а супервизор ограничивает число одновременно выданных
+    соединений подвижным лимитом. Лишние физические соединения закрываются
+    самим пулом по max_inactive_connection_lifetime.
+
+    Args:
+        pool: Пул asyncpg
+        min_size: Нижняя граница лимита
+        max_size: Верхняя граница лимита (max_size пула)
+        name: Имя пула в логах ("primary", "replica")
+    """
+
+    def __init__(self, pool, min_size: int, max_size: int, name: str = "primary"):
+        self.name = name
+        self.pool = pool
+        self.min_size = min_size
+        self.max_size = max_size
+        self.limit = max_size
+        self.in_use = 0
+        self.breaker = CircuitBreaker(name=name)
+        self._condition = asyncio.Condition()
+        self._task: Optional[asyncio.Task] = None
+        # Ожидания и пиковая загрузка с последнего пересмотра лимита
+        self._waits: deque = deque(maxlen=5000)
+        self._peak_in_use = 0
+        self._last_health_check = time.monotonic()
+        self.stats: Dict[str, Any] = {
+            "acquired": 0,
+            "acquire_timeouts": 0,
+            "connection_errors": 0,
+            "health_checks": 0,
+            "health_failures": 0,
+            "health_skipped": 0,
+            "recycled": 0,
+            "resizes": 0,
+        }
+
+    async def _enter(self, timeout: float) -> None:
+        async with self._condition:
+            await asyncio.wait_for(self._condition.wait_for(lambda: self.in_use < self.limit), timeout)
+            self.in_use += 1
+            self._peak_in_use = max(self._peak_in_use, self.in_use)
+
+    async def _leave(self) -> None:
+        async with self._condition:
+            self.in_use -= 1
+            self._condition.notify()
+
+    def _record_error(self, error: BaseException) -> None:
+        if isinstance(error, CONNECTION_ERRORS):
+            self.stats["connection_errors"] += 1
+            self.breaker.record_failure()
+        else:
+            # Ошибка запроса: сервер ответил, значит соединение работает
+            self.breaker.record_success()
+
+    @asynccontextmanager
+    async def acquire(self, timeout: float = ACQUIRE_TIMEOUT):
+        """
+        Получить соединение из пула.
+
+        Raises:
+            DatabaseUnavailable: цепь разомкнута или соединение не освободилось за timeout
+        """
+        self.breaker.before_call()
+        started = time.perf_counter()
+        try:
+            await self._enter(timeout)
+        except asyncio.TimeoutError:
+            self.stats["acquire_timeouts"] += 1
+            raise DatabaseUnavailable(f"Нет свободного соединения с базой данных за {timeout} с")
+        try:
+            try:
+                connection = await self.pool.acquire(timeout=max(0.1, timeout - (time.perf_counter() - started)))
+            except Exception as e:
+                self._record_error(e)
+                raise
+            self._waits.append(time.perf_counter() - started)
+            self.stats["acquired"] += 1
+            try:
+                yield connection
+            except Exception as e:
+                self._record_error(e)
+                raise
+            else:
+                self.breaker.record_success()
+            finally:
+                await self.pool.release(connection)
+        finally:
+            await self._leave()
+
+    def _wait_percentile(self, percentile: float) -> Optional[float]:
+        if not self._waits:
+            return None
+        ordered = sorted(self._waits)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))] * 1000
+
+    async def _tune(self) -> None:
+        """Пересмотреть лимит по времени ожидания и загрузке с прошлого пересмотра."""
+        p95 = self._wait_percentile(95)
+        limit = self.limit
+        if p95 is not None and p95 > WAIT_TARGET_MS and self._peak_in_use >= self.limit:
+            limit = min(self.max_size, self.limit + max(1, self.limit // 4))
+        elif self._peak_in_use <= self.limit // 2:
+            limit = max(self.min_size, self.limit - 1)
+
+        if limit != self.limit:
+            logger.info(f"Лимит пула соединений ({self.name}): {self.limit} -> {limit} "
+                        f"(p95 ожидания {p95 or 0:.1f} мс, пик занятых {self._peak_in_use})")
+            self.stats["resizes"] += 1
+            async with self._condition:
+                self.limit = limit
+                self._condition.notify_all()
+
+        self._waits.clear()
+        self._peak_in_use = self.in_use
+
+    async def health_check(self) -> Optional[bool]:
+        """
+        Проверить соединение с БД в обход лимита; после сбоя пересоздать соединения пула.
+
+        Returns:
+            Optional[bool]: None, если проверка пропущена - все соединения заняты рабочими запросами
+        """
+        self.stats["health_checks"] += 1
+        try:
+            connection = await self.pool.acquire(timeout=ACQUIRE_TIMEOUT)
+        except asyncio.TimeoutError as e:
+            if self.in_use >= self.limit:
+                # Пул занят под пиковой нагрузкой - это не сбой БД, рабочие соединения не трогаем
+                self.stats["health_skipped"] += 1
+                return None
+            return self._health_failed(e)
+        except Exception as e:
+            return self._health_failed(e)
+
+        try:
+            await connection.fetchval("SELECT 1", timeout=ACQUIRE_TIMEOUT)
+        except Exception as e:
+            return self._health_failed(e)
+        finally:
+            await self.pool.release(connection)
+
+        recovered = self.breaker.state != "closed"
+        self.breaker.record_success()
+        if recovered:
+            # Соединения, открытые до сбоя, могли остаться полуживыми
+            self._recycle()
+        return True
+
+    def _health_failed(self, error: BaseException) -> bool:
+        self.stats["health_failures"] += 1
+        logger.warning(f"Проверка соединения с базой данных ({self.name}) не прошла: {error!r}")
+        self.breaker.record_failure()
+        self._recycle()
+        return False
+
+    def _recycle(self) -> None:
+        # Соединения будут закрыты при возврате в пул и открыты заново при следующем запросе
+        self.pool.expire_connections()
+        self.stats["recycled"] += 1
+
+    async def _supervise(self) -> None:
+        while True:
+            try:
+                await asyncio.sleep(TUNE_INTERVAL)
+                await self._tune()
+                # Пока цепь разомкнута, проверяем чаще, чтобы быстрее ее замкнуть
+                interval = HEALTH_INTERVAL if self.breaker.state == "closed" else min(HEALTH_INTERVAL, self.breaker.reset_timeout)
+                if time.monotonic() - self._last_health_check >= interval:
+                    self._last_health_check = time.monotonic()
+                    await self.health_check()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка в надзоре за пулом соединений ({self.name}): {e}")
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._supervise())
+
+    async def stop(self) -> None:
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    def get_stats(self) -> dict:
+        p50 = self._wait_percentile(50)
+        p95 = self._wait_percentile(95)
+        return {
+            **self.stats,
+            "size": self.pool.get_size(),
+            "idle": self.pool.get_idle_size(),
+            "in_use": self.in_use,
+            "limit": self.limit,
+            "utilization": round(self.in_use / self.limit, 2) if self.limit else None,
+            "wait_p50_ms": round(p50, 1) if p50 is not None else None,
+            "wait_p95_ms": round(p95, 1) if p95 is not None else None,
+            "breaker": self.breaker.state,
+            **{f"breaker_{key}": value for key, value in self.breaker.stats.items()},
+        }
@@ -0,0 +1,335 @@
+"""
+Модуль контроля допуска входящих обновлений.
+
+Перед вызовом обработчиков проверяет частоту запросов пользователя (token bucket),
+ограничивает общее число одновременно обрабатываемых обновлений и объединяет
+фотографии из одного альбома (media_group) в одно решение о допуске.
+Обновления разных пользователей обрабатываются параллельно, а обновления одного
+пользователя - по очереди, чтобы его обработчики не меняли context.user_data
+одновременно.
+"""
+import os
+import time
+import asyncio
+import logging
+from functools import wraps
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Optional, Tuple
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Параметры контроля допуска (можно переопределить через переменные окружения)
+USER_RATE = float(os.getenv("ADMISSION_USER_RATE", "1"))  # Токенов в секунду на пользователя
+USER_BURST = int(os.getenv("ADMISSION_USER_BURST", "5"))  # Максимальный запас токенов
+GLOBAL_CONCURRENCY = int(os.getenv("ADMISSION_GLOBAL_CONCURRENCY", "50"))  # Одновременных обновлений
+ADMISSION_MODE = os.getenv("ADMISSION_MODE", "queue")  # "queue" - ждать токен, "reject" - отклонять
+MAX_QUEUE_WAIT = float(os.getenv("ADMISSION_MAX_QUEUE_WAIT", "5"))  # Максимальное ожидание в очереди (сек)
+
+# Время хранения решения по альбому и неактивных bucket'ов (в секундах)
+MEDIA_GROUP_TTL = 60
+BUCKET_IDLE_TTL = 600
+
+# Как часто напоминать пользователю об ограничении (в секундах)
+REJECT_NOTICE_INTERVAL = 10
+
+class TokenBucket:
+    """Классический token bucket: токены пополняются со скоростью rate до capacity."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        """Пополнить запас токенов с момента последнего обращения."""
+        elapsed = now - self.updated
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+
+    def try_acquire(self, amount: float = 1) -> bool:
+        """Попытаться забрать токены. Возвращает True, если токенов хватило."""
+        self._refill(time.monotonic())
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def time_until_available(self, amount: float = 1) -> float:
+        """Сколько секунд нужно подождать, чтобы набрать нужное количество токенов."""
+        self._refill(time.monotonic())
+        if self.tokens >= amount:
+            return 0.0
+        if self.rate <= 0:
+            return float("inf")
+        return (amount - self.tokens) / self.rate
+
+    def is_idle(self, now: float) -> bool:
+        """Bucket полон и давно не использовался - его можно удалить."""
+        self._refill(now)
+        return self.tokens >= self.capacity and now - self.updated > BUCKET_IDLE_TTL
+
+class AdmissionController:
+    """
+    Контроль допуска обновлений перед обработчиками.
+
+    Args:
+        rate: Скорость пополнения токенов пользователя (токенов в секунду)
+        burst: Максимальный запас токенов пользователя
+        concurrency: Максимальное число одновременно обрабатываемых обновлений
+        mode: "queue" - ждать освобождения ресурсов, "reject" - сразу отклонять
+        max_wait: Максимальное время ожидания в режиме "queue" (в секундах)
+    """
+
+    def __init__(self, rate: float = USER_RATE, burst: int = USER_BURST,
+                 concurrency: int = GLOBAL_CONCURRENCY, mode: str = ADMISSION_MODE,
+                 max_wait: float = MAX_QUEUE_WAIT):
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.mode = mode if mode in ("queue", "reject") else "queue"
+        self.max_wait = max_wait
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._in_flight = 0
+        # Корзины токенов пользователей {user_id: TokenBucket}
+        self._buckets: Dict[int, TokenBucket] = {}
+        # Решения по альбомам {media_group_id: (Future с решением, timestamp)}
+        self._media_groups: Dict[str, Tuple[asyncio.Future, float]] = {}
+        # Очередь обработки обновлений пользователя {user_id: [Lock, число ожидающих и владельца]}
+        self._user_locks: Dict[int, list] = {}
+        # Когда пользователю последний раз сообщали об ограничении {user_id: timestamp}
+        self._last_notice: Dict[int, float] = {}
+        self._last_prune = time.monotonic()
+        # Счетчики для мониторинга
+        self.stats: Dict[str, int] = {
+            "admitted": 0,
+            "rejected": 0,
+            "queued": 0,
+            "coalesced": 0,
+            "serialized": 0,
+        }
+
+    def _get_bucket(self, user_id: int) -> TokenBucket:
+        """Получить (или создать) корзину токенов пользователя."""
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self._buckets[user_id] = bucket
+        return bucket
+
+    def _prune(self, now: float) -> None:
+        """Удалить неактивные корзины и устаревшие решения по альбомам."""
+        if now - self._last_prune < MEDIA_GROUP_TTL:
+            return
+        self._last_prune = now
+        for user_id in [uid for uid, bucket in self._buckets.items() if bucket.is_idle(now)]:
+            del self._buckets[user_id]
+        for group_id in [gid for gid, (_, ts) in self._media_groups.items() if now - ts > MEDIA_GROUP_TTL]:
+            del self._media_groups[group_id]
+        for user_id in [uid for uid, ts in self._last_notice.items() if now - ts > REJECT_NOTICE_INTERVAL]:
+            del self._last_notice[user_id]
+
+    async def _acquire_user_token(self, user_id: int) -> bool:
+        """Забрать токен пользователя, при необходимости подождав в очереди."""
+        bucket = self._get_bucket(user_id)
+        if bucket.try_acquire():
+            return True
+
+        if self.mode != "queue":
+            return False
+
+        wait_time = bucket.time_until_available()
+        if wait_time > self.max_wait:
+            return False
+
+        # Ждем, пока накопится токен
+        self.stats["queued"] += 1
+        await asyncio.sleep(wait_time)
+        return bucket.try_acquire()
+
+    async def admit(self, update: Any) -> bool:
+        """
+        Решить, допускать ли обновление к обработке.
+
+        Все фотографии одного альбома получают одно общее решение и расходуют
+        один токен пользователя.
+
+        Returns:
+            bool: True, если обновление можно обрабатывать
+        """
+        now = time.monotonic()
+        self._prune(now)
+
+        user = getattr(update, "effective_user", None)
+        if user is None:
+            # Служебные обновления без пользователя не ограничиваем
+            return True
+
+        message = getattr(update, "effective_message", None)
+        media_group_id = getattr(message, "media_group_id", None) if message else None
+        if media_group_id and media_group_id in self._media_groups:
+            # Остальные фото альбома ждут решения по первому, не расходуя свои токены
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(self._media_groups[media_group_id][0])
+
+        decision = None
+        if media_group_id:
+            decision = asyncio.get_running_loop().create_future()
+            self._media_groups[media_group_id] = (decision, now)
+
+        try:
+            admitted = await self._acquire_user_token(user.id)
+        except BaseException:
+            if decision is not None and not decision.done():
+                decision.set_result(False)
+            raise
+
+        if decision is not None:
+            decision.set_result(admitted)
+
+        if admitted:
+            self.stats["admitted"] += 1
+        else:
+            self.stats["rejected"] += 1
+            logger.warning(f"Обновление от пользователя {user.id} отклонено контролем допуска")
+        return admitted
+
+    async def _notify_rejected(self, update: Any) -> None:
+        """Сообщить пользователю об ограничении, не чаще раза в REJECT_NOTICE_INTERVAL."""
+        user = update.effective_user
+        now = time.monotonic()
+        try:
+            if getattr(update, "callback_query", None):
+                # На callback нужно ответить в любом случае, иначе кнопка "зависнет"
+                await update.callback_query.answer("Слишком много запросов. Подождите немного.")
+                return
+
+            if now - self._last_notice.get(user.id, 0) < REJECT_NOTICE_INTERVAL:
+                return
+            self._last_notice[user.id] = now
+
+            if getattr(update, "effective_message", None):
+                await update.effective_message.reply_text(
+                    "⏳ Слишком много запросов. Пожалуйста, подождите несколько секунд и попробуйте снова."
+                )
+        except Exception as e:
+            logger.warning(f"Не удалось уведомить пользователя {user.id} об ограничении: {e}")
+
+    async def _enter_user(self, user_id: int) -> Optional[asyncio.Lock]:
+        """Дождаться окончания обработки предыдущих обновлений пользователя (не дольше max_wait)."""
+        entry = self._user_locks.get(user_id)
+        if entry is None:
+            entry = self._user_locks[user_id] = [asyncio.Lock(), 0]
+        lock = entry[0]
+        entry[1] += 1
+        if entry[1] > 1:
+            self.stats["serialized"] += 1
+        try:
+            await asyncio.wait_for(lock.acquire(), timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            self._leave_user(user_id, None)
+            return None
+        return lock
+
+    def _leave_user(self, user_id: int, lock: Optional[asyncio.Lock]) -> None:
+        if lock is not None:
+            lock.release()
+        entry = self._user_locks.get(user_id)
+        if entry is not None:
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self._user_locks[user_id]
+
+    @asynccontextmanager
+    async def user_turn(self, update: Any):
+        """
+        Выполнить блок в общей очереди обновлений пользователя - для работы,
+        запускаемой вне обработчиков (например, собранного альбома).
+
+        Yields:
+            bool: False, если очередь не подошла за max_wait (пользователь уведомлен)
+        """
+        user_id = update.effective_user.id
+        lock = await self._enter_user(user_id)
+        if lock is None:
+            self.stats["rejected"] += 1
+            logger.warning(f"Обновление от пользователя {user_id} отклонено: предыдущее еще обрабатывается")
+            await self._notify_rejected(update)
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            self._leave_user(user_id, lock)
+
+    def wrap(self, handler):
+        """Обернуть обработчик контролем допуска."""
+        @wraps(handler)
+        async def wrapper(update, context, *args, **kwargs):
+            if not await self.admit(update):
+                await self._notify_rejected(update)
+                return None
+
+            # Обновления одного пользователя обрабатываем по очереди
+            user = getattr(update, "effective_user", None)
+            user_lock = None
+            if user is not None:
+                user_lock = await self._enter_user(user.id)
+                if user_lock is None:
+                    self.stats["rejected"] += 1
+                    logger.warning(f"Обновление от пользователя {user.id} отклонено: предыдущее еще обрабатывается")
+                    await self._notify_rejected(update)
+                    return None
+            try:
+                return await self._run_admitted(handler, update, context, *args, **kwargs)
+            finally:
+                if user is not None:
+                    self._leave_user(user.id, user_lock)
+        return wrapper
+
+    async def _run_admitted(self, handler, update, context, *args, **kwargs):
+        """Вызвать обработчик с учетом глобального ограничения одновременной обработки."""
+        # Глобальное ограничение на количество одновременно обрабатываемых обновлений
+        if self.mode == "reject" and self._semaphore.locked():
+            self.stats["rejected"] += 1
+            await self._notify_rejected(update)
+            return None
+
+        if self._semaphore.locked():
+            self.stats["queued"] += 1
+
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.max_wait)
+        except asyncio.TimeoutError:
+            self.stats["rejected"] += 1
+            logger.warning("Обновление отклонено: превышен глобальный лимит одновременной обработки")
+            await self._notify_rejected(update)
+            return None
+
+        self._in_flight += 1
+        try:
+            return await handler(update, context, *args, **kwargs)
+        finally:
+            self._in_flight -= 1
+            self._semaphore.release()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Получить счетчики контроля допуска."""
+        return {
+            **self.stats,
+            "in_flight": self._in_flight,
+            "tracked_users": len(self._buckets),
+            "tracked_media_groups": len(self._media_groups),
+            "busy_users": len(self._user_locks),
+        }
+
+# Глобальный контроллер допуска
+admission = AdmissionController()
+
+def admission_control(handler):
+    """Декоратор: пропускает обновление к обработчику только после контроля допуска."""
+    return admission.wrap(handler)
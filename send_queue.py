@@ -0,0 +1,302 @@
+"""
+Модуль очереди исходящих запросов к Telegram.
+
+Все фоновые отправки (результаты генерации, статусы, служебные сообщения) проходят
+через единый планировщик, который соблюдает общий лимит Telegram (~30 сообщений в
+секунду) и лимит на один чат (~1 сообщение в секунду), повторяет запросы после
+RetryAfter и отправляет результаты раньше обновлений статусов. После таймаута
+ответа повторяются только идемпотентные запросы (редактирование, удаление):
+сообщение или фото могли уже дойти до пользователя, и повтор продублирует его.
+"""
+import os
+import time
+import asyncio
+import logging
+import itertools
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+import httpx
+from telegram.error import BadRequest, RetryAfter, TimedOut, NetworkError
+
+from rate_limit import TokenBucket
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Приоритеты (меньше - важнее)
+PRIORITY_RESULT = 0   # Готовые изображения и платежи
+PRIORITY_MESSAGE = 1  # Обычные сообщения
+PRIORITY_STATUS = 2   # Обновления и удаление статусных сообщений
+
+# Лимиты Telegram Bot API
+GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))  # Сообщений в секунду на весь бот
+PER_CHAT_RATE = float(os.getenv("TELEGRAM_PER_CHAT_RATE", "1"))  # Сообщений в секунду в одном чате
+PER_CHAT_BURST = int(os.getenv("TELEGRAM_PER_CHAT_BURST", "3"))  # Допустимый всплеск в одном чате
+MAX_IN_FLIGHT = int(os.getenv("TELEGRAM_MAX_IN_FLIGHT", "30"))  # Одновременных HTTP-запросов
+MAX_RETRIES = 3
+
+# Ошибки httpx, при которых запрос точно не был отправлен в Telegram
+_NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+class OutboundStopped(Exception):
+    """Очередь исходящих остановлена до отправки запроса."""
+
+def _was_not_sent(error: Exception) -> bool:
+    """Ошибка возникла до отправки запроса (соединение не установлено)."""
+    return isinstance(error.__cause__, _NOT_SENT_ERRORS)
+
+class _OutboundItem:
+    """Один запрос в очереди исходящих."""
+
+    __slots__ = ("factory", "chat_id", "priority", "future", "idempotent", "enqueued_at", "attempts")
+
+    def __init__(self, factory: Callable[[], Awaitable[Any]], chat_id: Optional[int],
+                 priority: int, future: asyncio.Future, idempotent: bool = False):
+        self.factory = factory
+        self.chat_id = chat_id
+        self.priority = priority
+        self.future = future
+        self.idempotent = idempotent
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+class OutboundScheduler:
+    """
+    Планировщик исходящих запросов с приоритетами и ограничением частоты.
+
+    Args:
+        global_rate: Общий лимит запросов в секунду
+        per_chat_rate: Лимит запросов в секунду для одного чата
+        per_chat_burst: Допустимый всплеск запросов в одном чате
+        max_in_flight: Максимальное количество одновременно выполняемых запросов
+        max_retries: Сколько раз повторять запрос после RetryAfter или сетевой ошибки
+    """
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, per_chat_rate: float = PER_CHAT_RATE,
+                 per_chat_burst: int = PER_CHAT_BURST, max_in_flight: int = MAX_IN_FLIGHT,
+                 max_retries: int = MAX_RETRIES):
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_retries = max_retries
+        self._global_bucket = TokenBucket(global_rate, max(1, int(global_rate)))
+        # Корзины токенов чатов {chat_id: TokenBucket}
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        # Чаты, которым Telegram велел подождать {chat_id: monotonic time}
+        self._chat_blocked_until: Dict[int, float] = {}
+        self._global_blocked_until = 0.0
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self._sequence = itertools.count()
+        self._worker_task: Optional[asyncio.Task] = None
+        # Выполняемые запросы (ссылки нужны, чтобы задачи не собрал сборщик мусора)
+        self._dispatch_tasks: Set[asyncio.Task] = set()
+        # Запросы, результат которых еще не получен (включая отложенные повторы)
+        self._pending = 0
+        # Счетчики для мониторинга
+        self.stats: Dict[str, float] = {
+            "submitted": 0,
+            "sent": 0,
+            "failed": 0,
+            "throttled": 0,
+            "retry_after": 0,
+            "timeouts_not_retried": 0,
+            "total_wait_ms": 0.0,
+            "max_wait_ms": 0.0,
+        }
+
+    def _ensure_running(self) -> None:
+        """Запустить обработчик очереди, если он еще не запущен."""
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        if self._worker_task is None or self._worker_task.done():
+            self._worker_task = asyncio.create_task(self._run())
+
+    def _put(self, item: _OutboundItem) -> None:
+        """Поставить запрос в очередь с учетом приоритета и порядка поступления."""
+        if self._worker_task is None:
+            # Очередь остановлена, пока запрос ждал повтора
+            self._fail(item, OutboundStopped("Очередь исходящих остановлена"))
+            return
+        self._queue.put_nowait((item.priority, next(self._sequence), item))
+
+    def _requeue_later(self, item: _OutboundItem, delay: float) -> None:
+        """Вернуть запрос в очередь через delay секунд, не блокируя остальные чаты."""
+        asyncio.get_running_loop().call_later(max(0.0, delay), self._put, item)
+
+    async def submit(self, factory: Callable[[], Awaitable[Any]], chat_id: Optional[int] = None,
+                     priority: int = PRIORITY_MESSAGE, idempotent: bool = False) -> Any:
+        """
+        Поставить запрос в очередь и дождаться его выполнения.
+
+        Args:
+            factory: Функция без аргументов, создающая корутину запроса
+                     (нужна фабрика, чтобы запрос можно было повторить)
+            chat_id: ID чата для соблюдения лимита на чат
+            priority: Приоритет запроса (PRIORITY_RESULT, PRIORITY_MESSAGE, PRIORITY_STATUS)
+            idempotent: Запрос можно безопасно повторить после таймаута ответа
+                        (редактирование, удаление); отправки сообщений и фото не повторяются
+
+        Returns:
+            Результат вызова Telegram API
+        """
+        self._ensure_running()
+        future = asyncio.get_running_loop().create_future()
+        self._pending += 1
+        future.add_done_callback(self._settled)
+        self._put(_OutboundItem(factory, chat_id, priority, future, idempotent))
+        self.stats["submitted"] += 1
+        return await future
+
+    def _settled(self, _future: asyncio.Future) -> None:
+        self._pending -= 1
+
+    def _chat_delay(self, chat_id: Optional[int], now: float) -> float:
+        """Сколько секунд чат должен подождать перед следующим запросом."""
+        if chat_id is None:
+            return 0.0
+        blocked = self._chat_blocked_until.get(chat_id, 0.0) - now
+        if blocked > 0:
+            return blocked
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) > 10000:
+                self._prune_chats(now)
+            bucket = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        if bucket.try_acquire():
+            return 0.0
+        return bucket.time_until_available()
+
+    def _prune_chats(self, now: float) -> None:
+        """Удалить корзины неактивных чатов и истекшие блокировки."""
+        for chat_id in [cid for cid, bucket in self._chat_buckets.items() if bucket.is_idle(now)]:
+            del self._chat_buckets[chat_id]
+        for chat_id in [cid for cid, until in self._chat_blocked_until.items() if until < now]:
+            del self._chat_blocked_until[chat_id]
+
+    async def _run(self) -> None:
+        """Главный цикл: выдает запросы из очереди с соблюдением лимитов."""
+        logger.info("Запущена очередь исходящих запросов Telegram")
+        try:
+            while True:
+                _, _, item = await self._queue.get()
+                if item.future.done():
+                    continue
+
+                now = time.monotonic()
+
+                # Лимит на чат: откладываем запрос, не задерживая другие чаты
+                delay = self._chat_delay(item.chat_id, now)
+                if delay > 0:
+                    self.stats["throttled"] += 1
+                    self._requeue_later(item, delay)
+                    continue
+
+                # Общий лимит бота: ждем токен (или окончание глобального RetryAfter)
+                if self._global_blocked_until > now:
+                    await asyncio.sleep(self._global_blocked_until - now)
+                wait = self._global_bucket.time_until_available()
+                if wait > 0:
+                    self.stats["throttled"] += 1
+                    await asyncio.sleep(wait)
+                self._global_bucket.try_acquire()
+
+                await self._in_flight.acquire()
+                task = asyncio.create_task(self._dispatch(item))
+                self._dispatch_tasks.add(task)
+                task.add_done_callback(self._dispatch_tasks.discard)
+        except asyncio.CancelledError:
+            logger.info("Очередь исходящих запросов Telegram остановлена")
+
+    async def _dispatch(self, item: _OutboundItem) -> None:
+        """Выполнить запрос и обработать RetryAfter и временные сетевые ошибки."""
+        wait_ms = (time.monotonic() - item.enqueued_at) * 1000
+        item.attempts += 1
+        try:
+            result = await item.factory()
+        except RetryAfter as e:
+            self.stats["retry_after"] += 1
+            retry_after = float(e.retry_after)
+            now = time.monotonic()
+            if item.chat_id is not None:
+                self._chat_blocked_until[item.chat_id] = now + retry_after
+            else:
+                self._global_blocked_until = now + retry_after
+            logger.warning(f"Telegram RetryAfter {retry_after} сек. для чата {item.chat_id} (попытка {item.attempts})")
+            self._retry_or_fail(item, e, retry_after)
+        except BadRequest as e:
+            # BadRequest наследуется от NetworkError, но повторять такие запросы бессмысленно
+            self._fail(item, e)
+        except (TimedOut, NetworkError) as e:
+            if item.idempotent or _was_not_sent(e):
+                logger.warning(f"Сетевая ошибка при отправке в чат {item.chat_id}: {e} (попытка {item.attempts})")
+                self._retry_or_fail(item, e, float(item.attempts))
+            else:
+                # Запрос мог дойти до Telegram: повтор продублирует сообщение
+                self.stats["timeouts_not_retried"] += 1
+                logger.warning(f"Нет ответа Telegram для чата {item.chat_id}: {e}, запрос не повторяется")
+                self._fail(item, e)
+        except Exception as e:
+            self._fail(item, e)
+        else:
+            self.stats["sent"] += 1
+            self.stats["total_wait_ms"] += wait_ms
+            self.stats["max_wait_ms"] = max(self.stats["max_wait_ms"], wait_ms)
+            if not item.future.done():
+                item.future.set_result(result)
+        finally:
+            self._in_flight.release()
+
+    def _retry_or_fail(self, item: _OutboundItem, error: Exception, delay: float) -> None:
+        """Повторить запрос позже или завершить его ошибкой, если попытки исчерпаны."""
+        if item.attempts <= self.max_retries and not item.future.done():
+            self._requeue_later(item, delay)
+            return
+        self._fail(item, error)
+
+    def _fail(self, item: _OutboundItem, error: Exception) -> None:
+        """Завершить запрос ошибкой."""
+        self.stats["failed"] += 1
+        if not item.future.done():
+            item.future.set_exception(error)
+
+    async def drain(self, timeout: float) -> bool:
+        """Дождаться отправки всех поставленных запросов. Возвращает False, если не успели за timeout."""
+        deadline = time.monotonic() + timeout
+        while self._pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._pending:
+            logger.warning(f"Не отправлено запросов из очереди исходящих: {self._pending}")
+        return not self._pending
+
+    async def stop(self) -> None:
+        """Остановить обработчик очереди и завершить ошибкой все неотправленные запросы."""
+        if self._worker_task and not self._worker_task.done():
+            self._worker_task.cancel()
+            try:
+                await self._worker_task
+            except asyncio.CancelledError:
+                pass
+        self._worker_task = None
+        # Отложенные повторы завершаются ошибкой в _put, оставшиеся в очереди - здесь
+        dropped = 0
+        while self._queue is not None and not self._queue.empty():
+            _, _, item = self._queue.get_nowait()
+            if not item.future.done():
+                dropped += 1
+                self._fail(item, OutboundStopped("Очередь исходящих остановлена"))
+        if dropped:
+            logger.warning(f"Очередь исходящих остановлена, не отправлено запросов: {dropped}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Получить метрики очереди исходящих запросов."""
+        sent = self.stats["sent"]
+        return {
+            **self.stats,
+            "avg_wait_ms": round(self.stats["total_wait_ms"] / sent, 2) if sent else 0.0,
+            "queue_size": self._queue.qsize() if self._queue else 0,
+            "pending": self._pending,
+        }
+
+# Глобальная очередь исходящих запросов
+outbound = OutboundScheduler()
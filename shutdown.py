@@ -0,0 +1,173 @@
+"""
+Модуль корректной остановки бота.
+
+По SIGTERM (Railway при деплое и перезапуске) или SIGINT координатор:
+1. прекращает прием обновлений;
+2. ждет завершения фоновых генераций до SHUTDOWN_DRAIN_TIMEOUT секунд, а
+   незавершенные отменяет - задачи сами возвращают звезды через журнал
+   начислений и предупреждают пользователя;
+3. по очереди выполняет шаги остановки (отправка очереди сообщений, запись
+   статистики, применение журнала начислений, закрытие пула соединений),
+   ограничивая каждый SHUTDOWN_STEP_TIMEOUT секундами;
+4. пишет в лог отчет: время ожидания задач, брошенные задачи и длительность шагов.
+"""
+import os
+import time
+import signal
+import asyncio
+import inspect
+import logging
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Tuple
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Сколько ждать завершения генераций (Railway ждет после SIGTERM ограниченное время)
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "20"))
+# Сколько дать отмененным задачам на возврат звезд и сообщение пользователю
+SHUTDOWN_CANCEL_GRACE = float(os.getenv("SHUTDOWN_CANCEL_GRACE", "5"))
+# Предел для каждого шага остановки
+SHUTDOWN_STEP_TIMEOUT = float(os.getenv("SHUTDOWN_STEP_TIMEOUT", "10"))
+
+Step = Tuple[str, Callable[[], Any]]
+
+class ShutdownCoordinator:
+    """
+    Координатор остановки: сигналы, учет фоновых задач и порядок шагов остановки.
+
+    Args:
+        drain_timeout: Сколько ждать завершения фоновых задач
+        step_timeout: Предел для каждого шага остановки
+    """
+
+    def __init__(self, drain_timeout: float = SHUTDOWN_DRAIN_TIMEOUT, step_timeout: float = SHUTDOWN_STEP_TIMEOUT):
+        self.drain_timeout = drain_timeout
+        self.step_timeout = step_timeout
+        self.stopping = False
+        self.reason: Optional[str] = None
+        self._event = asyncio.Event()
+        # Фоновые задачи {задача: описание для отчета}
+        self._jobs: Dict[asyncio.Task, str] = {}
+        self.stats: Dict[str, int] = {"spawned": 0, "completed": 0, "abandoned": 0}
+        self.report: Dict[str, Any] = {}
+
+    def install_signal_handlers(self) -> None:
+        """Перехватывать SIGTERM и SIGINT вместо немедленного завершения процесса."""
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                loop.add_signal_handler(sig, self.request, sig.name)
+            except NotImplementedError:
+                # Windows: обработчик вызывается вне цикла событий
+                signal.signal(sig, lambda signum, frame: loop.call_soon_threadsafe(
+                    self.request, signal.Signals(signum).name))
+
+    def request(self, reason: str = "request") -> None:
+        """Начать остановку (повторные сигналы игнорируются)."""
+        if self.stopping:
+            return
+        self.stopping = True
+        self.reason = reason
+        logger.warning(f"Получен сигнал остановки ({reason}), завершаем работу")
+        self._event.set()
+
+    async def wait(self, timeout: Optional[float] = None) -> bool:
+        """Ждать сигнала остановки не дольше timeout. Возвращает True, если остановка началась."""
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.stopping
+
+    def spawn(self, coro: Coroutine, name: str) -> asyncio.Task:
+        """Запустить фоновую задачу, которую нужно дождаться при остановке."""
+        task = asyncio.create_task(coro)
+        self._jobs[task] = name
+        self.stats["spawned"] += 1
+        task.add_done_callback(self._job_done)
+        return task
+
+    def _job_done(self, task: asyncio.Task) -> None:
+        if self._jobs.pop(task, None) is not None and not task.cancelled():
+            self.stats["completed"] += 1
+
+    async def drain(self) -> Tuple[float, List[str]]:
+        """
+        Дождаться фоновых задач, незавершенные к сроку отменить.
+
+        Returns:
+            Tuple[float, List[str]]: Время ожидания и описания брошенных задач
+        """
+        started = time.monotonic()
+        deadline = started + self.drain_timeout
+        # Задачи, запущенные уже во время ожидания, тоже дожидаемся
+        while self._jobs and time.monotonic() < deadline:
+            await asyncio.wait(set(self._jobs), timeout=deadline - time.monotonic())
+
+        abandoned = list(self._jobs.items())
+        for task, _ in abandoned:
+            task.cancel()
+        if abandoned:
+            # Отмененные задачи возвращают звезды и сообщают пользователю
+            await asyncio.wait([task for task, _ in abandoned], timeout=SHUTDOWN_CANCEL_GRACE)
+            self.stats["abandoned"] += len(abandoned)
+        return time.monotonic() - started, [name for _, name in abandoned]
+
+    async def _run_step(self, name: str, step: Callable[[], Any]) -> Dict[str, Any]:
+        started = time.monotonic()
+        result: Dict[str, Any] = {"step": name}
+        try:
+            outcome = step()
+            if inspect.isawaitable(outcome):
+                await asyncio.wait_for(outcome, self.step_timeout)
+            result["ok"] = True
+        except asyncio.TimeoutError:
+            result["ok"] = False
+            result["error"] = f"не завершился за {self.step_timeout:g} с"
+        except Exception as e:
+            result["ok"] = False
+            result["error"] = str(e)
+        result["seconds"] = round(time.monotonic() - started, 3)
+        if not result["ok"]:
+            logger.error(f"Шаг остановки '{name}': {result['error']}")
+        return result
+
+    async def shutdown(self, stop_intake: List[Step], flush: List[Step]) -> Dict[str, Any]:
+        """
+        Выполнить остановку.
+
+        Args:
+            stop_intake: Шаги, прекращающие прием новой работы (выполняются до ожидания задач)
+            flush: Шаги записи накопленных данных и освобождения ресурсов, по порядку
+
+        Returns:
+            Dict[str, Any]: Отчет об остановке
+        """
+        self.stopping = True
+        started = time.monotonic()
+        steps = [await self._run_step(name, step) for name, step in stop_intake]
+        drain_seconds, abandoned = await self.drain()
+        steps += [await self._run_step(name, step) for name, step in flush]
+
+        self.report = {
+            "reason": self.reason or "exit",
+            "drain_seconds": round(drain_seconds, 3),
+            "jobs_completed": self.stats["completed"],
+            "jobs_abandoned": abandoned,
+            "steps": steps,
+            "total_seconds": round(time.monotonic() - started, 3),
+        }
+        failed = [s["step"] for s in steps if not s["ok"]]
+        logger.info(f"Остановка завершена за {self.report['total_seconds']} с: ожидание задач "
+                    f"{self.report['drain_seconds']} с, брошено задач {len(abandoned)}"
+                    f"{', ошибки в шагах: ' + ', '.join(failed) if failed else ''}")
+        if abandoned:
+            logger.warning(f"Брошенные при остановке задачи: {', '.join(abandoned)}")
+        logger.info(f"Отчет об остановке: {self.report}")
+        return self.report
+
+    def get_stats(self) -> dict:
+        return {**self.stats, "running": len(self._jobs), "stopping": self.stopping}
+
+# Глобальный экземпляр
+shutdown = ShutdownCoordinator()
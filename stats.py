@@ -0,0 +1,322 @@
+"""
+Модуль накопления статистики бота в памяти с периодической записью в PostgreSQL.
+
+Вместо отдельного UPDATE bot_stats на каждое событие счетчики копятся в памяти
+и раз в STATS_FLUSH_INTERVAL секунд записываются пакетом через upsert с
+прибавлением. Почасовые агрегаты (генерации по стилям, возвраты, платежи,
+гистограммы задержек OpenAI, активные пользователи) хранятся в stats_hourly,
+а сводка по таблице users пересчитывается по расписанию в stats_rollup.
+"""
+import os
+import time
+import asyncio
+import logging
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Период записи накопленных счетчиков (в секундах)
+STATS_FLUSH_INTERVAL = float(os.getenv("STATS_FLUSH_INTERVAL", "30"))
+# Период пересчета сводки по пользователям (в секундах)
+STATS_ROLLUP_INTERVAL = float(os.getenv("STATS_ROLLUP_INTERVAL", "600"))
+# Сколько секунд отдавать отчет администратора из кэша
+REPORT_CACHE_TTL = float(os.getenv("STATS_REPORT_CACHE_TTL", "60"))
+
+# Границы корзин гистограммы задержек (в миллисекундах); последняя корзина - "inf"
+LATENCY_BUCKETS_MS = [250, 500, 1000, 2000, 5000, 10000, 15000, 20000, 30000, 45000, 60000, 90000, 120000]
+
+def hour_bucket(moment: Optional[datetime] = None) -> datetime:
+    """Начало часа для почасовых агрегатов."""
+    return (moment or datetime.now()).replace(minute=0, second=0, microsecond=0)
+
+def latency_bucket(value_ms: float) -> str:
+    """Верхняя граница корзины гистограммы для значения задержки."""
+    index = bisect_left(LATENCY_BUCKETS_MS, value_ms)
+    return str(LATENCY_BUCKETS_MS[index]) if index < len(LATENCY_BUCKETS_MS) else "inf"
+
+class StatsCollector:
+    """
+    Накопитель статистики.
+
+    Все методы record_* и increment синхронные и только обновляют словари
+    в памяти, поэтому их можно вызывать из горячих путей обработчиков.
+    """
+
+    def __init__(self, flush_interval: float = STATS_FLUSH_INTERVAL,
+                 rollup_interval: float = STATS_ROLLUP_INTERVAL):
+        self.flush_interval = flush_interval
+        self.rollup_interval = rollup_interval
+        # Приращения счетчиков bot_stats {stat_name: delta}
+        self._counters: Dict[str, int] = defaultdict(int)
+        # Почасовые агрегаты {(bucket, metric, dimension): [count, total]}
+        self._hourly: Dict[Tuple[datetime, str, str], List[float]] = defaultdict(lambda: [0, 0.0])
+        # Активные пользователи {(bucket, user_id)}
+        self._active: Set[Tuple[datetime, int]] = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._last_rollup = 0.0
+        self.stats = {"flushes": 0, "flush_errors": 0, "rows_written": 0, "rollups": 0}
+
+    # --- Накопление событий ---
+
+    def increment(self, stat_name: str, amount: int = 1) -> None:
+        """Увеличить счетчик bot_stats."""
+        self._counters[stat_name] += amount
+
+    def record(self, metric: str, dimension: str = "", value: float = 0.0, count: int = 1) -> None:
+        """Добавить событие в почасовой агрегат."""
+        entry = self._hourly[(hour_bucket(), metric, dimension)]
+        entry[0] += count
+        entry[1] += value
+
+    def record_latency(self, metric: str, value_ms: float, dimension: str = "") -> None:
+        """Учесть задержку: сумму для среднего и корзину гистограммы для перцентилей."""
+        self.record(metric, dimension, value_ms)
+        self.record(f"{metric}_hist", latency_bucket(value_ms))
+
+    def record_active_user(self, user_id: Optional[int]) -> None:
+        if user_id:
+            self._active.add((hour_bucket(), user_id))
+
+    def record_generation(self, style: str, success: bool, latency_ms: Optional[float] = None) -> None:
+        """Учесть завершенную генерацию изображения."""
+        if success:
+            self.increment("generations")
+            self.record("generations", style)
+            if latency_ms is not None:
+                self.record_latency("openai_latency_ms", latency_ms)
+        else:
+            self.increment("generation_errors")
+            self.record("generation_errors", style)
+
+    def record_refund(self, style: str, stars: int, count: int = 1) -> None:
+        """Учесть возврат звезд за неудачные генерации."""
+        self.increment("refunds", count)
+        self.record("refunds", style, stars, count)
+
+    def record_payment(self, stars: int) -> None:
+        """Учесть успешную оплату пакета звезд."""
+        self.increment("payments")
+        self.record("payments", str(stars), stars)
+
+    # --- Запись в базу ---
+
+    async def flush(self) -> int:
+        """
+        Записать накопленные приращения одной транзакцией.
+
+        Returns:
+            int: Количество записанных строк
+        """
+        if not (self._counters or self._hourly or self._active):
+            return 0
+
+        # Забираем накопленное; при ошибке вернем обратно
+        counters, self._counters = self._counters, defaultdict(int)
+        hourly, self._hourly = self._hourly, defaultdict(lambda: [0, 0.0])
+        active, self._active = self._active, set()
+
+        try:
+            from db import acquire
+            async with acquire() as conn:
+                async with conn.transaction():
+                    # Ключи сортируются, чтобы параллельные экземпляры блокировали строки в одном порядке
+                    if counters:
+                        await conn.executemany('''
+                            INSERT INTO bot_stats (stat_name, value, last_updated)
+                            VALUES ($1, $2, CURRENT_TIMESTAMP)
+                            ON CONFLICT (stat_name) DO UPDATE SET
+                                value = bot_stats.value + EXCLUDED.value,
+                                last_updated = EXCLUDED.last_updated
+                        ''', sorted(counters.items()))
+                    if hourly:
+                        await conn.executemany('''
+                            INSERT INTO stats_hourly (bucket, metric, dimension, count, total)
+                            VALUES ($1, $2, $3, $4, $5)
+                            ON CONFLICT (bucket, metric, dimension) DO UPDATE SET
+                                count = stats_hourly.count + EXCLUDED.count,
+                                total = stats_hourly.total + EXCLUDED.total
+                        ''', sorted((b, m, d, int(c), float(t)) for (b, m, d), (c, t) in hourly.items()))
+                    if active:
+                        await conn.executemany('''
+                            INSERT INTO stats_hourly_users (bucket, user_id) VALUES ($1, $2)
+                            ON CONFLICT DO NOTHING
+                        ''', sorted(active))
+                        # Число уникальных пользователей за час пересчитывается по первичному ключу
+                        await conn.execute('''
+                            INSERT INTO stats_hourly (bucket, metric, dimension, count, total)
+                            SELECT bucket, 'active_users', '', COUNT(1), 0
+                            FROM stats_hourly_users WHERE bucket = ANY($1::timestamp[])
+                            GROUP BY bucket
+                            ON CONFLICT (bucket, metric, dimension) DO UPDATE SET count = EXCLUDED.count
+                        ''', sorted({bucket for bucket, _ in active}))
+        except Exception as e:
+            logger.error(f"Ошибка при записи статистики: {e}")
+            self.stats["flush_errors"] += 1
+            self._merge_back(counters, hourly, active)
+            return 0
+
+        rows = len(counters) + len(hourly) + len(active)
+        self.stats["flushes"] += 1
+        self.stats["rows_written"] += rows
+        return rows
+
+    def _merge_back(self, counters, hourly, active) -> None:
+        """Вернуть незаписанные приращения в накопитель."""
+        for name, value in counters.items():
+            self._counters[name] += value
+        for key, (count, total) in hourly.items():
+            entry = self._hourly[key]
+            entry[0] += count
+            entry[1] += total
+        self._active |= active
+
+    async def refresh_rollup(self) -> None:
+        """Пересчитать сводку по пользователям (раз в STATS_ROLLUP_INTERVAL)."""
+        from db import refresh_user_stats_rollup
+        if await refresh_user_stats_rollup():
+            self.stats["rollups"] += 1
+            self._last_rollup = time.monotonic()
+
+    async def _flush_loop(self) -> None:
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+                if time.monotonic() - self._last_rollup >= self.rollup_interval:
+                    await self.refresh_rollup()
+        except asyncio.CancelledError:
+            pass
+
+    def start(self) -> None:
+        """Запустить периодическую запись статистики."""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self) -> None:
+        """Остановить периодическую запись и сбросить остаток в базу."""
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+        self._flush_task = None
+        await self.flush()
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "pending_counters": len(self._counters),
+            "pending_hourly": len(self._hourly),
+            "pending_active": len(self._active),
+        }
+
+# Глобальный экземпляр
+stats_collector = StatsCollector()
+
+def _histogram_percentile(buckets: Dict[str, int], p: float) -> Optional[float]:
+    """Оценка перцентиля по гистограмме: верхняя граница корзины, в которую он попадает."""
+    total = sum(buckets.values())
+    if not total:
+        return None
+    ordered = sorted(buckets.items(), key=lambda item: float(item[0]))
+    threshold = total * p / 100
+    seen = 0
+    for bound, count in ordered:
+        seen += count
+        if seen >= threshold:
+            return float(bound)
+    return float(ordered[-1][0])
+
+# Кэш готового отчета {hours: (время построения, отчет)}
+_report_cache: Dict[int, Tuple[float, dict]] = {}
+
+async def build_report(hours: int = 24) -> dict:
+    """
+    Построить отчет для администратора только по агрегатам.
+
+    Читает stats_hourly за последние hours часов (несколько сотен строк по первичному
+    ключу), stats_rollup и bot_stats; сырые user_actions и balance_history не сканируются.
+    Готовый отчет кэшируется на REPORT_CACHE_TTL секунд.
+    """
+    cached = _report_cache.get(hours)
+    if cached and time.monotonic() - cached[0] < REPORT_CACHE_TTL:
+        return cached[1]
+
+    from db import acquire_read, get_user_stats
+    since = hour_bucket() - timedelta(hours=hours - 1)
+    # Тяжелые агрегаты читаются с реплики, если она есть, чтобы не мешать списаниям и платежам
+    async with acquire_read() as conn:
+        hourly = await conn.fetch('''
+            SELECT bucket, metric, dimension, count, total FROM stats_hourly
+            WHERE bucket >= $1
+        ''', since)
+        counters = await conn.fetch('SELECT stat_name, value FROM bot_stats')
+    users = await get_user_stats()
+
+    per_style: Dict[str, Dict[str, int]] = defaultdict(lambda: {"generations": 0, "errors": 0, "refunds": 0})
+    packages: Dict[str, Dict[str, float]] = defaultdict(lambda: {"payments": 0, "stars": 0})
+    latency_hist: Dict[str, int] = defaultdict(int)
+    latency_count, latency_total = 0, 0.0
+    active_by_hour: Dict[str, int] = {}
+    refunds = 0
+
+    for row in hourly:
+        metric, dimension = row['metric'], row['dimension']
+        if metric == "generations":
+            per_style[dimension]["generations"] += row['count']
+        elif metric == "generation_errors":
+            per_style[dimension]["errors"] += row['count']
+        elif metric == "refunds":
+            per_style[dimension]["refunds"] += row['count']
+            refunds += row['count']
+        elif metric == "payments":
+            packages[dimension]["payments"] += row['count']
+            packages[dimension]["stars"] += row['total']
+        elif metric == "openai_latency_ms":
+            latency_count += row['count']
+            latency_total += row['total']
+        elif metric == "openai_latency_ms_hist":
+            latency_hist[dimension] += row['count']
+        elif metric == "active_users":
+            active_by_hour[row['bucket'].isoformat(timespec="minutes")] = row['count']
+
+    attempts = sum(s["generations"] + s["errors"] for s in per_style.values())
+    # Корзина "inf" учитывается как значение больше последней границы
+    hist = {("1e12" if bound == "inf" else bound): count for bound, count in latency_hist.items()}
+    percentiles = {f"p{p}": _histogram_percentile(hist, p) for p in (50, 90, 95, 99)}
+
+    report = {
+        "generated_at": datetime.now().isoformat(timespec="seconds"),
+        "period_hours": hours,
+        "users": users,
+        "active_users": {
+            "last_hour": active_by_hour.get(hour_bucket().isoformat(timespec="minutes"), 0),
+            "peak_hour": max(active_by_hour.values(), default=0),
+            "by_hour": dict(sorted(active_by_hour.items())),
+        },
+        "generations": {
+            "total": sum(s["generations"] for s in per_style.values()),
+            "errors": sum(s["errors"] for s in per_style.values()),
+            "by_style": {style: dict(values) for style, values in sorted(per_style.items())},
+        },
+        "refund_rate": round(refunds / attempts, 4) if attempts else 0.0,
+        "openai_latency_ms": {
+            "count": latency_count,
+            "mean": round(latency_total / latency_count, 1) if latency_count else None,
+            # Перцентили - верхние границы корзин гистограммы; None сверх последней границы
+            **{name: (None if value == 1e12 else value) for name, value in percentiles.items()},
+        },
+        "revenue": {
+            "stars": sum(p["stars"] for p in packages.values()),
+            "by_package": {stars: {"payments": int(v["payments"]), "stars": int(v["stars"])}
+                           for stars, v in sorted(packages.items(), key=lambda item: int(item[0]))},
+        },
+        "counters": {row['stat_name']: row['value'] for row in counters},
+    }
+    _report_cache[hours] = (time.monotonic(), report)
+    return report
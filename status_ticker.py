@@ -0,0 +1,248 @@
+"""
+Модуль централизованного обновления статусных сообщений генерации.
+
+Вместо отдельной корутины-таймера на каждую генерацию один тикер обходит
+все активные задачи по колесу таймеров (timing wheel), ограничивает частоту
+правок в одном чате и общее количество правок в секунду, а также пропускает
+правки, которые не изменили бы текст сообщения.
+"""
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, List, Optional, Set, Tuple
+
+from telegram.error import BadRequest, RetryAfter
+
+from send_queue import outbound, PRIORITY_STATUS
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Интервал обновления статуса одной задачи (в секундах)
+STATUS_UPDATE_INTERVAL = float(os.getenv("STATUS_UPDATE_INTERVAL", "15"))
+# Шаг колеса таймеров (в секундах) и количество слотов
+TICK_SECONDS = 1.0
+WHEEL_SLOTS = 64
+# Минимальный интервал между правками в одном чате (в секундах)
+PER_CHAT_MIN_INTERVAL = float(os.getenv("STATUS_PER_CHAT_MIN_INTERVAL", "3"))
+# Максимальное количество правок статусов за один тик (на весь бот)
+MAX_EDITS_PER_TICK = int(os.getenv("STATUS_MAX_EDITS_PER_SECOND", "10"))
+
+STATUS_EMOJIS = ["⏱", "⏲", "⏳", "⌛"]
+STATUS_TEXTS = [
+    "Генерирую изображение... Это может занять несколько секунд.",
+    "Искусственный интеллект творит изображение...",
+    "Добавляю штрихи в стиле... Почти готово!",
+    "Завершаю работу над изображением..."
+]
+
+class StatusJob:
+    """Статусное сообщение одной генерации."""
+
+    __slots__ = ("bot", "chat_id", "message_id", "interval", "step", "last_text", "rounds", "active")
+
+    def __init__(self, bot, chat_id: int, message_id: int, interval: float):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.interval = interval
+        self.step = 0
+        self.last_text: Optional[str] = None
+        # Сколько полных оборотов колеса осталось до срабатывания
+        self.rounds = 0
+        self.active = True
+
+    def next_text(self) -> str:
+        """Текст следующего обновления статуса."""
+        emoji = STATUS_EMOJIS[self.step % len(STATUS_EMOJIS)]
+        text = STATUS_TEXTS[self.step % len(STATUS_TEXTS)]
+        return f"{emoji} {text}"
+
+class StatusTicker:
+    """
+    Единый планировщик обновлений статусных сообщений.
+
+    Задачи раскладываются по слотам колеса таймеров, поэтому стоимость одного тика
+    зависит только от количества задач, срабатывающих в этот тик.
+    """
+
+    def __init__(self, tick: float = TICK_SECONDS, slots: int = WHEEL_SLOTS,
+                 per_chat_interval: float = PER_CHAT_MIN_INTERVAL,
+                 max_edits_per_tick: int = MAX_EDITS_PER_TICK):
+        self.tick = tick
+        self.slots = slots
+        self.per_chat_interval = per_chat_interval
+        self.max_edits_per_tick = max_edits_per_tick
+        self._wheel: List[List[StatusJob]] = [[] for _ in range(slots)]
+        self._position = 0
+        self._active_jobs = 0
+        # Время последней правки в чате {chat_id: timestamp}
+        self._last_chat_edit: Dict[int, float] = {}
+        self._task: Optional[asyncio.Task] = None
+        # Выполняющиеся правки (ссылки нужны, чтобы задачи не собрал сборщик мусора)
+        self._edit_tasks: Set[asyncio.Task] = set()
+        # Счетчики для мониторинга
+        self.stats: Dict[str, int] = {
+            "edits": 0,
+            "skipped_unchanged": 0,
+            "deferred": 0,
+            "errors": 0,
+        }
+
+    def _schedule(self, job: StatusJob, delay: float) -> None:
+        """Положить задачу в слот колеса через delay секунд."""
+        ticks = max(1, int(round(delay / self.tick)))
+        job.rounds = (ticks - 1) // self.slots
+        slot = (self._position + ticks) % self.slots
+        self._wheel[slot].append(job)
+
+    def register(self, bot, chat_id: int, message_id: int,
+                 interval: float = STATUS_UPDATE_INTERVAL) -> StatusJob:
+        """
+        Начать периодически обновлять статусное сообщение.
+
+        Returns:
+            StatusJob: Дескриптор задачи, который нужно передать в unregister
+        """
+        job = StatusJob(bot, chat_id, message_id, interval)
+        self._schedule(job, interval)
+        self._active_jobs += 1
+        self._ensure_running()
+        return job
+
+    def unregister(self, job: Optional[StatusJob]) -> None:
+        """Прекратить обновление статуса. Задача будет удалена из колеса при следующем проходе."""
+        if job is not None and job.active:
+            job.active = False
+            self._active_jobs -= 1
+
+    def _ensure_running(self) -> None:
+        """Запустить цикл тикера, если он еще не запущен."""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Остановить тикер и отменить неотправленные правки статусов."""
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        # Правки статусов не нужны после остановки - не держим ради них очередь исходящих
+        edits = list(self._edit_tasks)
+        for task in edits:
+            task.cancel()
+        if edits:
+            await asyncio.gather(*edits, return_exceptions=True)
+
+    def _collect_due(self) -> List[StatusJob]:
+        """Сдвинуть колесо на один слот и забрать задачи, которым пора обновиться."""
+        self._position = (self._position + 1) % self.slots
+        bucket = self._wheel[self._position]
+        self._wheel[self._position] = []
+
+        due = []
+        for job in bucket:
+            if not job.active:
+                continue
+            if job.rounds > 0:
+                job.rounds -= 1
+                self._wheel[self._position].append(job)
+            else:
+                due.append(job)
+        return due
+
+    async def _edit(self, job: StatusJob, text: str) -> None:
+        """Отредактировать статусное сообщение одной задачи."""
+        try:
+            await outbound.submit(
+                lambda: job.bot.edit_message_text(chat_id=job.chat_id, message_id=job.message_id, text=text),
+                job.chat_id, PRIORITY_STATUS, idempotent=True
+            )
+            job.last_text = text
+            self.stats["edits"] += 1
+        except BadRequest as e:
+            if "Message is not modified" in str(e):
+                job.last_text = text
+                self.stats["skipped_unchanged"] += 1
+            else:
+                self.stats["errors"] += 1
+                logger.warning(f"Не удалось обновить статус: {e}")
+        except RetryAfter as e:
+            # Повторы в очереди исходящих исчерпаны - откладываем следующие правки в этом чате
+            self._last_chat_edit[job.chat_id] = time.monotonic() + float(e.retry_after)
+            self.stats["errors"] += 1
+            logger.warning(f"Флуд-лимит при обновлении статуса в чате {job.chat_id}: {e.retry_after} сек.")
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.warning(f"Не удалось обновить статус: {e}")
+
+    async def _process_tick(self) -> None:
+        """Обработать задачи текущего тика с учетом лимитов Telegram."""
+        due = self._collect_due()
+        if not due:
+            return
+
+        now = time.monotonic()
+        batch: List[Tuple[StatusJob, str]] = []
+        chats_in_batch = set()
+
+        for job in due:
+            text = job.next_text()
+
+            # Пропускаем правки, которые не изменят сообщение
+            if text == job.last_text:
+                self.stats["skipped_unchanged"] += 1
+                job.step += 1
+                self._schedule(job, job.interval)
+                continue
+
+            # Соблюдаем лимит частоты правок в одном чате и общий лимит на тик
+            chat_ready = now - self._last_chat_edit.get(job.chat_id, 0) >= self.per_chat_interval
+            if (not chat_ready or job.chat_id in chats_in_batch
+                    or len(batch) >= self.max_edits_per_tick):
+                self.stats["deferred"] += 1
+                self._schedule(job, self.tick)
+                continue
+
+            batch.append((job, text))
+            chats_in_batch.add(job.chat_id)
+            self._last_chat_edit[job.chat_id] = now
+            job.step += 1
+            self._schedule(job, job.interval)
+
+        # Правки уходят в очередь исходящих, тик не ждет их выполнения
+        for job, text in batch:
+            task = asyncio.create_task(self._edit(job, text))
+            self._edit_tasks.add(task)
+            task.add_done_callback(self._edit_tasks.discard)
+
+        # Очищаем устаревшие отметки о правках в чатах
+        if len(self._last_chat_edit) > 1000:
+            cutoff = now - self.per_chat_interval
+            self._last_chat_edit = {cid: ts for cid, ts in self._last_chat_edit.items() if ts > cutoff}
+
+    async def _run(self) -> None:
+        """Главный цикл тикера."""
+        logger.info("Запущен тикер статусных сообщений")
+        next_tick = time.monotonic()
+        try:
+            while True:
+                next_tick += self.tick
+                await asyncio.sleep(max(0, next_tick - time.monotonic()))
+                try:
+                    await self._process_tick()
+                except Exception as e:
+                    logger.error(f"Ошибка в тикере статусных сообщений: {e}")
+        except asyncio.CancelledError:
+            logger.info("Тикер статусных сообщений остановлен")
+
+    def get_stats(self) -> Dict[str, int]:
+        """Получить счетчики тикера."""
+        return {**self.stats, "active_jobs": self._active_jobs, "edits_in_flight": len(self._edit_tasks)}
+
+# Глобальный тикер статусных сообщений
+status_ticker = StatusTicker()
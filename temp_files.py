@@ -0,0 +1,183 @@
+"""
+Модуль учета временных файлов бота.
+
+Каждый временный файл регистрируется с владельцем (ID задачи генерации) и сроком
+жизни. Когда задача завершается, файлы владельца удаляются сразу через release(),
+а фоновая очистка в отдельном потоке проходит только по зарегистрированным файлам
+с истекшим сроком - без обхода каталогов по маске и без чужих файлов в /tmp.
+Вместо периодической проверки диска в метриках отдается свободное место, а при
+его нехватке удаляются все временные файлы, не занятые текущими задачами.
+"""
+import os
+import time
+import shutil
+import asyncio
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+# Каталог временных файлов и срок жизни файла без явного освобождения (в секундах)
+TEMP_DIR = os.getenv("TEMP_DIR", "images/temp")
+TEMP_FILE_TTL = float(os.getenv("TEMP_FILE_TTL", str(30 * 60)))
+# Как часто удалять файлы с истекшим сроком и измерять свободное место (в секундах)
+TEMP_SWEEP_INTERVAL = float(os.getenv("TEMP_SWEEP_INTERVAL", "300"))
+# Ниже этого свободного места (МБ) удаляются все временные файлы без активных владельцев
+TEMP_MIN_FREE_MB = float(os.getenv("TEMP_MIN_FREE_MB", "50"))
+
+class TempFileManager:
+    """
+    Реестр временных файлов {путь: (владелец, срок, размер)}.
+
+    Args:
+        directory: Каталог временных файлов
+        ttl: Срок жизни файла по умолчанию
+    """
+
+    def __init__(self, directory: str = TEMP_DIR, ttl: float = TEMP_FILE_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self._files: Dict[str, Tuple[str, float, int]] = {}
+        # Владельцы, чьи задачи сейчас выполняются (их файлы не трогает экстренная очистка)
+        self._active: Dict[str, int] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.disk_free_mb: Optional[float] = None
+        self.stats: Dict[str, int] = {
+            "registered": 0,
+            "removed": 0,
+            "expired": 0,
+            "emergency_removed": 0,
+            "freed_bytes": 0,
+            "remove_errors": 0,
+            "sweeps": 0,
+        }
+        os.makedirs(directory, exist_ok=True)
+
+    def register(self, file_path: str, owner: str, ttl: Optional[float] = None, size: int = 0) -> None:
+        """Зарегистрировать файл (повторная регистрация передает его другому владельцу)."""
+        if file_path not in self._files:
+            self.stats["registered"] += 1
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._files[file_path] = (owner, expires_at, size)
+
+    def _remove_sync(self, paths: Iterable[str]) -> Tuple[int, int]:
+        """Удалить файлы (выполняется в потоке). Возвращает (удалено, освобождено байт)."""
+        removed = freed = 0
+        for file_path in paths:
+            try:
+                size = os.path.getsize(file_path)
+                os.remove(file_path)
+                removed += 1
+                freed += size
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                self.stats["remove_errors"] += 1
+                logger.warning(f"Не удалось удалить временный файл {file_path}: {e}")
+        return removed, freed
+
+    async def _remove(self, paths: List[str], counter: str) -> int:
+        for file_path in paths:
+            self._files.pop(file_path, None)
+        if not paths:
+            return 0
+        removed, freed = await asyncio.to_thread(self._remove_sync, paths)
+        self.stats[counter] += removed
+        self.stats["freed_bytes"] += freed
+        return removed
+
+    async def remove(self, file_path: str) -> None:
+        """Удалить один файл, не дожидаясь завершения задачи владельца."""
+        await self._remove([file_path], "removed")
+
+    async def release(self, owner: str) -> int:
+        """Удалить все файлы владельца (вызывается по завершении задачи)."""
+        paths = [path for path, entry in self._files.items() if entry[0] == owner]
+        return await self._remove(paths, "removed")
+
+    def begin(self, owner: str) -> None:
+        """Отметить задачу владельца как выполняющуюся."""
+        self._active[owner] = self._active.get(owner, 0) + 1
+
+    async def finish(self, owner: str) -> None:
+        """Отметить завершение задачи и удалить ее файлы."""
+        count = self._active.pop(owner, 0) - 1
+        if count > 0:
+            self._active[owner] = count
+            return
+        await self.release(owner)
+
+    def _adopt_orphans_sync(self) -> List[str]:
+        """Файлы, оставшиеся в каталоге от прошлого запуска (выполняется в потоке один раз)."""
+        try:
+            with os.scandir(self.directory) as entries:
+                return [entry.path for entry in entries if entry.is_file()]
+        except OSError as e:
+            logger.warning(f"Не удалось просмотреть каталог временных файлов {self.directory}: {e}")
+            return []
+
+    def _measure_disk(self) -> None:
+        try:
+            self.disk_free_mb = shutil.disk_usage(self.directory).free / (1024 * 1024)
+        except OSError as e:
+            logger.warning(f"Не удалось определить свободное место на диске: {e}")
+
+    async def sweep(self) -> int:
+        """Удалить файлы с истекшим сроком; при нехватке места - все файлы без активных задач."""
+        self.stats["sweeps"] += 1
+        now = time.monotonic()
+        expired = [path for path, (owner, expires_at, _) in self._files.items() if expires_at <= now]
+        removed = await self._remove(expired, "expired")
+
+        await asyncio.to_thread(self._measure_disk)
+        if self.disk_free_mb is not None and self.disk_free_mb < TEMP_MIN_FREE_MB:
+            idle = [path for path, entry in self._files.items() if entry[0] not in self._active]
+            logger.warning(f"Критически мало места на диске: {self.disk_free_mb:.2f} МБ. "
+                           f"Удаляются временные файлы без активных задач: {len(idle)}")
+            removed += await self._remove(idle, "emergency_removed")
+            await asyncio.to_thread(self._measure_disk)
+        return removed
+
+    async def _run(self) -> None:
+        # Файлы прошлого запуска не удаляются сразу, а получают обычный срок жизни
+        for file_path in await asyncio.to_thread(self._adopt_orphans_sync):
+            if file_path not in self._files:
+                self.register(file_path, "orphan")
+        while True:
+            try:
+                removed = await self.sweep()
+                if removed:
+                    logger.info(f"Очистка временных файлов: удалено {removed}, "
+                                f"свободно на диске {self.disk_free_mb or 0:.2f} МБ")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка при очистке временных файлов: {e}")
+            await asyncio.sleep(TEMP_SWEEP_INTERVAL)
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Остановить очистку и удалить все зарегистрированные файлы."""
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self._remove(list(self._files), "removed")
+
+    def get_stats(self) -> dict:
+        return {
+            **self.stats,
+            "tracked": len(self._files),
+            "tracked_bytes": sum(entry[2] for entry in self._files.values()),
+            "active_owners": len(self._active),
+            "disk_free_mb": round(self.disk_free_mb, 1) if self.disk_free_mb is not None else None,
+        }
+
+# Глобальный экземпляр
+temp_files = TempFileManager()
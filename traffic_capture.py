@@ -0,0 +1,158 @@
+"""
+Модуль записи входящего трафика для регрессионных бенчмарков.
+
+Если задана переменная TRAFFIC_CAPTURE_PATH, каждое входящее обновление
+записывается в JSONL-файл вместе со смещением времени от начала записи.
+Перед записью обновление обезличивается: ID пользователей и чатов заменяются
+стабильными псевдонимами, имена удаляются, текст заменяется заглушкой той же
+длины, идентификаторы файлов и платежей хешируются. Такой файл можно
+воспроизвести через `python -m benchmarks.replay`.
+"""
+import os
+import json
+import time
+import uuid
+import hashlib
+import logging
+from typing import Any, Dict, Optional
+
+# Настройка логирования
+logger = logging.getLogger(__name__)
+
+CAPTURE_PATH = os.getenv("TRAFFIC_CAPTURE_PATH")
+# Соль для псевдонимов; без нее псевдонимы стабильны только в пределах одного запуска
+CAPTURE_SALT = os.getenv("TRAFFIC_CAPTURE_SALT") or uuid.uuid4().hex
+# Максимальное количество записываемых обновлений (0 - без ограничения)
+CAPTURE_MAX_UPDATES = int(os.getenv("TRAFFIC_CAPTURE_MAX_UPDATES", "0"))
+
+# ID пользователей и чатов Telegram содержат не более 52 значащих бит, поэтому
+# псевдонимы берутся из диапазона [2^52, 2^52 + 2^48): он не пересекается с
+# реальными ID, а значения остаются точно представимыми в double (меньше 2^53)
+PSEUDONYM_BASE = 1 << 52
+PSEUDONYM_SPACE = 1 << 48
+
+# Поля с персональными данными, которые удаляются целиком
+_DROPPED_FIELDS = {"first_name", "last_name", "username", "title", "phone_number", "language_code", "bio"}
+# Текстовые поля, содержимое которых заменяется заглушкой
+_TEXT_FIELDS = {"text", "caption"}
+# Идентификаторы, которые хешируются
+_HASHED_FIELDS = {
+    "file_id", "file_unique_id", "chat_instance", "inline_message_id",
+    "telegram_payment_charge_id", "provider_payment_charge_id",
+}
+# Объекты, поле id которых является ID пользователя или чата
+_ID_OBJECTS = {"from", "chat", "user", "sender_chat", "forward_from", "forward_from_chat"}
+
+def _digest(value: Any) -> str:
+    return hashlib.sha256(f"{CAPTURE_SALT}:{value}".encode()).hexdigest()
+
+def pseudonym(user_id: int) -> int:
+    """Стабильный псевдоним для ID пользователя или чата."""
+    sign = -1 if user_id < 0 else 1
+    return sign * (PSEUDONYM_BASE + int(_digest(abs(user_id))[:12], 16) % PSEUDONYM_SPACE)
+
+def _redact_text(text: str) -> str:
+    """Заменить текст заглушкой, сохранив команду, пробелы и длину."""
+    command = ""
+    if text.startswith("/"):
+        command = text.split(maxsplit=1)[0]
+        text = text[len(command):]
+    return command + "".join(ch if ch.isspace() else "x" for ch in text)
+
+def _anonymize_payload(payload: str) -> str:
+    """Обезличить invoice_payload (JSON с user_id)."""
+    try:
+        data = json.loads(payload)
+    except (TypeError, ValueError):
+        return _digest(payload)[:16]
+    if isinstance(data, dict) and isinstance(data.get("user_id"), int):
+        data["user_id"] = pseudonym(data["user_id"])
+    return json.dumps(data)
+
+def anonymize(value: Any, parent: Optional[str] = None) -> Any:
+    """Рекурсивно обезличить данные обновления Telegram."""
+    if isinstance(value, list):
+        return [anonymize(item, parent) for item in value]
+    if not isinstance(value, dict):
+        return value
+
+    result = {}
+    for key, item in value.items():
+        if key in _DROPPED_FIELDS:
+            continue
+        if key == "id" and parent in _ID_OBJECTS and isinstance(item, int):
+            result[key] = pseudonym(item)
+        elif key == "user_id" and isinstance(item, int):
+            result[key] = pseudonym(item)
+        elif key in _TEXT_FIELDS and isinstance(item, str):
+            result[key] = _redact_text(item)
+        elif key in _HASHED_FIELDS and isinstance(item, str):
+            result[key] = _digest(item)[:24]
+        elif key == "invoice_payload" and isinstance(item, str):
+            result[key] = _anonymize_payload(item)
+        else:
+            result[key] = anonymize(item, key)
+    return result
+
+class TrafficRecorder:
+    """
+    Запись обезличенных обновлений в JSONL.
+
+    Каждая строка: {"t": секунды от начала записи, "update": обновление}.
+    """
+
+    def __init__(self, path: Optional[str], max_updates: int = 0):
+        self.path = path
+        self.max_updates = max_updates
+        self.recorded = 0
+        self.errors = 0
+        self._file = None
+        self._started_at: Optional[float] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def _open(self) -> None:
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._started_at = time.monotonic()
+        logger.info(f"Запись трафика включена: {self.path}")
+
+    def record(self, update_data: Dict[str, Any]) -> None:
+        """Обезличить и записать одно обновление."""
+        if not self.enabled or (self.max_updates and self.recorded >= self.max_updates):
+            return
+        try:
+            if self._file is None:
+                self._open()
+            line = {
+                "t": round(time.monotonic() - self._started_at, 3),
+                "update": anonymize(update_data),
+            }
+            self._file.write(json.dumps(line, ensure_ascii=False) + "\n")
+            self.recorded += 1
+            # Сбрасываем буфер пачками, чтобы не писать на диск на каждое обновление
+            if self.recorded % 50 == 0:
+                self._file.flush()
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Ошибка при записи трафика: {e}")
+
+    async def capture(self, update, context) -> None:
+        """Обработчик TypeHandler: записывает обновление и не мешает остальным."""
+        self.record(update.to_dict())
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            logger.info(f"Запись трафика завершена: {self.recorded} обновлений в {self.path}")
+
+    def get_stats(self) -> dict:
+        return {"enabled": self.enabled, "recorded": self.recorded, "errors": self.errors}
+
+# Глобальный экземпляр
+traffic_recorder = TrafficRecorder(CAPTURE_PATH, CAPTURE_MAX_UPDATES)